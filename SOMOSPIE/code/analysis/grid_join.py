@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Joins predictions to observed values on integer grid keys instead of float (x, y) indexes.
+# Coordinates are mapped to the (row, col) of a grid: the geotransform of a raster when one is given,
+# otherwise the grid of the observed points (their minimum as origin and their smallest spacing as
+# resolution). Points within half a pixel of each other get the same key, so predictions rounded
+# to 9 decimals still match their observations.
+#
+# compare() reads the observed file once and matches every prediction file of a region against it
+# with a sorted search, then computes R^2, RMSE, deltas and relative deltas of all of them at once.
+#
+# Command-line example:
+# $ ./grid_join.py ../data/2017/original_sm/CEC_10.csv ../out/job/2017/month4/CEC_10/predictions/*.csv
+
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def geotransform(raster_file):
+    # (x0, dx, y0, dy) of the pixel centers of a raster
+    from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+    ds = gdal.Open(str(raster_file), 0)
+    gt = ds.GetGeoTransform()
+    ds = None
+    return gt[0] + gt[1] / 2, gt[1], gt[3] + gt[5] / 2, gt[5]
+
+
+def resolution(values, tolerance=1e-9):
+    # Smallest spacing between distinct coordinates, 1 when they are all the same
+    steps = np.diff(np.unique(values))
+    steps = steps[steps > tolerance]
+    return steps.min() if steps.size else 1.0
+
+
+def infer_grid(x, y):
+    return x.min(), resolution(x), y.min(), resolution(y)
+
+
+def grid_keys(x, y, grid):
+    # One int64 key per point from its (row, col) on the grid
+    x0, dx, y0, dy = grid
+    cols = np.rint((np.asarray(x) - x0) / dx).astype(np.int64)
+    rows = np.rint((np.asarray(y) - y0) / dy).astype(np.int64)
+    return rows * (2**31) + cols
+
+
+def match(keys, sorted_keys, order):
+    # Index in the observed points of every key, -1 when it is not observed
+    pos = np.searchsorted(sorted_keys, keys).clip(0, max(len(sorted_keys) - 1, 0))
+    found = sorted_keys[pos] == keys if len(sorted_keys) else np.zeros(len(keys), bool)
+    return np.where(found, order[pos], -1)
+
+
+def scores(obs, values):
+    # Number of points, R^2 and RMSE of every column of values (points, files) against obs (points),
+    # in one pass over the points with both values
+    obs = np.asarray(obs, dtype=np.float64)[:, None]
+    valid = ~np.isnan(values) & ~np.isnan(obs)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        o = np.where(valid, obs, 0.0)
+        p = np.where(valid, values, 0.0)
+        mean_o, mean_p = o.sum(axis=0) / n, p.sum(axis=0) / n
+        do, dp = np.where(valid, o - mean_o, 0.0), np.where(valid, p - mean_p, 0.0)
+        r2 = ((do * dp).sum(axis=0) / np.sqrt((do**2).sum(axis=0) * (dp**2).sum(axis=0)))**2
+        rmse = np.sqrt(((p - o)**2).sum(axis=0) / n)
+    return n, r2, rmse
+
+
+def read_predictions(pred_file):
+    new = pd.read_csv(pred_file, header=None)
+    new = new[new.columns[:3]]
+    new.columns = ["x", "y", "new"]
+    return new
+
+
+def compare(orig_file, pred_files, grid=None):
+    # Observed values (csv with header x, y, value) against every prediction file (x, y, value without header).
+    # Returns the observed DataFrame with one column per prediction file (nan where it has no prediction),
+    # and the statistics {pred_file: {"n", "r2", "rmse"}}.
+    old = pd.read_csv(orig_file)
+    old.columns = ["x", "y", "old"]
+    grid = grid or infer_grid(old["x"].values, old["y"].values)
+    keys = grid_keys(old["x"].values, old["y"].values, grid)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    # Predictions of every file on the observed points, (points, files)
+    values = np.full((len(old), len(pred_files)), np.nan)
+    for j, pred_file in enumerate(pred_files):
+        new = read_predictions(pred_file)
+        index = match(grid_keys(new["x"].values, new["y"].values, grid), sorted_keys, order)
+        found = index >= 0
+        # The first prediction of a point is kept
+        index, first = np.unique(index[found], return_index=True)
+        values[index, j] = new["new"].values[found][first]
+
+    n, r2, rmse = scores(old["old"].values, values)
+
+    for j, pred_file in enumerate(pred_files):
+        old[str(pred_file)] = values[:, j]
+    stats = {str(pred_file): {"n": int(n[j]), "r2": r2[j], "rmse": rmse[j]} for j, pred_file in enumerate(pred_files)}
+    return old, stats
+
+
+def deltas(compared, pred_file):
+    # x, y, old, new, deltas and relative deltas of the points of a prediction file with both values
+    df = compared[["x", "y", "old"]].assign(new=compared[str(pred_file)]).dropna()
+    df["deltas"] = df["new"] - df["old"]
+    df["reltas"] = df["deltas"] / df["old"]
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("orig_file", help="Observed values, csv with header x, y, value.")
+    parser.add_argument("pred_files", nargs="+", help="Predictions, csv files x, y, value without header.")
+    parser.add_argument("-r", "--raster", help="Raster whose grid gives the keys, the grid of the observed points by default.")
+    args = parser.parse_args()
+
+    grid = geotransform(args.raster) if args.raster else None
+    compared, stats = compare(args.orig_file, args.pred_files, grid)
+    for pred_file, s in stats.items():
+        print(f"{pred_file}: n={s['n']} r2={s['r2']} rmse={s['rmse']}")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Python version of obs_vs_pred.R: R^2 and RMSE of prediction files against the observed values
+# they left out, computed in process. The observed file is read once for all the prediction files
+# of a region, and the scores of all of them are computed in one pass (grid_join.scores).
+#
+# As in the R script, each prediction file is gridded (its points are the centers of the cells)
+# and the observed points take the value of the cell they fall in. Both files are read with
+# read.csv defaults (first row as header), and the lines appended to the R^2 and RMSE files are
+# the ones R writes: the value with 15 significant digits (NA when undefined), a comma and the
+# prediction file, so gather_analysis/parse_analysis read them the same.
+#
+# Command-line example:
+# $ ./obs_vs_pred.py ../out/job/2017/original_sm-month1/CEC_10.csv job.r2 job.rmse ../out/job/2017/month1/CEC_10/predictions/*.csv
+
+import argparse
+import numpy as np
+import pandas as pd
+import grid_join as gj
+
+
+def r_number(value):
+    # A double as R pastes it
+    return "NA" if np.isnan(value) else f"{value:.15g}"
+
+
+def extract(pred, x, y):
+    # Values of the gridded prediction (x, y, value) at the points (x, y), nan outside its cells
+    grid = gj.infer_grid(pred[:, 0], pred[:, 1])
+    keys = gj.grid_keys(pred[:, 0], pred[:, 1], grid)
+    order = np.argsort(keys, kind="stable")
+    index = gj.match(gj.grid_keys(x, y, grid), keys[order], order)
+    return np.where(index >= 0, pred[index, 2], np.nan)
+
+
+def obs_vs_pred(obs_file, pred_files):
+    # {pred_file: (r2, rmse)} of every prediction file against the observed file
+    obs = pd.read_csv(obs_file).to_numpy(dtype=np.float64)
+    values = np.full((len(obs), len(pred_files)), np.nan)
+    for j, pred_file in enumerate(pred_files):
+        pred = pd.read_csv(pred_file).to_numpy(dtype=np.float64)
+        if len(pred):
+            values[:, j] = extract(pred, obs[:, 0], obs[:, 1])
+    n, r2, rmse = gj.scores(obs[:, 2], values)
+    return {str(pred_file): (r2[j], rmse[j]) for j, pred_file in enumerate(pred_files)}
+
+
+def write_scores(scores, r2_out, rmse_out):
+    # Appends the lines of obs_vs_pred.R, one write per file so parallel regions do not interleave them
+    with open(r2_out, "a") as f:
+        f.write("".join(f"{r_number(r2)},{pred_file}\n" for pred_file, (r2, rmse) in scores.items()))
+    with open(rmse_out, "a") as f:
+        f.write("".join(f"{r_number(rmse)},{pred_file}\n" for pred_file, (r2, rmse) in scores.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("obs_file", help="Observed values, csv x, y, sm.")
+    parser.add_argument("r2_out", help="File where the R^2 lines are appended.")
+    parser.add_argument("rmse_out", help="File where the RMSE lines are appended.")
+    parser.add_argument("pred_files", nargs="+", help="Prediction files, csv x, y, sm.")
+    args = parser.parse_args()
+
+    write_scores(obs_vs_pred(args.obs_file, args.pred_files), args.r2_out, args.rmse_out)
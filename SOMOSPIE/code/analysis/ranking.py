@@ -1,4 +1,7 @@
+import os
+import hashlib
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from matplotlib import transforms
 import seaborn as sns
@@ -10,26 +13,103 @@ from sklearn.ensemble import RandomForestRegressor
 from sklearn.feature_selection import SelectKBest
 
 
-def get_scores(X, Y, methods):
-    scores = np.zeros((X.shape[1], len(methods)))
-    for i, method in enumerate(methods):
-        if method == 'LR':
-            reg = LinearRegression().fit(X, Y)
-            scores[:, i] = np.abs(reg.coef_)
-        elif method == 'ULR':
-            ureg = SelectKBest(score_func=f_regression, k='all').fit(X, Y)
-            scores[:, i] = ureg.scores_
-        elif method == 'MI':
-            minfo = SelectKBest(score_func=mutual_info_regression, k='all').fit(X, Y)
-            scores[:, i] = minfo.scores_       
-        elif method == 'RF':
-            reg = RandomForestRegressor(n_estimators=100, max_depth=None, random_state=0).fit(X, Y)
-            scores[:, i] = np.abs(reg.feature_importances_)
-        else:
-            raise Exception('Method: <' + method + '> is not supported.')
+def method_scores(X, Y, method):
+    # Score of every feature (column of X) by a ranking method
+    if method == 'LR':
+        reg = LinearRegression().fit(X, Y)
+        return np.abs(reg.coef_)
+    elif method == 'ULR':
+        ureg = SelectKBest(score_func=f_regression, k='all').fit(X, Y)
+        return ureg.scores_
+    elif method == 'MI':
+        minfo = SelectKBest(score_func=mutual_info_regression, k='all').fit(X, Y)
+        return minfo.scores_
+    elif method == 'RF':
+        reg = RandomForestRegressor(n_estimators=100, max_depth=None, random_state=0).fit(X, Y)
+        return np.abs(reg.feature_importances_)
+    else:
+        raise Exception('Method: <' + method + '> is not supported.')
+
+
+def stratified_sample(Y, size, rng, bins=10):
+    # Indices of about size rows drawn without replacement from every quantile bin of Y in proportion to it,
+    # so the subsample keeps the distribution of the target
+    Y = np.asarray(Y).ravel()
+    if size is None or size >= len(Y):
+        return np.arange(len(Y))
+    edges = np.quantile(Y, np.linspace(0, 1, bins + 1)[1:-1])
+    strata = np.searchsorted(edges, Y, side='right')
+    sample = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        k = max(1, int(round(size * len(members) / len(Y))))
+        sample.append(rng.choice(members, min(k, len(members)), replace=False))
+    return np.sort(np.concatenate(sample))
+
+
+def scores_hash(X, Y, *extra):
+    digest = hashlib.sha256()
+    digest.update(repr((np.shape(X), extra)).encode())
+    digest.update(np.ascontiguousarray(X, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(Y, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def score_samples(X, Y, methods, sample_size=None, repeats=1, workers=1, seed=0, cache_dir=None):
+    # Scores of every method on repeats stratified subsamples of sample_size rows (all the rows by default),
+    # shape (repeats, features, methods). The (subsample, method) fits run in workers threads: the
+    # estimators release the GIL in their numerical code, and the threads share X and Y instead of
+    # copying them. With cache_dir, the scores are stored under the hash of the data and the options,
+    # and read back by a call with the same ones (e.g. to plot them again).
+    X, Y = np.asarray(X), np.asarray(Y).ravel()
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = os.path.join(cache_dir, f"scores_{scores_hash(X, Y, list(methods), sample_size, repeats, seed)}.npy")
+        if os.path.isfile(cache_file):
+            return np.load(cache_file)
+
+    rng = np.random.default_rng(seed)
+    # Without subsampling every repeat would fit the same rows
+    repeats = repeats if sample_size and sample_size < len(Y) else 1
+    samples = [stratified_sample(Y, sample_size, rng) for _ in range(repeats)]
+    jobs = [(r, i) for r in range(len(samples)) for i in range(len(methods))]
+
+    def run(job):
+        r, i = job
+        return method_scores(X[samples[r]], Y[samples[r]], methods[i])
+
+    scores = np.zeros((repeats, X.shape[1], len(methods)))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run, jobs))
+    else:
+        results = [run(job) for job in jobs]
+    for (r, i), result in zip(jobs, results):
+        scores[r, :, i] = result
+
+    if cache_dir:
+        # Written to a file of the process and renamed, so a concurrent call never reads a partial file
+        temp = f"{cache_file}.{os.getpid()}.npy"
+        np.save(temp, scores)
+        os.replace(temp, cache_file)
     return scores
 
 
+def get_scores(X, Y, methods, sample_size=None, repeats=1, workers=1, seed=0, cache_dir=None):
+    # Scores of every feature (rows) by every method (columns), averaged over the subsamples
+    return score_samples(X, Y, methods, sample_size, repeats, workers, seed, cache_dir).mean(axis=0)
+
+
+def rank_stability(samples, descending=True):
+    # Mean and standard deviation over the subsamples of the rank of every feature (0 the first) by every
+    # method, from the scores of score_samples; a deviation near 0 means a rank the subsampling does not change
+    order = samples.argsort(axis=1)
+    if descending:
+        order = order[:, ::-1, :]
+    ranks = order.argsort(axis=1)
+    return ranks.mean(axis=0), ranks.std(axis=0)
+
+
 def plot_ranking(labels, scores, score_names, descending=True, fig_title='', filename=''):
     # Labels is a 1-d array of strings, Scores is a 2-d array of numbers
     labels = np.array([label if len(label.split()) < 2 else '. '.join([s[0:2] for s in label.split()]) for label in labels])
@@ -7,6 +7,7 @@ import pandas as pd
 import matplotlib as mpl
 import numpy as np
 import argument_validators as av
+import grid_join as gj
 from matplotlib import pyplot as plt
 from os import fspath
 from math import ceil
@@ -44,9 +45,86 @@ def validate_args(args):
     return val_args 
 
 
-# General heatmap function. 
-def heatmap(df, horizontal=0, vertical=1, value=2, vmin=None, vmax=None, size=1, title="Heatmap", out="", cmap=None):
-    df.plot.scatter(x=horizontal, y=vertical, s=size, c=value, cmap=cmap, title=title, vmin=vmin, vmax=vmax)
+# Maps with more points than this are drawn as an image of their grid instead of one marker per point.
+RASTER_POINTS = 50000
+
+
+# Label of a column given by label or by position, as pandas plotting resolves it.
+def column(df, c):
+    return c if c in df.columns else df.columns[c]
+
+
+# Output size in pixels of the figures.
+def figure_pixels():
+    dpi = plt.rcParams["savefig.dpi"]
+    dpi = plt.rcParams["figure.dpi"] if dpi == "figure" else dpi
+    width, height = plt.rcParams["figure.figsize"]
+    return int(width * dpi), int(height * dpi)
+
+
+# Bins points onto their native grid (the grid_join grid of their coordinates), decimated to at most
+# width x height cells by averaging the points of every block ("mean"), or by taking one of them
+# ("nearest", for classes, which an average would turn into classes that do not exist). Returns the image,
+# first row at the bottom, with nan where there is no point, and its extent (left, right, bottom, top).
+def grid_image(x, y, values, width, height, reduce="mean"):
+    x, y, values = (np.asarray(a, dtype=np.float64) for a in (x, y, values))
+    x0, dx, y0, dy = gj.infer_grid(x, y)
+    cols = np.rint((x - x0) / dx).astype(np.int64)
+    rows = np.rint((y - y0) / dy).astype(np.int64)
+    fx, fy = max(1, ceil((cols.max() + 1) / width)), max(1, ceil((rows.max() + 1) / height))
+    cols, rows = cols // fx, rows // fy
+    shape = (rows.max() + 1, cols.max() + 1)
+    cells = rows * shape[1] + cols
+    valid = ~np.isnan(values)
+    if reduce == "nearest":
+        image = np.full(shape[0] * shape[1], np.nan)
+        image[cells[valid]] = values[valid]
+        image = image.reshape(shape)
+    else:
+        sums = np.bincount(cells[valid], weights=values[valid], minlength=shape[0] * shape[1])
+        counts = np.bincount(cells[valid], minlength=shape[0] * shape[1])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            image = (sums / counts).reshape(shape)
+    extent = (x0 - dx / 2, x0 + (shape[1] * fx - 0.5) * dx, y0 - dy / 2, y0 + (shape[0] * fy - 0.5) * dy)
+    return image, extent
+
+
+# Reads the first band of a raster decimated to at most width x height pixels (GDAL reads its overviews when
+# it has them), so the time does not depend on the size of the raster. Same returns as grid_image.
+def raster_image(raster_file, width, height):
+    from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+    ds = gdal.Open(fspath(raster_file), 0)
+    band = ds.GetRasterBand(1)
+    xsize, ysize = min(width, ds.RasterXSize), min(height, ds.RasterYSize)
+    image = band.ReadAsArray(buf_xsize=xsize, buf_ysize=ysize).astype(np.float64)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        image[image == nodata] = np.nan
+    gt = ds.GetGeoTransform()
+    left, right = gt[0], gt[0] + gt[1] * ds.RasterXSize
+    top, bottom = gt[3], gt[3] + gt[5] * ds.RasterYSize
+    ds = None
+    # First row at the bottom, as grid_image
+    image = image[::-1]
+    return image, (left, right, bottom, top)
+
+
+# General heatmap function. Points are drawn as markers, or as an image of their grid when raster is true
+# (by default when there are more than RASTER_POINTS); the image is decimated to the pixels of the figure
+# with the reduce of grid_image.
+def heatmap(df, horizontal=0, vertical=1, value=2, vmin=None, vmax=None, size=1, title="Heatmap", out="", cmap=None, raster=None, reduce="mean"):
+    if raster is None:
+        raster = len(df) > RASTER_POINTS
+    if raster:
+        x, y, c = column(df, horizontal), column(df, vertical), column(df, value)
+        image, extent = grid_image(df[x], df[y], df[c], *figure_pixels(), reduce=reduce)
+        image_map(image, extent, xlabel=x, ylabel=y, legend=c, vmin=vmin, vmax=vmax, title=title, cmap=cmap)
+    else:
+        df.plot.scatter(x=horizontal, y=vertical, s=size, c=value, cmap=cmap, title=title, vmin=vmin, vmax=vmax)
+    save_or_show(out)
+
+
+def save_or_show(out=""):
     if out:
         print(f"Saving image to {out}")
         plt.savefig(fspath(out))
@@ -55,15 +133,36 @@ def heatmap(df, horizontal=0, vertical=1, value=2, vmin=None, vmax=None, size=1,
     plt.close()
 
 
+# Draws an image the way heatmap draws its points: same axes, labels and colorbar.
+def image_map(image, extent, xlabel="", ylabel="", legend="", vmin=None, vmax=None, title="", cmap=None):
+    cmap = mpl.colormaps[cmap] if isinstance(cmap, str) else (cmap or mpl.colormaps[mpl.rcParams["image.cmap"]])
+    cmap = cmap.copy()
+    cmap.set_bad(alpha=0)
+    fig, ax = plt.subplots()
+    im = ax.imshow(np.ma.masked_invalid(image), extent=extent, origin="lower", aspect="auto",
+                   interpolation="nearest", cmap=cmap, vmin=vmin, vmax=vmax)
+    fig.colorbar(im, ax=ax, label=legend)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+
+
 # For if a dataframe has three columns--1st lon, 2nd lat, 3rd soil moisture
-def soil_map(df, title="Soil Moisture Heatmap", out="", cmap=plt.cm.get_cmap('RdBu'), legend="Soil Moisture", size=.05, vmin=None, vmax=None, value=2):
+def soil_map(df, title="Soil Moisture Heatmap", out="", cmap=plt.cm.get_cmap('RdBu'), legend="Soil Moisture", size=.05, vmin=None, vmax=None, value=2, raster=None):
     if df.shape[1]<3:
         raise ValueError("The dataframe doesn't have enough columns.")
     elif df.shape[1]>3:
         #print("The dataframe has too many columns, so we're dropping all but the first three.")
         df = df[df.columns[:3]]
     df.columns=["Longitude", "Latitude", legend]
-    heatmap(df, title=title, out=out, cmap=cmap, size=size, vmin=vmin, vmax=vmax, value=value)
+    heatmap(df, title=title, out=out, cmap=cmap, size=size, vmin=vmin, vmax=vmax, value=value, raster=raster)
+
+
+# soil_map of a prediction GeoTIFF, read at the resolution of the figure
+def tif_map(raster_file, title="Soil Moisture Heatmap", out="", cmap=plt.cm.get_cmap('RdBu'), legend="Soil Moisture", vmin=None, vmax=None):
+    image, extent = raster_image(raster_file, *figure_pixels())
+    image_map(image, extent, xlabel="Longitude", ylabel="Latitude", legend=legend, vmin=vmin, vmax=vmax, title=title, cmap=cmap)
+    save_or_show(out)
 
 
 # Rounds value to one of a specified "scale", or to integers if no scale given.
@@ -126,7 +225,8 @@ def discrete_map(df, horizontal=0, vertical=1, value=2, title="Discrete Heatmap"
     base = plt.cm.gnuplot
     color_list = base(np.linspace(0, 1, n))
     cmap = base.from_list(f"cmap{n}", color_list, n)
-    heatmap(df, horizontal=horizontal, vertical=vertical, value=value, vmin=bounds[0]-.5, vmax=bounds[-1]+.5, title=title, out=out, cmap=cmap)
+    # Blocks of a large map take the class of one of their points, never an average of classes
+    heatmap(df, horizontal=horizontal, vertical=vertical, value=value, vmin=bounds[0]-.5, vmax=bounds[-1]+.5, title=title, out=out, cmap=cmap, reduce="nearest")
 
 
 # Argument dep_var give the column number for the dependent variable.
@@ -10,6 +10,7 @@
 import numpy as np
 import pandas as pd
 import argparse
+import os
 import pickle
 from sklearn.neighbors import KNeighborsRegressor
 from sklearn.model_selection import train_test_split
@@ -17,6 +18,10 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.metrics import mean_squared_error
 
+# Cores given to the model by the scheduler of the workflow (SOMOSPIE_CORES), all the processors otherwise
+def n_jobs():
+    return int(os.environ.get("SOMOSPIE_CORES", -1))
+
 
 #Input arguments to execute the k-Nearest Neighbors Regression 
 def get_parser():
@@ -69,9 +74,9 @@ def random_parameter_search(knn, x_train, y_train, maxK, seed):
     	  'metric': ['euclidean','minkowski']
              }
     # Random search based on the grid of params and n_iter controls number of random combinations it will try
-    # n_jobs=-1 means using all processors
+    # n_jobs() is -1 (all processors) unless the workflow gives the model fewer cores
     # random_state sets the seed for manner of reproducibility 
-    params_search = RandomizedSearchCV(knn, params, verbose=1, cv=10, n_iter=50, random_state=seed, n_jobs=-1)
+    params_search = RandomizedSearchCV(knn, params, verbose=1, cv=10, n_iter=50, random_state=seed, n_jobs=n_jobs())
     params_search.fit(x_train,y_train)
     # Check the results from the parameter search  
     print(params_search.best_score_)
@@ -91,7 +96,7 @@ def train_knn(x_train, y_train, maxK, seed, scalermodel):
     best_params = random_parameter_search(knn, x_train, y_train, maxK, seed)
     # Based on selection build the new regressor
     knn = KNeighborsRegressor(n_neighbors=best_params['n_neighbors'], weights=best_params['weights'],
-    				metric=best_params['metric'], n_jobs=-1)
+    				metric=best_params['metric'], n_jobs=n_jobs())
     # Fit the new model to data
     knn.fit(x_train, y_train)
     # Save model
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Runs the models of hyppo.py, knn.py and rf.py in the calling process, on train and eval data
+# loaded once per region, instead of one interpreter per model and parameter combination.
+# The arguments of a combination are parsed by the parser of its script, so they are the same
+# as on the command line, and the predictions and logs are written to the same files.
+#
+# Usage:
+#     data = load_region(train_file, eval_file)
+#     rows = run("KKNN", [("-k", 20)], data, train_file, eval_file, out_file, log_file)
+
+import numpy as np
+import pandas as pd
+import hyppo
+import knn
+import rf
+
+MODELS = ["HYPPO", "KNN", "SBM", "1NN", "KKNN", "RF"]
+
+
+def load_region(train_file, eval_file):
+    # Train and eval tables of a region, as DataFrames for knn/rf and arrays for hyppo
+    train_data = pd.read_csv(train_file)
+    eval_data = pd.read_csv(eval_file)
+    return {
+        "train": train_data,
+        "eval": eval_data,
+        "train_values": train_data.to_numpy(dtype=np.float64),
+        "eval_values": eval_data.to_numpy(dtype=np.float64),
+    }
+
+
+def model_args(MODEL, train_file, eval_file, out_file, log_file, params=()):
+    # The command-line arguments model.py used to pass to the script of the model
+    if MODEL in ["HYPPO", "KNN", "SBM"]:
+        argv = ["-t", train_file, "-e", eval_file, "-m", MODEL, "-o", out_file, "-l", log_file]
+    elif MODEL == "1NN":
+        argv = ["-t", train_file, "-e", eval_file, "-m", "KNN", "-o", out_file, "-s", 0, "-S", "1,2", "-v", 2, "-k", 1, "-l", log_file]
+    elif MODEL in ["KKNN", "RF"]:
+        argv = ["-t", train_file, "-e", eval_file, "-o", out_file, "-l", log_file]
+    else:
+        raise ValueError(f"Model \"{MODEL}\" unknown!")
+    for param in params:
+        argv.extend(param)
+    return [str(arg) for arg in argv]
+
+
+def run_hyppo(args, data):
+    hyppo.log(f"\n{len(data['train_values'])} lines of original data have been loaded from {args.train}.\n", file=args.logFile)
+    hyppo.log(f"{len(data['eval_values'])} lines of evaluation data have been loaded from {args.eval}.\n", file=args.logFile)
+    output = hyppo.main(data["train_values"], data["eval_values"], args)
+    np.savetxt(args.out, output, delimiter=",", fmt='%.15f')
+    return len(output)
+
+
+def training_table(data):
+    # Third column renamed to z, as from_args_to_vars of knn.py and rf.py
+    training_data = data["train"].copy()
+    col = list(training_data.columns)
+    col[2] = 'z'
+    training_data.columns = col
+    return training_data
+
+
+def run_knn(args, data):
+    training_data, evaluation_data = training_table(data), data["eval"]
+    maxK, seed = int(args.maxK), int(args.seed)
+    x_train, y_train, x_test, y_test, ss = knn.split_and_preprocess_trainingdata(training_data)
+    model = knn.train_knn(x_train, y_train, maxK, seed, ss)
+    knn.validate_knn(model, x_test, y_test)
+    x_predict = knn.preprocess_evaluationdata(evaluation_data, ss)
+    knn.predict_knn(x_predict, evaluation_data, args.outputdata, model)
+    return len(evaluation_data)
+
+
+def run_rf(args, data):
+    training_data, evaluation_data = training_table(data), data["eval"]
+    maxtree, seed = int(args.maxtree), int(args.seed)
+    x_train, y_train, x_test, y_test, ss = rf.split_and_preprocess_trainingdata(training_data)
+    model = rf.train_rf(x_train, y_train, maxtree, seed)
+    rf.validate_rf(model, x_test, y_test)
+    x_predict = rf.preprocess_evaluationdata(evaluation_data, ss)
+    rf.predict_rf(x_predict, evaluation_data, args.outputdata, model)
+    return len(evaluation_data)
+
+
+def run(MODEL, params, data, train_file, eval_file, out_file, log_file):
+    # Runs one parameter combination (list of (flag, value)) of a model, returns the rows predicted
+    argv = model_args(MODEL, train_file, eval_file, out_file, log_file, params)
+    if MODEL in ["HYPPO", "KNN", "SBM", "1NN"]:
+        return run_hyppo(hyppo.get_parser().parse_args(argv), data)
+    elif MODEL == "KKNN":
+        return run_knn(knn.get_parser().parse_args(argv), data)
+    else:
+        return run_rf(rf.get_parser().parse_args(argv), data)
@@ -10,6 +10,7 @@
 import numpy as np
 import pandas as pd
 import argparse
+import os
 import pickle
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.datasets import make_regression
@@ -18,6 +19,10 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.metrics import mean_squared_error
 
+# Cores given to the model by the scheduler of the workflow (SOMOSPIE_CORES), all the processors otherwise
+def n_jobs():
+    return int(os.environ.get("SOMOSPIE_CORES", -1))
+
 def get_parser():
     #Input arguments to execute the k-Nearest Neighbors Regression 
     parser = argparse.ArgumentParser(description='Arguments and data files for executing Random forest.')
@@ -77,11 +82,11 @@ def random_parameter_search(rf, x_train, y_train, maxtree, seed):
                    'max_features': ['sqrt'],
                    'max_depth': [20,50,70],
                    'bootstrap': [True],
-                   'n_jobs':[-1]}
+                   'n_jobs':[n_jobs()]}
     # Random search based on the grid of params and n_iter controls number of random combinations it will try
-    # n_jobs=-1 means using all processors
+    # n_jobs() is -1 (all processors) unless the workflow gives the model fewer cores
     # random_state sets the seed for manner of reproducibility 
-    params_search = RandomizedSearchCV(rf, params, verbose=1, cv=10, n_iter=10, random_state=seed, n_jobs=-1)
+    params_search = RandomizedSearchCV(rf, params, verbose=1, cv=10, n_iter=10, random_state=seed, n_jobs=n_jobs())
     params_search.fit(x_train,y_train)
     # Check the results from the parameter search  
     print(params_search.best_score_)
@@ -4,10 +4,12 @@
 # in train and predi files are identical.
 # Thus the sm header(s) in the train file must be numeric (day/month/year).
 
-import sys
+import argparse
+import hashlib
+import os
 import numpy as np
 import pandas as pd
-from sklearn.decomposition import PCA #TruncatedSVD as SVD
+from sklearn.decomposition import PCA, IncrementalPCA #TruncatedSVD as SVD
 from sklearn.preprocessing import StandardScaler
 from sklearn.pipeline import Pipeline
 
@@ -29,24 +31,87 @@ def remove_sparse_rows(data, error=-99999.0):
     data_matrix = [row for row in data_matrix if error in row]
     return pd.DataFrame(data_matrix, columns=data.columns)
 
-def fit_data(train_data, num_comps="mle"):
+def fit_data(train_data, num_comps="mle", solver="full"):
     # Build pipeline and fit it to training data.
     scaler = StandardScaler()
     # https://github.com/scikit-learn/scikit-learn/issues/9884
-    pca = PCA(n_components=num_comps, svd_solver="full")
+    pca = PCA(n_components=num_comps, svd_solver=solver)
     pipeline = Pipeline([("scaler", scaler), ("pca", pca)])
     pipeline.fit(train_data)
     return pipeline
 
 
+# Keep the first {num_comps} components of a fitted pipeline.
+# The components are sorted by eigenvalue, so this is the model a refit with {num_comps} would give.
+def truncate(model, num_comps):
+    pca = model.named_steps["pca"]
+    pca.components_ = pca.components_[:num_comps]
+    for attr in ["explained_variance_", "explained_variance_ratio_", "singular_values_"]:
+        setattr(pca, attr, getattr(pca, attr)[:num_comps])
+    pca.n_components_ = pca.n_components = num_comps
+    return model
+
+
+def count_comps(model, bound=1):
+    eigenvals = model.named_steps['pca'].explained_variance_
+    #print(f"eigenvals:\n{eigenvals}\n")
+    return max(1, len([ev for ev in eigenvals if (ev >= bound)]))
+
+
 #Select the target number of components.
 # Uses Avereage Eigenvalue technique from:
 # http://pubs.acs.org/doi/pdf/10.1021/ie990110i
 def choose_num_comps(train_data, bound=1):
-    model = fit_data(train_data)
-    eigenvals = model.named_steps['pca'].explained_variance_
-    #print(f"eigenvals:\n{eigenvals}\n")
-    return len([ev for ev in eigenvals if (ev >= bound)])
+    return count_comps(fit_data(train_data), bound)
+
+
+# Fit the pipeline once and keep the components with eigenvalue >= {bound}.
+#   full        exact SVD of all the components (as choose_num_comps)
+#   randomized  for wide data: randomized SVD of a few components, doubled until
+#               the last eigenvalue is below {bound}
+# Returns the pipeline and the number of components.
+def fit_pca(train_data, bound=1, solver="full"):
+    if solver == "randomized":
+        most = min(train_data.shape)
+        num_comps = min(8, most)
+        while True:
+            model = fit_data(train_data, num_comps, "randomized")
+            if num_comps == most or model.named_steps["pca"].explained_variance_[-1] < bound:
+                break
+            num_comps = min(2 * num_comps, most)
+    else:
+        model = fit_data(train_data)
+    num_comps = count_comps(model, bound)
+    return truncate(model, num_comps), num_comps
+
+
+# Batches of at least {min_rows} rows: IncrementalPCA needs as many rows as components in each
+# partial fit, a short last chunk is merged into the one before.
+def batches(chunks, min_rows):
+    previous = None
+    for chunk in chunks:
+        if previous is not None and len(chunk) < min_rows:
+            chunk = pd.concat([previous, chunk])
+        elif previous is not None:
+            yield previous
+        previous = chunk
+    if previous is not None:
+        yield previous
+
+
+# Fit the pipeline on a training csv too long for memory: the scaler and an IncrementalPCA of all
+# the components are fitted chunk by chunk, in two passes over the file.
+def fit_pca_incremental(train_file, params, bound=1, chunksize=100000):
+    chunksize = max(chunksize, len(params))
+    scaler = StandardScaler()
+    for chunk in pd.read_csv(train_file, usecols=params, chunksize=chunksize):
+        scaler.partial_fit(chunk[params])
+    pca = IncrementalPCA(n_components=len(params))
+    for chunk in batches(pd.read_csv(train_file, usecols=params, chunksize=chunksize), len(params)):
+        pca.partial_fit(scaler.transform(chunk[params]))
+    model = Pipeline([("scaler", scaler), ("pca", pca)])
+    num_comps = count_comps(model, bound)
+    return truncate(model, num_comps), num_comps
 
 
 # Assumes the first two columns are x/y-coordinates
@@ -74,13 +139,24 @@ def apply_model(df, model, params, num_comps):
     return post_full
 
 
-def joint_pca(train_data, predi_data, params):
+# Apply the model to a csv file chunk by chunk, writing each chunk as it is transformed,
+# so the memory does not depend on the size of the file. Returns the number of rows.
+def transform_csv(in_file, out_file, model, params, num_comps, chunksize=100000):
+    rows = 0
+    for i, chunk in enumerate(pd.read_csv(in_file, header=0, chunksize=chunksize)):
+        post = apply_model(chunk, model, params, num_comps)
+        post.to_csv(path_or_buf=out_file, index=False, mode="w" if i == 0 else "a", header=(i == 0))
+        rows += len(post)
+    return rows
+
 
-    # Run PCA on train_data to create a dimension-reduction model.
+def joint_pca(train_data, predi_data, params, solver="full"):
+
+    # Run PCA on train_data to create a dimension-reduction model,
+    # fitted once: the components kept are read from the eigenvalues of that fit.
     pca_train = train_data[params]
-    num_comps = choose_num_comps(pca_train)
+    model, num_comps = fit_pca(pca_train, solver=solver)
     #print(f"num_comps:\n{num_comps}\n")
-    model = fit_data(pca_train, num_comps)
     #print(f"model:\n{model}\n")
     
     #print(f"one row of train_data before:\n{train_data.iloc[1]}")
@@ -98,31 +174,129 @@ def joint_pca(train_data, predi_data, params):
     return train_data, predi_data, components
 
 
+# Hash of the values and column names of a DataFrame, the index is ignored.
+def data_hash(df, *extra):
+    digest = hashlib.sha256()
+    digest.update(repr((list(df.columns), extra)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()[:16]
+
+
+# Pickle written to a file of the process and renamed, so concurrent regions never read a partial file.
+def write_pickle(obj, path):
+    temp = f"{path}.{os.getpid()}"
+    pd.to_pickle(obj, temp)
+    os.replace(temp, path)
+
+
+# Most cache_dir holds, in MB: past it the files used least recently are removed.
+PCA_CACHE_MB = 1024
+
+
+# Removes the least recently used pickles of cache_dir until it holds at most max_mb.
+def prune_cache(cache_dir, max_mb=PCA_CACHE_MB):
+    files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(".pkl")]
+    files = sorted((os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files if os.path.isfile(f))
+    total = sum(size for _, size, _ in files)
+    for _, size, f in files:
+        if total <= max_mb * 1024**2:
+            break
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def read_cached(path):
+    # Pickle of the cache, marked as used for prune_cache
+    obj = pd.read_pickle(path)
+    os.utime(path)
+    return obj
+
+
+# joint_pca with the fitted pipeline and the transformed predi data stored in {cache_dir}.
+# The model is keyed by the hash of the training covariates and the component rule (solver, bound),
+# so the results are those of joint_pca. The months of a region whose training points have the same
+# covariates reuse one fit. The transformed predi data (keyed by the model and the hash of the predi data)
+# is only stored once its model has been reused, so months with their own fit do not write eval tables
+# that would never be read. The cache holds at most max_mb, the files used least recently are removed.
+# Returns the same as joint_pca and the names of what was reused.
+def cached_joint_pca(train_data, predi_data, params, cache_dir, solver="full", bound=1, max_mb=PCA_CACHE_MB):
+    os.makedirs(cache_dir, exist_ok=True)
+    reused = []
+    model_key = data_hash(train_data[params], solver, bound)
+    model_file = os.path.join(cache_dir, f"pca_{model_key}.pkl")
+    if os.path.isfile(model_file):
+        model, num_comps = read_cached(model_file)
+        reused.append("model")
+    else:
+        model, num_comps = fit_pca(train_data[params], bound, solver)
+        write_pickle((model, num_comps), model_file)
+
+    predi_file = os.path.join(cache_dir, f"predi_{model_key}_{data_hash(predi_data)}.pkl")
+    if os.path.isfile(predi_file):
+        predi_post = read_cached(predi_file)
+        reused.append("eval")
+    else:
+        predi_post = apply_model(predi_data, model, params, num_comps)
+        if reused:
+            write_pickle(predi_post, predi_file)
+    prune_cache(cache_dir, max_mb)
+
+    train_post = apply_model(train_data, model, params, num_comps)
+    return train_post, predi_post, model.named_steps["pca"].components_, reused
+
+
+# Streaming version of joint_pca for files: the eval (predi) file is never loaded whole.
+# The training file is loaded for the full/randomized solvers, read in chunks for incremental.
+def stream_pca(train_in, predi_in, train_out, predi_out, solver="incremental", chunksize=100000):
+    params = get_params(pd.read_csv(train_in, header=0, nrows=0))
+    if solver == "incremental":
+        model, num_comps = fit_pca_incremental(train_in, params, chunksize=chunksize)
+        transform_csv(train_in, train_out, model, params, num_comps, chunksize)
+    else:
+        train_data = pd.read_csv(train_in, header=0)
+        model, num_comps = fit_pca(train_data[params], solver=solver)
+        apply_model(train_data, model, params, num_comps).to_csv(path_or_buf=train_out, index=False)
+    transform_csv(predi_in, predi_out, model, params, num_comps, chunksize)
+    return params, model.named_steps["pca"].components_
+
+
 if __name__ == "__main__":
-    train_in = sys.argv[1]
-    predi_in = sys.argv[2]
-    train_out = sys.argv[3]
-    predi_out = sys.argv[4]
-    log_file = sys.argv[5]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("train_in", help="Training data file.")
+    parser.add_argument("predi_in", help="Prediction data file.")
+    parser.add_argument("train_out", help="Training data file after PCA.")
+    parser.add_argument("predi_out", help="Prediction data file after PCA.")
+    parser.add_argument("log_file", help="File where the components are appended.")
+    parser.add_argument("-s", "--solver", choices=["full", "randomized", "incremental"], default="full",
+                        help="SVD of the fit: full (default), randomized for wide data, incremental for long data.")
+    parser.add_argument("-c", "--chunksize", type=int, default=0,
+                        help="Rows per chunk; transforms the prediction data in chunks without loading it.")
+    args = parser.parse_args()
 
-    # Read in data files.
-    train_data = pd.read_csv(train_in, header=0)
-    predi_data = pd.read_csv(predi_in, header=0)
+    if args.chunksize or args.solver == "incremental":
+        # Stream the files through the model.
+        params, components = stream_pca(args.train_in, args.predi_in, args.train_out, args.predi_out,
+                                        args.solver, args.chunksize or 100000)
+    else:
+        # Read in data files.
+        train_data = pd.read_csv(args.train_in, header=0)
+        predi_data = pd.read_csv(args.predi_in, header=0)
 
-    # Find param names.
-    params = get_params(train_data)
+        # Find param names.
+        params = get_params(train_data)
 
-    # Do that pca stuff.
-    train_pca, predi_pca, components = joint_pca(train_data, predi_data, params)
+        # Do that pca stuff.
+        train_pca, predi_pca, components = joint_pca(train_data, predi_data, params, args.solver)
 
-    # Write the results to specified files.
-    train_pca.to_csv(path_or_buf=train_out, index=False)
-    predi_pca.to_csv(path_or_buf=predi_out, index=False)
+        # Write the results to specified files.
+        train_pca.to_csv(path_or_buf=args.train_out, index=False)
+        predi_pca.to_csv(path_or_buf=args.predi_out, index=False)
 
     # Log the pca components.
-    with open(log_file, "a") as log:
+    with open(args.log_file, "a") as log:
         log.write("Component Eigenvalues:\n")
         for i in range(len(params)):
             log.write(f"{params[i]}:\n{[c[i] for c in components]}\n")
-
-
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+# In-process replacement of create_shape.R + crop_to_shape.R for raster sources.
+# The region polygons are loaded once and indexed in an STRtree. The source raster is read once, in
+# strips of blocks, and every region intersecting a strip is rasterized on the grid of the strip
+# (pixel centers inside the polygon, as raster::mask) and its pixels are appended to its csv file.
+# Cropping n regions costs one read of the source instead of n R interpreters reading it.
+#
+# Regions whose polygon cannot be built here (STATE without a local GADM file) and sources that are not
+# rasters (.rds, .csv) are left to the R scripts, see curate.py.
+#
+# Command-line example:
+# $ ./region_crop.py ../data/topo15_CONUS_1km.tif -r STATE,Arizona CEC,8.5 BOX,-100_-90_30_40 -o ../data/eval -s ../data/shapes
+
+import argparse
+import os
+import pathlib
+import numpy as np
+import pandas as pd
+from osgeo import gdal, ogr, osr
+import shapely
+# STRtree.query returns indices from shapely 2 on (geometries in 1.x): with 1.x, curate.py gets the
+# ImportError and crops with the R scripts
+if int(shapely.__version__.split(".")[0]) < 2:
+    raise ImportError(f"region_crop needs shapely>=2, found {shapely.__version__}")
+from shapely import wkb
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+# Paths as in create_shape.R, relative to the code folder
+CEC_FILES = ["../data/NA_Terrestrial_Ecoregions_Level_I_Shapefile/data/NA_Terrestrial_Ecoregions_v2_level1.shp",
+             "../data/NA_Terrestrial_Ecoregions_Level_II_Shapefile/data/NA_Terrestrial_Ecoregions_v2_level2.shp",
+             "../data/NA_Terrestrial_Ecoregions_v2_Level_III_Shapefile/data/NA_Terrestrial_Ecoregions_v2_level3.shp"]
+NEON_FILE = "../data/NEONDomains_0/NEON_Domains.shp"
+# GADM level 1 (states) of the USA, downloaded by raster::getData in create_shape.R
+GADM_FILE = "../data/gadm36_USA_1.shp"
+
+WGS84 = "+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs"
+# Planar projection used for the buffers in crop_to_shape.R, selected for CONUS
+BUFFER_PROJ = "+proj=aeqd +lat_0=52 +lon_0=-97.5 +x_0=8264722.17686 +y_0=4867518.35323 +datum=WGS84 +units=m +no_defs"
+
+# Names given by crop_to_shape.R to the 15 topographic parameters of a .tif
+NAMES_TOPO = ["DEM", "HILL", "SLP", "ASP", "CSC", "LC", "CI", "CD",
+              "FA", "TWI", "LSF", "CNB", "VDC", "VD", "RSP"]
+
+RASTER_EXTS = [".tif", ".tiff", ".sdat", ".nc", ".vrt"]
+STRIP_ROWS = 512
+
+
+def get_srs(projection):
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(projection)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def is_raster(path):
+    return pathlib.Path(path).suffix.lower() in RASTER_EXTS
+
+
+def union_features(shp_file, field_values):
+    # Union of the features of shp_file whose field is one of the values, in WGS84
+    ds = ogr.Open(str(shp_file))
+    if ds is None:
+        return None
+    layer = ds.GetLayer()
+    geometry = None
+    for feature in layer:
+        if any(str(feature.GetField(field)) == value for field, value in field_values):
+            g = feature.GetGeometryRef().Clone()
+            geometry = g if geometry is None else geometry.Union(g)
+    src_srs = layer.GetSpatialRef()
+    ds = None
+    if geometry is not None and src_srs is not None:
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        geometry.Transform(osr.CoordinateTransformation(src_srs, get_srs(WGS84)))
+    return geometry
+
+
+def region_geometry(reg_type, reg):
+    # Same regions as create_shape.R, as an ogr geometry in WGS84, None if it can not be built here
+    if reg_type == "BOX":
+        x1, x2, y1, y2 = [float(v) for v in reg.split("_")]
+        return ogr.CreateGeometryFromWkt(box(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)).wkt)
+    if reg_type == "CEC":
+        level = reg.count(".")
+        if level > 2:
+            return None
+        return union_features(CEC_FILES[level], [(f"LEVEL{level + 1}", reg)])
+    if reg_type == "NEON":
+        return union_features(NEON_FILE, [("DomainID", reg), ("DomainName", reg)])
+    if reg_type == "STATE" and os.path.exists(GADM_FILE):
+        if reg == "CONUS":
+            ds = ogr.Open(GADM_FILE)
+            states = [f.GetField("NAME_1") for f in ds.GetLayer()]
+            ds = None
+            return union_features(GADM_FILE, [("NAME_1", s) for s in states if s not in ["Alaska", "Hawaii"]])
+        return union_features(GADM_FILE, [("NAME_1", reg)])
+    return None
+
+
+def load_region(reg_type, reg, shape_dir):
+    # Polygons are cached as GeoJSON next to the .rds files of create_shape.R
+    shape_dir = pathlib.Path(shape_dir)
+    shape_file = shape_dir.joinpath(f"{reg}.geojson")
+    if shape_file.is_file():
+        with open(shape_file, "r") as f:
+            return ogr.CreateGeometryFromJson(f.read())
+    geometry = region_geometry(reg_type, reg)
+    if geometry is not None:
+        shape_dir.mkdir(parents=True, exist_ok=True)
+        # Written to a file of the process and renamed, as create_shape in curate.py: the curations of
+        # other years share the folder and never read a partial file
+        temp = f"{shape_file}.{os.getpid()}"
+        with open(temp, "w") as f:
+            f.write(geometry.ExportToJson())
+        os.replace(temp, shape_file)
+    return geometry
+
+
+def buffered(geometry, buffer):
+    # Buffer in meters, in the planar projection of crop_to_shape.R
+    if not buffer:
+        return geometry
+    geometry = geometry.Clone()
+    geometry.Transform(osr.CoordinateTransformation(get_srs(WGS84), get_srs(BUFFER_PROJ)))
+    geometry = geometry.Buffer(buffer)
+    geometry.Transform(osr.CoordinateTransformation(get_srs(BUFFER_PROJ), get_srs(WGS84)))
+    return geometry
+
+
+def layer_names(ds, in_file, names=None):
+    # Column names as in crop_to_shape.R
+    if names:
+        return list(names)
+    if pathlib.Path(in_file).suffix.lower() in [".tif", ".tiff"] and ds.RasterCount == len(NAMES_TOPO):
+        return NAMES_TOPO
+    descriptions = [ds.GetRasterBand(k + 1).GetDescription() for k in range(ds.RasterCount)]
+    if all(descriptions):
+        return descriptions
+    stem = pathlib.Path(in_file).stem
+    return [stem] if ds.RasterCount == 1 else [f"{stem}.{k + 1}" for k in range(ds.RasterCount)]
+
+
+class RegionCropper:
+    # regions: list of (reg_type, reg) loaded once; crop() extracts any subset of them from a raster
+
+    def __init__(self, regions, shape_dir):
+        self.geometries = {}
+        self.missing = []
+        for reg_type, reg in dict.fromkeys(regions):
+            geometry = load_region(reg_type, reg, shape_dir)
+            if geometry is None:
+                self.missing.append((reg_type, reg))
+            else:
+                self.geometries[(reg_type, reg)] = geometry
+
+    def supports(self, region):
+        return region in self.geometries
+
+    def crop(self, in_file, outputs, names=None, buffer=0):
+        # outputs: list of ((reg_type, reg), out_file). Returns the number of points written per out_file.
+        outputs = [(region, pathlib.Path(out_file)) for region, out_file in outputs if region in self.geometries]
+        ds = gdal.Open(str(in_file), 0)
+        src_wkt = ds.GetProjection() or get_srs(WGS84).ExportToWkt()
+        to_src = osr.CoordinateTransformation(get_srs(WGS84), get_srs(src_wkt))
+        xmin, xres, _, ymax, _, yres = ds.GetGeoTransform()
+        columns = ["x", "y"] + layer_names(ds, in_file, names)
+        nodata = [ds.GetRasterBand(k + 1).GetNoDataValue() for k in range(ds.RasterCount)]
+
+        # Geometries in the projection of the source, their pixel windows and the STRtree over them
+        geometries = []
+        for region, out_file in outputs:
+            g = buffered(self.geometries[region], buffer).Clone()
+            g.Transform(to_src)
+            geometries.append(wkb.loads(bytes(g.ExportToWkb())))
+        tree = STRtree(geometries)
+
+        # Rows of the source covered by any region, read once in strips aligned with the blocks
+        row_min, row_max = ds.RasterYSize, 0
+        for g in geometries:
+            gxmin, gymin, gxmax, gymax = g.bounds
+            row_min = min(row_min, max(0, int(np.floor((ymax - gymax) / -yres))))
+            row_max = max(row_max, min(ds.RasterYSize, int(np.ceil((ymax - gymin) / -yres))))
+        block_rows = ds.GetRasterBand(1).GetBlockSize()[1]
+        strip_rows = max(block_rows, STRIP_ROWS // block_rows * block_rows)
+        row_min = row_min // block_rows * block_rows
+
+        counts = {out_file: 0 for _, out_file in outputs}
+        for _, out_file in outputs:
+            out_file.parent.mkdir(parents=True, exist_ok=True)
+            pd.DataFrame(columns=columns).to_csv(out_file, index=False)
+
+        mem = gdal.GetDriverByName("MEM")
+        for row in range(row_min, row_max, strip_rows):
+            nrows = min(strip_rows, row_max - row)
+            strip_ymax = ymax + row * yres
+            strip_box = box(xmin, strip_ymax + nrows * yres, xmin + ds.RasterXSize * xres, strip_ymax)
+            hits = tree.query(strip_box)
+            if len(hits) == 0:
+                continue
+            data = ds.ReadAsArray(0, row, ds.RasterXSize, nrows).astype(np.float64).reshape(ds.RasterCount, nrows, ds.RasterXSize)
+            for k, value in enumerate(nodata):
+                if value is not None:
+                    data[k][data[k] == value] = np.nan
+
+            for i in sorted(hits):
+                (region, out_file), g = outputs[i], geometries[i]
+                # Columns of the strip covered by the region, the mask is rasterized only there
+                gxmin, _, gxmax, _ = g.bounds
+                col0 = max(0, int(np.floor((gxmin - xmin) / xres)))
+                col1 = min(ds.RasterXSize, int(np.ceil((gxmax - xmin) / xres)))
+                if col1 <= col0:
+                    continue
+                mask_ds = mem.Create("", col1 - col0, nrows, 1, gdal.GDT_Byte)
+                mask_ds.SetGeoTransform([xmin + col0 * xres, xres, 0, strip_ymax, 0, yres])
+                mask_ds.SetProjection(src_wkt)
+                layer_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+                layer = layer_ds.CreateLayer("region", get_srs(src_wkt))
+                feature = ogr.Feature(layer.GetLayerDefn())
+                feature.SetGeometry(ogr.CreateGeometryFromWkb(g.wkb))
+                layer.CreateFeature(feature)
+                gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1])
+                mask = mask_ds.ReadAsArray().astype(bool)
+                mask_ds = None
+                layer_ds = None
+
+                rows, cols = np.nonzero(mask)
+                if rows.size == 0:
+                    continue
+                x = xmin + (col0 + cols + 0.5) * xres
+                y = strip_ymax + (rows + 0.5) * yres
+                values = data[:, rows, col0 + cols].T
+                df = pd.DataFrame(np.column_stack((x, y, values)), columns=columns)
+                df.to_csv(out_file, mode="a", header=False, index=False, na_rep="NA")
+                counts[out_file] += len(df)
+        ds = None
+
+        for out_file, count in counts.items():
+            if count == 0:
+                print(f"WARNING! {in_file} has empty intersection with the region of {out_file}.")
+        return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("in_file", help="Raster to crop.")
+    parser.add_argument("-r", "--regions", nargs="+", help="Regions as TYPE,NAME (types of create_shape.R).")
+    parser.add_argument("-o", "--out_dir", help="Folder for the TYPE_NAME.csv files.")
+    parser.add_argument("-s", "--shape_dir", default="../data/shapes", help="Folder with the cached region polygons.")
+    parser.add_argument("-b", "--buffer", type=int, default=0, help="Buffer in meters around each region.")
+    parser.add_argument("-n", "--names", nargs="*", help="Names of the layers.")
+    args = parser.parse_args()
+
+    regions = [tuple(r.split(",", 1)) for r in args.regions]
+    cropper = RegionCropper(regions, args.shape_dir)
+    if cropper.missing:
+        print(f"No polygon for {cropper.missing}, use create_shape.R and crop_to_shape.R for them.")
+    outputs = [(region, pathlib.Path(args.out_dir).joinpath(f"{region[0]}_{region[1]}.csv")) for region in regions]
+    counts = cropper.crop(args.in_file, outputs, args.names, args.buffer)
+    for out_file, count in counts.items():
+        print(f"{count} points in {out_file}")
@@ -6,6 +6,8 @@ from matplotlib import pyplot as plt
 import pandas as pd
 import numpy as np
 import geopandas
+import creation_profile as cp
+import gdal_runtime as grt
 
 
 def csv2tif(input_file, output_file):
@@ -14,7 +16,8 @@ def csv2tif(input_file, output_file):
     df.sort_values(by=["y", "x"], ascending=[False, True], inplace=True)
     df.to_csv(xyz_path, index=False, header=None, sep=" ")
     
-    translate_options = gdal.TranslateOptions(format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+    # Prediction tiles are mosaicked afterwards, so no overviews
+    translate_options = gdal.TranslateOptions(format='GTiff', creationOptions=cp.creation_options(gdal.GDT_Float64, profile='tiled'), callback=gdal.TermProgress_nocb)
     tif = gdal.Translate(output_file, xyz_path, options=translate_options)
     tif = None
     os.remove(xyz_path)
@@ -36,7 +39,7 @@ def rasterize(input_file, output_file, xres, yres):
 </OGRVRTDataSource>'.format(os.path.basename(output_file[:-4]), input_file)) # https://gdal.org/programs/gdal_grid.html#gdal-grid
     f.close()
     
-    rasterize_options = gdal.RasterizeOptions(xRes=xres, yRes=yres, attribute='sm', noData=np.nan, outputType=gdal.GDT_Float32, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+    rasterize_options = gdal.RasterizeOptions(xRes=xres, yRes=yres, attribute='sm', noData=np.nan, outputType=gdal.GDT_Float32, creationOptions=cp.creation_options(gdal.GDT_Float32, profile='tiled'), callback=gdal.TermProgress_nocb)
     r = gdal.Rasterize(output_file, vrt_file, options=rasterize_options)
     r = None
     
@@ -60,9 +63,10 @@ def resample_mosaic(input_file, output_file, width=7680):
     
     height = int(h * width / float(w))
     
-    warp_options = gdal.WarpOptions(format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], resampleAlg='average', width=width, height= height, callback=gdal.TermProgress_nocb)
+    warp_options = gdal.WarpOptions(format='GTiff', creationOptions=cp.creation_options(band.DataType), resampleAlg='average', width=width, height= height, callback=gdal.TermProgress_nocb)
     warp = gdal.Warp(output_file, input_file, options=warp_options)
     warp = None  # Closes the files
+    cp.finalize(output_file)
     
     
 def plot_tif(tif_path, png_path, sm_min, sm_max, shp_file=None):
@@ -90,6 +94,7 @@ if __name__ == '__main__':
     csv_folder = '/home/exouser/predictions'
     tiles_folder = './tiles'
     output_file = './oklahoma_10m.png'
+    grt.configure('translate')
 
     Path(tiles_folder).mkdir(parents=True, exist_ok=True)
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Batch sampling of a raster at many points, replacing the per-point reads of tools.extract_raster
+# and the add_topos.R subprocess of curate.py.
+# Coordinates are converted to pixel indices with NumPy and sorted by block: each block holding points
+# is read once for all the bands and the values are gathered with fancy indexing.
+#
+# Command-line example (same arguments as add_topos.R):
+# $ ./point_sampler.py ../data/train/STATE_Arizona.csv ../data/topo15_CONUS_1km.tif ../data/train/STATE_Arizona.csv DEM HILL SLP
+
+import argparse
+import pathlib
+import numpy as np
+import pandas as pd
+from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+
+
+def band_names(ds, raster_file):
+    # Band descriptions, or the layer names raster::stack gives to the bands of a file
+    names = [ds.GetRasterBand(k + 1).GetDescription() for k in range(ds.RasterCount)]
+    if all(names):
+        return names
+    stem = pathlib.Path(raster_file).stem
+    return [stem] if ds.RasterCount == 1 else [f"{stem}.{k + 1}" for k in range(ds.RasterCount)]
+
+
+def read_window(ds, xoff, yoff, xsize, ysize, nodata):
+    # All the bands of a window as float64 (bands, rows, cols), nodata as nan
+    data = ds.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float64).reshape(ds.RasterCount, ysize, xsize)
+    for k, value in enumerate(nodata):
+        if value is not None:
+            data[k][data[k] == value] = np.nan
+    return data
+
+
+def blocks_of(cols, rows, block_size, n_block_cols):
+    # Points grouped by block: (order, starts, ends), order sorts the points by block
+    keys = (rows // block_size[1]) * n_block_cols + (cols // block_size[0])
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    # No group at all without points
+    starts = np.flatnonzero(np.r_[keys.size > 0, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], keys.size][:starts.size]
+    return order, starts, ends
+
+
+def sample(raster_file, x, y, bilinear=False):
+    # Values of every band at the points (x, y) in the coordinates of the raster, array (points, bands).
+    # Points outside the raster or on nodata are nan. With bilinear, the 4 nearest pixel centers are
+    # weighted by distance, ignoring the nodata ones.
+    ds = gdal.Open(str(raster_file), 0)
+    gt = ds.GetGeoTransform()
+    ncols, nrows, nbands = ds.RasterXSize, ds.RasterYSize, ds.RasterCount
+    nodata = [ds.GetRasterBand(k + 1).GetNoDataValue() for k in range(nbands)]
+    block_size = ds.GetRasterBand(1).GetBlockSize()
+    n_block_cols = -(-ncols // block_size[0])
+
+    fx = (np.asarray(x, dtype=np.float64) - gt[0]) / gt[1]
+    fy = (np.asarray(y, dtype=np.float64) - gt[3]) / gt[5]
+    values = np.full((fx.size, nbands), np.nan)
+
+    if bilinear:
+        # Upper left pixel center of the 4 neighbours, and the weights of the right/lower ones
+        fx, fy = fx - 0.5, fy - 0.5
+        cols, rows = np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64)
+        # Within half a pixel of the left/top edge only the edge pixel is used
+        wx, wy = np.where(cols < 0, 0.0, fx - cols), np.where(rows < 0, 0.0, fy - rows)
+        inside = (fx >= -0.5) & (fx < ncols - 0.5) & (fy >= -0.5) & (fy < nrows - 0.5)
+        cols, rows = np.clip(cols, 0, ncols - 1), np.clip(rows, 0, nrows - 1)
+    else:
+        cols, rows = np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64)
+        inside = (cols >= 0) & (cols < ncols) & (rows >= 0) & (rows < nrows)
+
+    index = np.flatnonzero(inside)
+    if index.size == 0:
+        # No point in the raster (or no point at all, e.g. the csv of an empty crop): all nan
+        ds = None
+        return values
+    order, starts, ends = blocks_of(cols[index], rows[index], block_size, n_block_cols)
+    index = index[order]
+
+    for start, end in zip(starts, ends):
+        points = index[start:end]
+        xoff = cols[points[0]] // block_size[0] * block_size[0]
+        yoff = rows[points[0]] // block_size[1] * block_size[1]
+        # With bilinear, one more row and column for the neighbours across the block edge
+        extra = 1 if bilinear else 0
+        xsize = min(block_size[0] + extra, ncols - xoff)
+        ysize = min(block_size[1] + extra, nrows - yoff)
+        data = read_window(ds, xoff, yoff, xsize, ysize, nodata)
+
+        c, r = cols[points] - xoff, rows[points] - yoff
+        if not bilinear:
+            values[points] = data[:, r, c].T
+            continue
+
+        c1, r1 = np.minimum(c + 1, xsize - 1), np.minimum(r + 1, ysize - 1)
+        ax, ay = wx[points], wy[points]
+        neighbours = np.stack([data[:, r, c], data[:, r, c1], data[:, r1, c], data[:, r1, c1]])  # (4, bands, points)
+        weights = np.stack([(1 - ax) * (1 - ay), ax * (1 - ay), (1 - ax) * ay, ax * ay])[:, None, :]
+        weights = np.where(np.isnan(neighbours), 0.0, weights)
+        total = weights.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values[points] = (np.nansum(neighbours * weights, axis=0) / total).T
+    ds = None
+    return values
+
+
+def add_columns(in_file, raster_file, out_file, names=None, bilinear=False):
+    # Same as add_topos.R: the csv with x and y columns gets one column per band of the raster
+    df = pd.read_csv(in_file)
+    ds = gdal.Open(str(raster_file), 0)
+    names = list(names) if names else band_names(ds, raster_file)
+    ds = None
+    values = sample(raster_file, df["x"].values, df["y"].values, bilinear)
+    df = pd.concat([df, pd.DataFrame(values, columns=names, index=df.index)], axis=1)
+    df.to_csv(out_file, index=False, na_rep="NA")
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("in_file", help="csv file with x and y columns.")
+    parser.add_argument("cov_file", help="Raster with the covariates.")
+    parser.add_argument("out_file", help="csv file with the covariates added.")
+    parser.add_argument("names", nargs="*", help="Names of the columns of the raster bands.")
+    parser.add_argument("-b", "--bilinear", action="store_true", help="Bilinear sampling instead of the pixel containing the point.")
+    args = parser.parse_args()
+
+    df = add_columns(args.in_file, args.cov_file, args.out_file, args.names, args.bilinear)
+    print(f"{df.shape[0]} points sampled, columns: {list(df.columns)}")
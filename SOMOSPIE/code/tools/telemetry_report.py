@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Aggregates the stage telemetry (telemetry.py) of one or more runs: JSON lines files, or job logs
+# (Pegasus .out files, local executor logs) with lines prefixed by "[telemetry]".
+# For each run it prints the makespan, the critical path, the slowest stages and their throughput.
+#
+# Command-line example:
+# ./telemetry_report.py -i local-run/telemetry.jsonl
+# ./telemetry_report.py -i submit/*/*.out -n 5 -o report.json
+
+import argparse
+import json
+from collections import defaultdict
+
+PREFIX = '[telemetry]'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Arguments and files to aggregate the telemetry of SOMOSPIE runs.')
+    parser.add_argument('-i', "--infiles", help='Telemetry JSON lines files or job logs.', nargs='+')
+    parser.add_argument('-n', "--top", help='Number of slowest stages to show.', type=int, default=10)
+    parser.add_argument('-o', "--outfile", help='Json file with the aggregated report.', default=None)
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    return args.infiles, args.top, args.outfile
+
+
+def read_records(input_files):
+    records = []
+    seen = set()
+    for input_file in input_files:
+        with open(input_file, 'r', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith(PREFIX):
+                    line = line[len(PREFIX):].strip()
+                if not line.startswith('{'):
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'stage' not in record or 'start' not in record:
+                    continue
+                # The same stage is in the jsonl file and in the job log
+                key = (record.get('run'), record['stage'], record.get('host'), record.get('pid'), record['start'])
+                if key not in seen:
+                    seen.add(key)
+                    records.append(record)
+    return records
+
+
+def critical_path(records, tolerance=1.0):
+    # Walk back from the stage that ends last: the predecessor of a stage is the one that ends last before
+    # it starts. Stages of a workflow only start once their inputs exist, so this is the chain that set the makespan.
+    remaining = sorted(records, key=lambda r: r['end'])
+    path = []
+    current = remaining[-1] if remaining else None
+    while current is not None:
+        path.append(current)
+        candidates = [r for r in remaining if r['end'] <= current['start'] + tolerance and r is not current and r['start'] < current['start']]
+        current = max(candidates, key=lambda r: r['end']) if candidates else None
+    return path[::-1]
+
+
+def stage_summary(records):
+    stages = defaultdict(lambda: {'count': 0, 'wall': 0.0, 'max_wall': 0.0, 'cpu': 0.0, 'pixels': 0, 'rows': 0,
+                                  'bytes_read': 0, 'bytes_written': 0, 'peak_rss_mb': 0.0, 'failed': 0})
+    for r in records:
+        s = stages[r['stage']]
+        s['count'] += 1
+        s['wall'] += r.get('wall', 0.0)
+        s['max_wall'] = max(s['max_wall'], r.get('wall', 0.0))
+        s['cpu'] += r.get('cpu', 0.0)
+        s['pixels'] += r.get('pixels', 0)
+        s['rows'] += r.get('rows', 0)
+        s['bytes_read'] += r.get('bytes_read', 0)
+        s['bytes_written'] += r.get('bytes_written', 0)
+        s['peak_rss_mb'] = max(s['peak_rss_mb'], r.get('peak_rss_mb', 0.0))
+        s['failed'] += r.get('status', 'ok') != 'ok'
+    for s in stages.values():
+        s['mean_wall'] = s['wall'] / s['count']
+        s['pixels_per_s'] = s['pixels'] / s['wall'] if s['wall'] > 0 else 0.0
+        s['rows_per_s'] = s['rows'] / s['wall'] if s['wall'] > 0 else 0.0
+        s['cpu_utilization'] = s['cpu'] / s['wall'] if s['wall'] > 0 else 0.0
+    return dict(stages)
+
+
+def run_report(records, top=10):
+    start = min(r['start'] for r in records)
+    end = max(r['end'] for r in records)
+    stages = stage_summary(records)
+    path = critical_path(records)
+    return {
+        'stages_run': len(records),
+        'makespan': end - start,
+        'wall': sum(r.get('wall', 0.0) for r in records),
+        'cpu': sum(r.get('cpu', 0.0) for r in records),
+        'pixels': sum(r.get('pixels', 0) for r in records),
+        'critical_path': [{'stage': r['stage'], 'start': r['start'] - start, 'wall': r.get('wall', 0.0)} for r in path],
+        'critical_path_wall': sum(r.get('wall', 0.0) for r in path),
+        'slowest': sorted(stages.items(), key=lambda item: item[1]['wall'], reverse=True)[:top],
+    }
+
+
+def print_report(run, report):
+    print("Run:", run or "(no run id)")
+    print("  {} stages, makespan {:.1f} s, {:.1f} s of stage wall time, {:.1f} s of cpu".format(
+        report['stages_run'], report['makespan'], report['wall'], report['cpu']))
+    print("  Critical path ({:.1f} s):".format(report['critical_path_wall']))
+    for step in report['critical_path']:
+        print("    +{:8.1f} s  {:<20} {:8.1f} s".format(step['start'], step['stage'], step['wall']))
+    print("  Slowest stages:")
+    print("    {:<20} {:>6} {:>10} {:>10} {:>10} {:>14} {:>10}".format('stage', 'count', 'wall', 'mean', 'max', 'pixels/s', 'rss (MB)'))
+    for name, s in report['slowest']:
+        print("    {:<20} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>14.0f} {:>10.0f}".format(
+            name, s['count'], s['wall'], s['mean_wall'], s['max_wall'], s['pixels_per_s'], s['peak_rss_mb']))
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    input_files, top, output_file = from_args_to_vars(args)
+
+    runs = defaultdict(list)
+    for record in read_records(input_files):
+        runs[record.get('run', '')].append(record)
+
+    reports = {}
+    for run, records in sorted(runs.items()):
+        reports[run] = run_report(records, top)
+        print_report(run, reports[run])
+
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(reports, f, indent=2)
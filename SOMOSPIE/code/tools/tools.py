@@ -10,6 +10,9 @@ import pandas as pd
 import math
 import multiprocessing
 import concurrent.futures
+import creation_profile as cp
+import gdal_runtime as grt
+import point_sampler as psm
 
 # In Ubuntu: sudo apt-get install grass grass-doc
 # pip install grass-session
@@ -17,8 +20,9 @@ from grass_session import Session
 import grass.script as gscript
 import tempfile
 
-# Increased the size of GDAL’s input-output buffer cache to reduce the number of look-up operations
-gdal.SetConfigOption("GDAL_CACHEMAX", "512")
+# GDAL’s input-output buffer cache and threads sized for the cores and memory of the node,
+# functions running several processes reconfigure them with their number of workers
+grt.configure()
 
 def bash(argv):
     arg_seq = [str(arg) for arg in argv]
@@ -44,8 +48,15 @@ def download_dem(file, folder):
 
 def merge_tiles(input_files, output_file):
     # input_files: list of .tif files to merge
+    # If output_file is a .vrt the mosaic stays lazy: GDAL reads the tiles when the mosaic is reprojected
+    if output_file.endswith('.vrt'):
+        vrt = gdal.BuildVRT(output_file, input_files)
+        vrt = None  # closes file
+        mosaic_io(input_files)
+        return
+
     vrt = gdal.BuildVRT("merged.vrt", input_files)
-    translate_options = gdal.TranslateOptions(creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS'],
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(cp.get_data_type(vrt)),
                                               callback=gdal.TermProgress_nocb)
     gdal.Translate(output_file, vrt, options=translate_options)
     vrt = None  # closes file
@@ -56,19 +67,31 @@ def merge_tiles(input_files, output_file):
     # bash(cmd)
 
 
+def mosaic_io(input_files):
+    # Bytes not written (and not read back by the reprojection) because the mosaic is a VRT.
+    # The compressed mosaic would have about the size of the compressed tiles.
+    tiles_bytes = sum(os.path.getsize(f) for f in input_files)
+    io = {'tiles': len(input_files), 'tiles_bytes': tiles_bytes, 'mosaic_bytes_not_written': tiles_bytes,
+          'io_bytes_saved': 2 * tiles_bytes}
+    print("Lazy mosaic:", io)
+    return io
+
+
 def reproject(input_file, output_file, projection):
+    # input_file can be a raster, a VRT or a list of tiles
     # Projection can be EPSG:4326, .... or the path to a wkt file
-    warp_options = gdal.WarpOptions(dstSRS=projection, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS'],
-                                    callback=gdal.TermProgress_nocb, multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'])
+    warp_options = gdal.WarpOptions(dstSRS=projection, creationOptions=cp.creation_options(cp.get_data_type(input_file)),
+                                    callback=gdal.TermProgress_nocb, multithread=True, warpOptions=['NUM_THREADS={}'.format(grt.num_threads())], warpMemoryLimit=grt.warp_memory())
     warp = gdal.Warp(output_file, input_file, options=warp_options)
     warp = None  # Closes the files
+    cp.finalize(output_file)
 
 
 def change_raster_format(input_file, output_file, raster_format):
     # Supported formats: https://gdal.org/drivers/raster/index.html
     # SAGA, GTiff
     if raster_format == 'GTiff':
-        translate_options = gdal.TranslateOptions(format=raster_format, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'],
+        translate_options = gdal.TranslateOptions(format=raster_format, creationOptions=cp.creation_options(cp.get_data_type(input_file)),
                                                 callback=gdal.TermProgress_nocb)
     elif raster_format == 'NC4C':
         translate_options = gdal.TranslateOptions(format=raster_format, creationOptions=['COMPRESS=DEFLATE'],
@@ -78,6 +101,8 @@ def change_raster_format(input_file, output_file, raster_format):
                                                 callback=gdal.TermProgress_nocb)
     
     gdal.Translate(output_file, input_file, options=translate_options)
+    if raster_format == 'GTiff':
+        cp.finalize(output_file)
 
 
 
@@ -93,17 +118,18 @@ def build_stack(input_files, output_file):
     # input_files: list of .tif files to stack
     vrt_options = gdal.BuildVRTOptions(separate=True)
     vrt = gdal.BuildVRT("stack.vrt", input_files, options=vrt_options)
-    translate_options = gdal.TranslateOptions(creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'],
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(cp.get_data_type(vrt)),
                                               callback=gdal.TermProgress_nocb)
     gdal.Translate(output_file, vrt, options=translate_options)
     vrt = None  # closes file
 
 
 def crop_region(input_file, shp_file, output_file):
-    warp_options = gdal.WarpOptions(cutlineDSName=shp_file, cropToCutline=True, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'],
+    warp_options = gdal.WarpOptions(cutlineDSName=shp_file, cropToCutline=True, creationOptions=cp.creation_options(cp.get_data_type(input_file)),
                                     callback=gdal.TermProgress_nocb)
     warp = gdal.Warp(output_file, input_file, options=warp_options)
     warp = None
+    cp.finalize(output_file)
 
 
 def get_projection(input_file, output_file):
@@ -115,15 +141,15 @@ def crop_coord(input_file, output_file, upper_left, lower_right):
     # upper_left = (x, y), lower_right = (x, y)
     # Coordinates must be in the same projection as the raster
     window = upper_left + lower_right
-    translate_options = gdal.TranslateOptions(projWin=window, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'],
+    translate_options = gdal.TranslateOptions(projWin=window, **cp.translate_kwargs(cp.get_data_type(input_file)),
                                               callback=gdal.TermProgress_nocb)
     gdal.Translate(output_file, input_file, options=translate_options)
 
 
-def crop_pixels(input_file, output_file, window):
+def crop_pixels(input_file, output_file, window, profile=None):
     # Window to crop by [left_x, top_y, width, height]
     translate_options = gdal.TranslateOptions(srcWin=window,
-                                              creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'],
+                                              **cp.translate_kwargs(cp.get_data_type(input_file), profile),
                                               callback=gdal.TermProgress_nocb)
     gdal.Translate(output_file, input_file, options=translate_options)
 
@@ -141,32 +167,38 @@ def get_extent(shp_file):
 def compute_geotiled(input_file):
     out_folder = os.path.dirname(os.path.dirname(input_file))
     out_file = os.path.join(out_folder,'slope_tiles', os.path.basename(input_file))
+    # Parameter tiles are merged later on, so no overviews
+    creation_options = cp.creation_options(gdal.GDT_Float32, profile='tiled')
     # Slope
-    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'])
+    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=creation_options)
     gdal.DEMProcessing(out_file, input_file, processing='slope', options=dem_options)
     # Aspect
     out_file = os.path.join(out_folder,'aspect_tiles', os.path.basename(input_file))
-    dem_options = gdal.DEMProcessingOptions(zeroForFlat=True, format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'])
+    dem_options = gdal.DEMProcessingOptions(zeroForFlat=True, format='GTiff', creationOptions=creation_options)
     gdal.DEMProcessing(out_file, input_file, processing='aspect', options=dem_options)
     # Hillshading
     out_file = os.path.join(out_folder,'hillshading_tiles', os.path.basename(input_file))
-    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'])
+    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=cp.creation_options(gdal.GDT_Byte, profile='tiled'))
     gdal.DEMProcessing(out_file, input_file, processing='hillshade', options=dem_options)
 
 
 def compute_params(input_prefix, parameters):
+    creation_options = cp.creation_options(gdal.GDT_Float32)
     # Slope
     if 'slope' in parameters:
-        dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+        dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=creation_options, callback=gdal.TermProgress_nocb)
         gdal.DEMProcessing(input_prefix + 'slope.tif', input_prefix + 'elevation.tif', processing='slope', options=dem_options)
+        cp.finalize(input_prefix + 'slope.tif')
     # Aspect
     if 'aspect' in parameters:
-        dem_options = gdal.DEMProcessingOptions(zeroForFlat=True, format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+        dem_options = gdal.DEMProcessingOptions(zeroForFlat=True, format='GTiff', creationOptions=creation_options, callback=gdal.TermProgress_nocb)
         gdal.DEMProcessing(input_prefix + 'aspect.tif', input_prefix + 'elevation.tif', processing='aspect', options=dem_options)
+        cp.finalize(input_prefix + 'aspect.tif')
     # Hillshading
     if 'hillshading' in parameters:
-        dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+        dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=cp.creation_options(gdal.GDT_Byte), callback=gdal.TermProgress_nocb)
         gdal.DEMProcessing(input_prefix + 'hillshading.tif', input_prefix + 'elevation.tif', processing='hillshade', options=dem_options)
+        cp.finalize(input_prefix + 'hillshading.tif')
 
     # Other parameters with GRASS GIS
     if any(param in parameters for param in ['twi', 'plan_curvature', 'profile_curvature']):
@@ -175,7 +207,7 @@ def compute_params(input_prefix, parameters):
 
         s = Session()
         s.open(gisdb=tmpdir.name, location='PERMANENT', create_opts=input_prefix + 'elevation.tif')
-        creation_options = 'BIGTIFF=YES,COMPRESS=LZW,TILED=YES' # For GeoTIFF files
+        creation_options = ','.join(cp.creation_options(gdal.GDT_Float32)) # For GeoTIFF files
 
         # Load raster into GRASS without loading it into memory (else use r.import or r.in.gdal)
         gscript.run_command('r.external', input=input_prefix + 'elevation.tif', output='elevation', overwrite=True)
@@ -208,32 +240,20 @@ def compute_params(input_prefix, parameters):
         #vgscript.run_command('r.slope.aspect', elevation='elevation', aspect='aspect.tif', slope='slope.tif', overwrite=True)
 
 def compute_params_concurrently(input_prefix, parameters):
-    with concurrent.futures.ProcessPoolExecutor(max_workers=20) as executor:
+    # The 20 workers share the node, each one gets its part of the cache and threads
+    with concurrent.futures.ProcessPoolExecutor(max_workers=20, initializer=grt.configure, initargs=('dem', 20, None, False)) as executor:
         for param in parameters:
             executor.submit(compute_params, input_prefix, param)
 
 
 def extract_raster(csv_file, raster_file, band_names):
-    # Extract values from raster corresponding to
+    # Extract values from raster corresponding to the x, y columns of the csv file.
+    # The points are sampled in batch by point_sampler: one read per block instead of one per point and band.
     df = pd.read_csv(csv_file)
 
-    ds = gdal.Open(raster_file, 0)
-    gt = ds.GetGeoTransform()
-
-    n_bands = ds.RasterCount
-    bands = np.zeros((df.shape[0], n_bands))
-
-    for i in range(df.shape[0]):
-        px = int((df['x'][i] - gt[0]) / gt[1])
-        py = int((df['y'][i] - gt[3]) / gt[5])
-
-        for j in range(n_bands):
-            band = ds.GetRasterBand(j + 1)
-            val = band.ReadAsArray(px, py, 1, 1)
-            bands[i, j] = val[0]
-    ds = None
+    bands = psm.sample(raster_file, df['x'].values, df['y'].values)
 
-    for j in range(n_bands):
+    for j in range(bands.shape[1]):
         df[band_names[j]] = bands[:, j]
 
     df.to_csv(csv_file, index=None)
@@ -310,7 +330,7 @@ def crop_into_tiles(mosaic, out_folder, n_tiles):
             h = win[3] + 2*buffer
             win[3] = h if win[1] + h < cols else cols - win[1]
 
-            crop_pixels(mosaic, tile_file, win)
+            crop_pixels(mosaic, tile_file, win, profile='tiled')
             tile_count += 1
 
 
@@ -346,5 +366,5 @@ def average(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize,raster_ysize,
     with open('merged.vrt', 'w') as f:
         f.write(contents)
 
-    cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-co', 'TILED=YES', '-co', 'BIGTIFF=YES', '--config', 'GDAL_VRT_ENABLE_PYTHON', 'YES', 'merged.vrt', output_file]
+    cmd = ['gdal_translate'] + cp.translate_args(gdal.GDT_Float32) + ['--config', 'GDAL_VRT_ENABLE_PYTHON', 'YES', 'merged.vrt', output_file]
     bash(cmd)
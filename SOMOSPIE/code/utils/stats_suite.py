@@ -6,7 +6,8 @@ import argparse
 import numpy as np
 import pandas as pd
 import skgstat as skg
-from os import path, listdir
+from os import path, listdir, environ
+from concurrent.futures import ProcessPoolExecutor
 from time import time
 t0 = time()
 
@@ -32,57 +33,82 @@ def qnt75(df):
     return df.quantile(.75)
 
 def count(df):
-    return df.dropna().shape[0]
-
-def corr(df):
-    if df.columns[0]==df.columns[1]:
-        return 1
-    else:
-        return df[df.columns[0]].corr(df[df.columns[1]])
-
-def variogram_range(df):
-    if df.columns[0]==df.columns[1]:
-        return 0
+    # Non-missing values of every column
+    return df.notna().sum()
+
+# Statistics on every pair of columns, one (cols, cols) matrix per statistic
+def count_matrix(df):
+    # Rows where both columns have a value: products of the not-null indicators
+    valid = df.notna().to_numpy(dtype=np.int64)
+    return valid.T @ valid
+
+def corr_matrix(df):
+    # Pearson correlation of every pair of columns on the rows where both have a value, 1 on the diagonal
+    r = df.corr().to_numpy(copy=True)
+    np.fill_diagonal(r, 1)
+    return r
+
+# Variogram parameters, each from the description of the fitted variogram, with the bounds
+# of their confidence interval over the subsamples
+VARIOGRAM_PARAMS = {f"{stat}{bound}": f"{key}{bound}" for stat, key in
+                    [("variogram_range", "effective_range"), ("variogram_sill", "sill"), ("variogram_nugget", "nugget")]
+                    for bound in ["", "_lo", "_hi"]}
+
+def spatial_sample(xy, n, rng):
+    # Indices of n points spread over the extent: the points are binned in a grid of about n cells,
+    # and taken one per cell in turn, in random order within each cell and each turn
+    if len(xy) <= n:
+        return np.arange(len(xy))
+    g = int(np.ceil(np.sqrt(n)))
+    lo, hi = xy.min(axis=0), xy.max(axis=0)
+    cells = np.floor((xy - lo) / np.where(hi > lo, hi - lo, 1) * g).clip(0, g-1).astype(np.int64)
+    cell = cells[:,0]*g + cells[:,1]
+    perm = rng.permutation(len(xy))
+    order = perm[np.argsort(cell[perm], kind="stable")]
+    sorted_cells = cell[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_cells)) + 1]
+    # Position of every point in its cell
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    return order[np.argsort(rank + rng.random(len(order)), kind="stable")[:n]]
+
+def variogram(df, max_points=2000, repeats=5, seed=0):
+    # Fits the variogram of the last column on the coordinates of the first two, on repeats spatial
+    # subsamples of at most max_points points (one fit when they are all used), and returns all its
+    # parameters: the median over the subsamples and the bounds of their 95% interval (none when it
+    # can not be fitted). The pairwise distances are O(max_points^2) instead of O(n^2).
     df = df.dropna()
-    if (len(set(df.columns[0]))<2):
-        return np.nan
-    coordinates = df[df.columns[:-1]]
-    values = df[df.columns[-1]]
-    try:
-        V = skg.Variogram(coordinates=coordinates, values=values)
-    except:
-        return np.nan
-    return V.describe()["effective_range"]
-
-def variogram_sill(df):
-    if df.columns[0]==df.columns[1]:
-        return np.nan
-    df = df.dropna()
-    if (len(set(df.columns[0]))<2):
-        return np.nan
-    coordinates = df[df.columns[:-1]]
-    values = df[df.columns[-1]]
-    try:
-        V = skg.Variogram(coordinates=coordinates, values=values)
-    except:
-        return np.nan
-    return V.describe()["sill"]
-
-def variogram_nugget(df):
-    if df.columns[0]==df.columns[1]:
-        return np.nan
-    df = df.dropna()
-    if (len(set(df.columns[0]))<2):
-        return np.nan
-    coordinates = df[df.columns[:-1]]
-    values = df[df.columns[-1]]
-    try:
-        V = skg.Variogram(coordinates=coordinates, values=values)
-    except:
-        return np.nan
-    return V.describe()["nugget"]
-
-def compute_stats(in_file, out_file, stat_dicts):
+    if df[df.columns[-1]].nunique() < 2:
+        return {}
+    coordinates = df[df.columns[:-1]].to_numpy(dtype=np.float64)
+    values = df[df.columns[-1]].to_numpy(dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    fits = {}
+    for _ in range(repeats if len(df) > max_points else 1):
+        sample = spatial_sample(coordinates, max_points, rng)
+        try:
+            V = skg.Variogram(coordinates=coordinates[sample], values=values[sample])
+            for key, value in V.describe().items():
+                if np.isscalar(value):
+                    fits.setdefault(key, []).append(value)
+        except:
+            continue
+    params = {}
+    for key, samples in fits.items():
+        try:
+            samples = np.asarray(samples, dtype=np.float64)
+        except (TypeError, ValueError):
+            continue
+        params[key] = np.median(samples)
+        params[f"{key}_lo"], params[f"{key}_hi"] = np.percentile(samples, [2.5, 97.5])
+    return params
+
+def row(values, diagonal=None, i=None):
+    values = [str(value) for value in values]
+    if diagonal is not None:
+        values[i] = diagonal
+    return ",".join(values)
+
+def compute_stats(in_file, out_file, stat_dicts, max_points=2000, repeats=5):
     df = pd.read_csv(in_file)
     cols = df.shape[1]
     print(f"Input file {in_file} has {cols} data columns.")
@@ -96,16 +122,33 @@ def compute_stats(in_file, out_file, stat_dicts):
             
             for stat in stat_dicts[1]:
                 keys_out.write(f"{stat}()\n")
-                stat_out.write(",".join([str(stat_dicts[1][stat](df[df.columns[i]])) for i in range(cols)])+"\n")
+                stat_out.write(row(stat_dicts[1][stat](df))+"\n")
                 
             for stat in stat_dicts[2]:
+                matrix = stat_dicts[2][stat](df)
+                # The correlation of a column with itself is written 1, as an int
+                diagonal = "1" if stat == "corr" else None
                 for i in range(cols):
                     keys_out.write(f"{stat}({df.columns[i]})\n")
-                    stat_out.write(",".join([str(stat_dicts[2][stat](df[[df.columns[i],df.columns[j]]])) for j in range(cols)])+"\n")
+                    stat_out.write(row(matrix[i], diagonal, i)+"\n")
                     
-            for stat in stat_dicts[3]:
-                keys_out.write(f"{stat}(x,y)\n")
-                stat_out.write("nan,nan," + ",".join([str(stat_dicts[3][stat](df[[df.columns[0], df.columns[1], df.columns[i]]])) for i in range(2,cols)])+"\n")
+            if stat_dicts[3]:
+                # One fit per column for all the variogram parameters
+                fits = [variogram(df[[df.columns[0], df.columns[1], df.columns[i]]], max_points, repeats) for i in range(2,cols)]
+                for stat in stat_dicts[3]:
+                    keys_out.write(f"{stat}(x,y)\n")
+                    stat_out.write("nan,nan," + row(fit.get(stat_dicts[3][stat], np.nan) for fit in fits)+"\n")
+
+def compute_all(files, stat_dicts, extension="csv", workers=1, max_points=2000, repeats=5):
+    # Statistics of every file, in workers processes
+    out_paths = [file[:-len(extension)] for file in files]
+    n = len(files)
+    if workers > 1 and n > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(compute_stats, files, out_paths, [stat_dicts]*n, [max_points]*n, [repeats]*n))
+    else:
+        for file, out_path in zip(files, out_paths):
+            compute_stats(file, out_path, stat_dicts, max_points, repeats)
     
 
 if __name__ == "__main__":
@@ -117,6 +160,15 @@ if __name__ == "__main__":
     parser.add_argument("-e", "--extension",
                         help="Expected file extension",
                         default="csv")
+    parser.add_argument("-w", "--workers",
+                        help="Files processed in parallel, SOMOSPIE_CORES by default.",
+                        type=int, default=int(environ.get("SOMOSPIE_CORES", 1)))
+    parser.add_argument("-m", "--max-points",
+                        help="Points of the subsamples the variograms are fitted on, 0 to skip the variograms.",
+                        type=int, default=2000)
+    parser.add_argument("-r", "--repeats",
+                        help="Subsamples per variogram, for the confidence bounds of its parameters.",
+                        type=int, default=5)
     args = parser.parse_args()
 
     # Check that arguments are sane
@@ -126,21 +178,20 @@ if __name__ == "__main__":
     if path.isfile(args.input_path):
         files = [args.input_path]
     elif path.isdir(args.input_path):
-        files = [file for file in listdir(args.input_path) if file.endswith(args.extension)]
+        files = [path.join(args.input_path, file) for file in sorted(listdir(args.input_path)) if file.endswith(args.extension)]
         
     stat_func_dicts = [{},{},{},{}]
     # Functions that act on the entire dataframe, each column independently
     stat_func_dicts[0] = {"mean":mean, "std":std, "min":mn, "max":mx, "range":rng, "quantile25":qnt25, "quantile75":qnt75}
-    # Functions performed on a 1-column dataframe
+    # Functions performed on the entire dataframe, one value per column
     stat_func_dicts[1] = {"count":count}
-    # Functions performed on a 2-column dataframe, with the first column the dependent variable when applicable
-    stat_func_dicts[2] = {"count":count, "corr":corr}#, "variogram_range":variogram_range, "variogram_sill":variogram_sill}#, "variogram_nugget":variogram_nugget}
-    # Functions performed on a 3-column dataframe, with the first two cols x (longitude) and y (latitude)
-    #stat_func_dicts[3] = {"variogram_range":variogram_range, "variogram_sill":variogram_sill, "variogram_nugget":variogram_nugget}
+    # Functions performed on the entire dataframe, one value per pair of columns, with the row column the dependent variable when applicable
+    stat_func_dicts[2] = {"count":count_matrix, "corr":corr_matrix}
+    # Variogram parameters of every column, with the first two cols x (longitude) and y (latitude)
+    if args.max_points > 0:
+        stat_func_dicts[3] = VARIOGRAM_PARAMS
         
-    for file in files:
-        out_path = file[:-len(args.extension)]
-        compute_stats(file, out_path, stat_func_dicts)
+    compute_all(files, stat_func_dicts, args.extension, args.workers, args.max_points, args.repeats)
 
-t1 = time()    
-print(f"Computed statistics for {len(files)} file(s) in {t1-t0} seconds.")
\ No newline at end of file
+    t1 = time()    
+    print(f"Computed statistics for {len(files)} file(s) in {t1-t0} seconds.")
@@ -13,6 +13,10 @@ def conf_parse(init_loc):
         SOMOSPIE_vars[var] = f'"{config["DEFAULT"][var]}"'
     for var in ["MAKE_T_E", "USE_PCA", "RAND_SEED", "USE_VIS", "BUFFER", "SUPER", "MIN_T_POINTS"]:
         SOMOSPIE_vars[var] = int(config["DEFAULT"][var])
+    # Processes curating the regions in parallel, optional
+    SOMOSPIE_vars["WORKERS"] = int(config["DEFAULT"].get("WORKERS", 1))
+    # Cores of the task scheduler of the wrapper, optional (0 uses all the cores of the node)
+    SOMOSPIE_vars["CORES"] = int(config["DEFAULT"].get("CORES", 0))
     for var in ["VALIDATE"]:
         SOMOSPIE_vars[var] = round(float(config["DEFAULT"][var]), 4)
     
@@ -11,16 +11,20 @@ else:
 
 import pathlib
 from os import listdir, chdir 
+from shutil import copyfile
 from utils import *
 
 from curate import curate
 from model import model
+from scheduler import Scheduler, Task
 from analyze import analysis
 from visualize import visualize
 
 import configparser
 from ast import literal_eval
 from SOMOSPIE_input_parser import conf_parse
+sys.path.append("./tools")
+import telemetry as tm
 SOMOSPIE_vars = conf_parse(init_file)
 for v in SOMOSPIE_vars:
     exec(f"{v}={SOMOSPIE_vars[v]}")
@@ -61,7 +65,12 @@ if SUPER:
 TRAIN_DIR = DATA.joinpath(TRAIN_DIR)
 EVAL_DIR = DATA.joinpath(EVAL_DIR)
 SHAPES = DATA.joinpath(SUB_SHAP)
-OUTPUT = pathlib.Path(OUTPUT).resolve().joinpath(strftime("job_%Y_%m_%d_%H_%M_%S",gmtime()))
+# A second argument is the job folder of an interrupted run, resumed from its task-state file
+RESUME = len(argv)>2
+if RESUME:
+    OUTPUT = pathlib.Path(argv[2]).resolve()
+else:
+    OUTPUT = pathlib.Path(OUTPUT).resolve().joinpath(strftime("job_%Y_%m_%d_%H_%M_%S",gmtime()))
 if not OUTPUT.exists():
     OUTPUT.mkdir(parents=True)
 
@@ -76,88 +85,161 @@ print(f"Original evaluation data in {EVAL_DIR}")
 JOB = OUTPUT.joinpath("job")
 
 PARAMS_FILE = append_to_folder(JOB, ".params")
-with open(PARAMS_FILE, "w") as params:
-    params.write(f"{SOMOSPIE_vars}\n")
+# A resumed run keeps the parameters of the interrupted one, one line read by utils.plot_all_predictions
+if not (RESUME and PARAMS_FILE.exists()):
+    with open(PARAMS_FILE, "w") as params:
+        params.write(f"{SOMOSPIE_vars}\n")
 
 JOB_FILE = append_to_folder(JOB, ".txt")
-with open(JOB_FILE, "w") as job:
+with open(JOB_FILE, "a" if RESUME else "w") as job:
     job.write(f"T0={T0}\n")
     job.write(f"{OUTPUT}\n")
     job.write(f"{REG_LIST}\n")
 LOG_FILE = append_to_folder(JOB, ".log")  
 
-MONTH_DICT = {}
+# Stage telemetry of the wrapper and of the model scripts it runs, aggregated by tools/telemetry_report.py
+os.environ.setdefault("SOMOSPIE_TELEMETRY", str(append_to_folder(JOB, ".telemetry.jsonl")))
+os.environ.setdefault("SOMOSPIE_RUN_ID", OUTPUT.name)
+RUN_STAGE = tm.start("somospie", months=len(MONTHS))
 
-# For now, we can only handle 1 year at a time.
-for year in YEAR[:1]:
-    folder = OUTPUT.joinpath(str(year))
-    if not folder.exists():
-        folder.mkdir()
-#####################################
-
-    for MONTH in MONTHS:
-        # This suffix is for future use.
-        MNTH_SUFX = f"-{MONTH}"
-
-        ##########################################
-        # 1 Data Processing
-
-        # ORIG is the sm data before any filtering, for use with analysis()
-        # TRAIN is the training set after filtering and pca, if specified
-        # EVAL is the evaluation set after filtering and pca, if specified
-    
-        curate_input = [MONTH_DICT, PARAMS_FILE, LOG_FILE, SM_FILE, COV_FILE, COV_LAYERS, 
-                        EVAL_FILE, SHAPES, REG_LIST, BUFFER, 
-                        TRAIN_DIR, MONTH, EVAL_DIR, USE_PCA, VALIDATE, 
-                        "", RAND_SEED, SUPER, MIN_T_POINTS]
-        print(f"curate(*{curate_input})")
-    
-        t0 = time()
-        ORIG, TRAIN, EVAL, REG_LIST, seed, suffix = curate(*curate_input)
-        with open(LOG_FILE, "a") as log:
-            log.write(f"Data curation for month {MONTH} took {time() - t0} seconds.\n")
-            log.write(f"Curated data:\nORIG={ORIG}\nTRAIN={TRAIN}\nEVAL={EVAL}\n")
-            log.write(f"The following regions had sufficient training points:\n{REG_LIST}\n")
-    
-        print("Data curated.")
+MONTH_DICT = {}
 
-        ##########################################
-        # 2 Modeling
+##########################################
+#
+# Task graph: curate each (year, month), then each model of each region kept (all its parameter
+# combinations, on the train and eval data read once), then the analysis and visualization of the region. The months of a year are curated one after the
+# other (they write the same train and eval files), everything else runs in parallel on CORES cores.
+#
 
-        PRED = folder.joinpath(suffix)
-        model_input = [0, TRAIN, EVAL, PRED, MODICT, suffix]
-        print(f"model(*{model_input})")
+# Cores of the models using n_jobs=-1, their combinations run one after the other on all of them
+MODEL_CPUS = {"RF": 4, "KKNN": 4}
+# The combinations of the other models (one core each) run in up to this many forked workers
+MODEL_WORKERS = 4
+# Memory hint of a model (MB) per MB of its train and eval files
+MODEL_MEM = {"RF": 20, "KKNN": 10}
+
+# Data folders and files of a year: the parser names them after the first year
+def year_dir(folder, year):
+    return DATA.joinpath(str(year), folder.relative_to(DATA.joinpath(str(YEAR[0]))))
+
+def year_file(file, year):
+    return pathlib.Path(str(file).replace(str(YEAR[0]), str(year))) if file else file
+
+def curate_month(year, MONTH):
+    ##########################################
+    # 1 Data Processing
+
+    # ORIG is the sm data before any filtering, for use with analysis()
+    # TRAIN is the training set after filtering and pca, if specified
+    # EVAL is the evaluation set after filtering and pca, if specified
+    month_dict = {}
+    MONTH_LOG = append_to_folder(JOB, f".{year}-{MONTH}.log")
+    curate_input = [month_dict, PARAMS_FILE, MONTH_LOG, year_file(SM_FILE, year), COV_FILE, COV_LAYERS,
+                    year_file(EVAL_FILE, year), SHAPES, REG_LIST, BUFFER,
+                    year_dir(TRAIN_DIR, year), MONTH, year_dir(EVAL_DIR, year), USE_PCA, VALIDATE,
+                    "", RAND_SEED, SUPER, MIN_T_POINTS, WORKERS]
+    print(f"curate(*{curate_input})")
+
+    t0 = time()
+    with tm.stage("curate", year=year, month=MONTH):
+        ORIG, TRAIN, EVAL, REGIONS, seed, suffix = curate(*curate_input)
+    with open(MONTH_LOG, "a") as log:
+        log.write(f"Data curation for month {MONTH} took {time() - t0} seconds.\n")
+        log.write(f"Curated data:\nORIG={ORIG}\nTRAIN={TRAIN}\nEVAL={EVAL}\n")
+        log.write(f"The following regions had sufficient training points:\n{REGIONS}\n")
+    if year == YEAR[0]:
+        # The notebook viewer (utils.plot_all_predictions) reads the regions of the first year from job.{MONTH}reg
+        copyfile(MONTH_LOG.with_suffix(f".{MONTH}reg"), append_to_folder(JOB, f".{MONTH}reg"))
+    print(f"Data curated for {year}-{MONTH}.")
+    return {"ORIG": ORIG, "TRAIN": TRAIN, "EVAL": EVAL, "REG_LIST": REGIONS, "suffix": suffix, "MONTH_DICT": month_dict.get(MONTH, {})}
+
+def model_region(year, MONTH, region, MODEL, curated, workers):
+    ##########################################
+    # 2 Modeling, all the parameter combinations of a model in one model() call: the train and eval
+    # files of the region are read once and shared by its forked workers
+    PRED = OUTPUT.joinpath(str(year), curated["suffix"])
+    model_input = [f"{region}.csv", pathlib.Path(curated["TRAIN"]), pathlib.Path(curated["EVAL"]), PRED,
+                   {MODEL: MODICT[MODEL]}, curated["suffix"], workers]
+    print(f"model(*{model_input})")
+    with tm.stage("model", year=year, month=MONTH, region=region, model=MODEL):
         model(*model_input)
-        
-        print("Prediction completed with modeling methods.")
-
-        ##########################################
-        # 3 Analysis & Visualization
 
-        for reg_type, reg in REG_LIST:
+def analyze_region(year, MONTH, reg_type, reg, curated):
+    ##########################################
+    # 3 Analysis & Visualization
+    region = f"{reg_type}_{reg}"
+    PRED = OUTPUT.joinpath(str(year), curated["suffix"])
+    ORIG = pathlib.Path(curated["ORIG"]) if curated["ORIG"] else None
+
+    if VALIDATE:
+        R2_FILE = append_to_folder(JOB, ".r2")
+        RMSE_FILE = append_to_folder(JOB, ".rmse")
+        analysis_input = [region, PRED, ORIG, VALIDATE, R2_FILE, RMSE_FILE]
+        print(f"analysis(*{analysis_input})")
+        with tm.stage("analysis", year=year, month=MONTH, region=region):
+            analysis(*analysis_input)
+
+    if USE_VIS:
+        # Specify the input data folder and the output figures folder
+        DATS = PRED.joinpath(region)
+        OUTS = DATS.joinpath(SUB_FIGS)
+        ORIGFOLDER = ORIG.joinpath(region)
+        visualize_input = [DATS, OUTS, ORIGFOLDER, reg_type, reg, 1, 0]
+        print(f"visualize(*{visualize_input})")
+        with tm.stage("visualize", year=year, month=MONTH, region=region):
+            visualize(*visualize_input)
+
+# Number of parameter combinations of each model, as in model()
+COMBOS = {MODEL: len(list(iterprod(*MODICT[MODEL].values()))) for MODEL in MODICT}
+
+def file_mb(*files):
+    return sum(f.stat().st_size for f in files if f.is_file()) / 2**20
+
+# Tasks of the regions a curation kept, added once it is done
+def region_tasks(year, MONTH):
+    def then(curated):
+        MONTH_DICT.setdefault(year, {})[MONTH] = curated["MONTH_DICT"]
+        tasks = []
+        for reg_type, reg in curated["REG_LIST"]:
             region = f"{reg_type}_{reg}"
-            
-            if VALIDATE:
-                R2_FILE = append_to_folder(JOB, ".r2")
-                RMSE_FILE = append_to_folder(JOB, ".rmse")
-                analysis_input = [region, PRED, ORIG, VALIDATE, R2_FILE, RMSE_FILE]
-                print(f"analysis(*{analysis_input})")
-                analysis(*analysis_input)
-
-            if USE_VIS:
-                # Specify the input data folder and the output figures folder
-                DATS = PRED.joinpath(region)
-                OUTS = DATS.joinpath(SUB_FIGS)
-                ORIGFOLDER = ORIG.joinpath(region)
-                visualize_input = [DATS, OUTS, ORIGFOLDER, reg_type, reg, 1, 0]
-                print(f"visualize(*{visualize_input})")
-                visualize(*visualize_input)
+            data_mb = file_mb(pathlib.Path(curated["TRAIN"]).joinpath(f"{region}.csv"), pathlib.Path(curated["EVAL"]).joinpath(f"{region}.csv"))
+            models = []
+            for MODEL in MODICT:
+                name = f"model-{year}-{MONTH}-{region}-{MODEL}"
+                models.append(name)
+                workers = 1 if MODEL in MODEL_CPUS else max(1, min(COMBOS[MODEL], MODEL_WORKERS))
+                tasks.append(Task(name, model_region, (year, MONTH, region, MODEL, curated, workers),
+                                  deps=[f"curate-{year}-{MONTH}"], cpus=MODEL_CPUS.get(MODEL, workers),
+                                  mem_mb=256 + MODEL_MEM.get(MODEL, 5) * data_mb * workers))
+            if VALIDATE or USE_VIS:
+                tasks.append(Task(f"analyze-{year}-{MONTH}-{region}", analyze_region, (year, MONTH, reg_type, reg, curated),
+                                  deps=models, mem_mb=256 + 5 * data_mb))
+        return tasks
+    return then
+
+scheduler = Scheduler(str(append_to_folder(JOB, ".tasks.json")), cores=CORES)
+for year in YEAR:
+    folder = OUTPUT.joinpath(str(year))
+    if not folder.exists():
+        folder.mkdir()
+    previous = []
+    for MONTH in MONTHS:
+        name = f"curate-{year}-{MONTH}"
+        scheduler.add(Task(name, curate_month, (year, MONTH), deps=previous, cpus=WORKERS, mem_mb=1024,
+                           then=region_tasks(year, MONTH)))
+        previous = [name]
+scheduler.run()
 
 T1 = time()
+RUN_STAGE.finish()
 with open(JOB_FILE, "a") as job:
     job.write(f"T1={T1}\n")
     job.write(f"T={T1-T0}\n")
-with open(PARAMS_FILE, "a") as params:
-    params.write(f"{MONTH_DICT}\n")
+# Same lines as a run of the first year only: the parameters, {month: ...} of the first year and the times,
+# then {year: {month: ...}} of all the years. Rewritten, so a resumed run has each line once.
+with open(PARAMS_FILE, "w") as params:
+    params.write(f"{SOMOSPIE_vars}\n")
+    params.write(f"{MONTH_DICT.get(YEAR[0], {})}\n")
     params.write(f"{T1}\n")
-    params.write(f"{T1-T0}\n")
\ No newline at end of file
+    params.write(f"{T1-T0}\n")
+    params.write(f"{MONTH_DICT}\n")
\ No newline at end of file
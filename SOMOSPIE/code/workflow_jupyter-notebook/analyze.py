@@ -5,6 +5,11 @@ import pandas as pd
 import pandas as pd
 from math import floor
 from time import time
+sys.path.append("./tools")
+sys.path.append("./analysis")
+import telemetry as tm
+import grid_join as gj
+import obs_vs_pred as ovp
 
 # This is a wrapper script for analysis of predictions produced in stage 2-model
 #
@@ -18,8 +23,6 @@ from time import time
 
 def analysis(REGION, PRED_DIR, ORIG_DIR, VALIDATE, R2_FILE, RMSE_FILE):
 
-    RESID_COMP = pathlib.Path("analysis/obs_vs_pred.R").resolve()
-
     PREDS = PRED_DIR.joinpath(REGION, SUB_PRED)
     RESIDS = PRED_DIR.joinpath(REGION, SUB_RESI)
     #RES_FIGS = PRED_DIR.joinpath(REGION, SUB_FIGS, SUB_RESI)
@@ -29,12 +32,20 @@ def analysis(REGION, PRED_DIR, ORIG_DIR, VALIDATE, R2_FILE, RMSE_FILE):
     #    RES_FIGS.mkdir(parents=True)
 
     ORIG = append_to_folder(ORIG_DIR.joinpath(REGION), ".csv")
-    for pred in (file for file in listdir(PREDS) if file.endswith(".csv")):
+    preds = [file for file in listdir(PREDS) if file.endswith(".csv")]
+    if floor(VALIDATE)==1 and preds:
+        # R^2 and RMSE of all the predictions of the region, the validation data read once
+        scores = ovp.obs_vs_pred(ORIG, [PREDS.joinpath(pred) for pred in preds])
+    elif VALIDATE==2 and preds:
+        # All the predictions of the region joined to the validation data at once, on grid keys
+        compared, stats = gj.compare(ORIG, [PREDS.joinpath(pred) for pred in preds])
+    for pred in preds:
         PRED = PREDS.joinpath(pred)
         RESID = RESIDS.joinpath(pred)
         LOG = RESID.with_suffix(".log")
                 
-        with open(LOG, "w") as log:
+        with open(LOG, "w") as log, tm.stage("analysis_run", region=REGION, prediction=pred) as stage:
+            stage.files(inputs=[ORIG, PRED])
             t0 = time()
             log.write(f"t0={t0}\n")
             
@@ -42,47 +53,32 @@ def analysis(REGION, PRED_DIR, ORIG_DIR, VALIDATE, R2_FILE, RMSE_FILE):
                 # ToDo: Save the differences to RESID.
                 log.write(f"floor(VALIDATE)==1: Computing residuals between prediction and the portion of original satellite data removed for testing.\n")
                 #RES_COMP = RES_FIGS.joinpath(pred).with_suffix(".png")
-                #resid_args = [RESID_COMP, ORIG, PRED, RES_COMP, SCORE_FILE]
-                resid_args = [RESID_COMP, ORIG, PRED, R2_FILE, RMSE_FILE]
-                log.write(f"resid_args: {resid_args}\n")
-                bash(resid_args)
+                # Same lines as analysis/obs_vs_pred.R, computed in process
+                r2, rmse = scores[str(PRED)]
+                log.write(f"obs_vs_pred: r2={r2} rmse={rmse} ({ORIG}, {PRED})\n")
+                ovp.write_scores({str(PRED): (r2, rmse)}, R2_FILE, RMSE_FILE)
                 
             elif VALIDATE==2:
                 log.write(f"VALIDATE==2: Computing differences between prediction and supplied validation data.\n")
                 
-                # Load in known sm values.
-                old = pd.read_csv(ORIG)
-                old.columns = ["x", "y", "old"]
-                old.set_index(["x", "y"], inplace=True)
-                
-                # Load in predicted sm values.
-                new = pd.read_csv(PRED, header=None)
-                new = new[new.columns[:3]]
-                new.columns = ["x", "y", "new"]
-                new.set_index(["x", "y"], inplace=True)
-                
-                # Join old and new.
+                # Known and predicted sm values, joined on the (row, col) of the grid of the known points.
                 # Will only keep data points for which the same x/y exists in both.
-                compare = old.join(new)#[new.columns[2]])#"new"])
-                #compare.columns = ["x", "y", "old", "new"]
-                compare.dropna(inplace=True)
+                compare = gj.deltas(compared, PRED)
                 
                 # Compute stats and save to files.
-                corr = (compare["new"].corr(compare["old"]))**2
+                corr = stats[str(PRED)]["r2"]
                 log.write(f"The correlation between the original and predicted data is {corr}.\n")
                 with open(R2_FILE, 'a') as r2_out:
-                    r2_out.write(f"{corr},{PRED}")
-                rmse = np.sqrt(np.mean((compare["new"] - compare["old"])**2))
+                    r2_out.write(f"{corr},{PRED}\n")
+                rmse = stats[str(PRED)]["rmse"]
                 log.write(f"The RMSE between the original and predicted data is {rmse}.\n")
                 with open(RMSE_FILE, 'a') as rmse_out:
-                    rmse_out.write(f"{rmse},{PRED}")
+                    rmse_out.write(f"{rmse},{PRED}\n")
                 
-                # Find differences and save to file.
-                compare["deltas"] = compare["new"] - compare["old"]
-                compare["reltas"] = compare["deltas"]/compare["old"]
+                # Differences and relative differences, saved to file.
                 log.write(f"The first few rows of differences and relative differences:\n{compare.head()}\n")
-                resid = compare[["deltas"]]#"x","y","reltas"]]
-                resid.to_csv(path_or_buf=RESID, header=False)#, index=False)
+                resid = compare[["x", "y", "deltas"]]#"reltas"]]
+                resid.to_csv(path_or_buf=RESID, header=False, index=False)
             
             t1 = time()
             log.write(f"t1={t1}\n")
@@ -3,23 +3,271 @@ import sys
 sys.path.append("./preprocessing")
 sys.path.append("./analysis")
 sys.path.append("./utils")
+sys.path.append("./tools")
 import pathlib
 import pandas as pd
 import panda_scripts as ps
 import joint_pca as pca
+try:
+    import region_crop as rc # Needs GDAL and shapely>=2, otherwise regions are cropped by the R scripts
+except ImportError:
+    rc = None
+try:
+    import point_sampler as psm # Needs GDAL, otherwise covariates are added by add_topos.R
+except ImportError:
+    psm = None
 from argument_validators import alphanumeric
 from shutil import rmtree
 from math import floor
 from numpy.random import randint
 from os import remove
 import inspect
+from concurrent.futures import ProcessPoolExecutor
 
 from utils import *
 
+########################################
+# Per-region steps of curate()
+#
+# Regions are independent once the sources have been cropped, so these steps run in a process pool
+# when WORKERS > 1. JOB is the dictionary of the arguments shared by the regions. Each region writes
+# its own log file (region_log_file), merged into LOG_FILE in the order of REG_LIST, and returns what
+# curate() records in MONTH_DICT.
+
+def region_log_file(LOG_FILE, MONTH, reg_type, reg):
+    return LOG_FILE.with_suffix(f".{MONTH}.{reg_type}_{reg}.log")
+
+def merge_region_logs(log, LOG_FILE, MONTH, REG_LIST):
+    for reg_type, reg in REG_LIST:
+        REG_LOG = region_log_file(LOG_FILE, MONTH, reg_type, reg)
+        if REG_LOG.is_file():
+            log.write(REG_LOG.read_text())
+            remove(REG_LOG)
+    log.flush()
+
+# Prepare shape for cropping.
+# The shape is written to a file of the process and renamed, so concurrent regions sharing a shape
+# (SUPER ecoregions) never read a partial .rds file.
+def create_shape(log, JOB, reg_type, reg):
+    SHAPE_DIR = JOB["SHAPE_DIR"]
+    SHAPE_DIR.mkdir(parents=True, exist_ok=True)
+    SHAPE_FILE = SHAPE_DIR.joinpath(f"{reg}.rds")
+    if SHAPE_FILE.is_file():
+        log.write(f"shape for {reg} exists in {SHAPE_DIR}\n")
+    else:
+        TEMP_FILE = SHAPE_DIR.joinpath(f"{reg}.{os.getpid()}.rds")
+        shape_args = [JOB["MASK_PATH"], reg_type, reg, TEMP_FILE]
+        log.write(f"{shape_args}\n")
+        #print(shape_args)
+        bash(shape_args)
+        if TEMP_FILE.is_file():
+            os.replace(TEMP_FILE, SHAPE_FILE)
+        log.write(f"Created shape for {reg} in {SHAPE_DIR}")
+    return SHAPE_FILE
+
+def crop_to_shape(log, JOB, SOURCE, reg_type, reg, out_file, buffer=0, names=[]):
+    SHAPE_FILE = create_shape(log, JOB, reg_type, reg)
+    crop_args = [JOB["CROP_PATH"], SOURCE, SHAPE_FILE, out_file, buffer] + names
+    log.write(f"{crop_args}\n")
+    bash(crop_args)
+
+# Add the covariate columns to a csv of points, in batch with point_sampler or with add_topos.R.
+def add_covariates(log, JOB, REG_FILE):
+    COV_FILE, COV_LAYERS = JOB["COV_FILE"], JOB["COV_LAYERS"]
+    if psm is not None:
+        log.write(f"point_sampler.add_columns({REG_FILE}, {COV_FILE}, {REG_FILE}, {COV_LAYERS})\n")
+        psm.add_columns(REG_FILE, COV_FILE, REG_FILE, COV_LAYERS)
+    else:
+        cov_args = [JOB["ADD_COV_PATH"], REG_FILE, COV_FILE, REG_FILE] + COV_LAYERS
+        log.write(f"{cov_args}\n")
+        bash(cov_args)
+
+# Train and eval files of a region. The sources the cropper did not handle for the region
+# (JOB["R_CROP"]) are cropped to its shape with crop_to_shape.R first.
+def create_region(JOB, reg_type, reg):
+    SM_FILE, COV_FILE, EVAL_FILE = JOB["SM_FILE"], JOB["COV_FILE"], JOB["EVAL_FILE"]
+    TRAIN_DIR, EVAL_DIR, SM_BEFORE = JOB["TRAIN_DIR"], JOB["EVAL_DIR"], JOB["SM_BEFORE"]
+    R_CROP = JOB["R_CROP"].get((reg_type, reg), {})
+    with open(region_log_file(JOB["LOG_FILE"], JOB["MONTH"], reg_type, reg), "w") as log:
+        if SM_FILE:
+            REG_TR_FILE = TRAIN_DIR.joinpath(f"{reg_type}_{reg}.csv")
+            if "SM" in R_CROP:
+                crop_to_shape(log, JOB, SM_FILE, *R_CROP["SM"], REG_TR_FILE, JOB["BUFFER"])
+            if COV_FILE:
+                add_covariates(log, JOB, REG_TR_FILE)
+
+        if EVAL_FILE or COV_FILE:
+            log.write(f"Creating EVAL file for {reg}.\n")
+            REG_EV_FILE = EVAL_DIR.joinpath(f"{reg_type}_{reg}.csv")
+            if EVAL_FILE:
+                if "EVAL" in R_CROP:
+                    crop_to_shape(log, JOB, EVAL_FILE, *R_CROP["EVAL"], REG_EV_FILE)
+            elif "COV" in R_CROP:
+                crop_to_shape(log, JOB, COV_FILE, *R_CROP["COV"], REG_EV_FILE, 0, JOB["COV_LAYERS"])
+
+            if JOB["VALIDATE"]==2:
+                VALID_FILE = SM_BEFORE.joinpath(REG_EV_FILE.name)
+                log.write(f"cp {REG_EV_FILE} {VALID_FILE}")
+                bash(["cp", REG_EV_FILE, VALID_FILE])
+
+            if EVAL_FILE:
+                print(f"{JOB['DROP_COLS_PATH']} {REG_EV_FILE} {REG_EV_FILE} -k 0,1")
+                bash([JOB["DROP_COLS_PATH"], REG_EV_FILE, REG_EV_FILE, "-k", "0,1"])
+
+                if COV_FILE:
+                    add_covariates(log, JOB, REG_EV_FILE)
+
+# Month selection, NA handling, validation split and PCA of the train and eval files of a region,
+# written to JOB["TRAIN_DIR_TEMP"] and JOB["EVAL_DIR_TEMP"].
+# Returns the number of points of the region, None when the region is dropped.
+def process_region(JOB, reg_type, reg):
+    TRAIN_DIR, EVAL_DIR, SM_BEFORE = JOB["TRAIN_DIR"], JOB["EVAL_DIR"], JOB["SM_BEFORE"]
+    MONTH, VALIDATE, seed = JOB["MONTH"], JOB["VALIDATE"], JOB["seed"]
+    region = f"{reg_type}_{reg}.csv"
+    with open(region_log_file(JOB["LOG_FILE"], MONTH, reg_type, reg), "w") as log:
+        if not os.path.isfile(TRAIN_DIR.joinpath(region)):
+            return None
+
+        tdf = pd.read_csv(TRAIN_DIR.joinpath(region))#, dtype=float)#.astype(object).infer_objects()
+        #print(f"before: {tdf.columns}")
+        tdf.rename(columns=alphanumeric, inplace=True)
+        #print(f"after: {tdf.columns}")
+
+        if not os.path.isfile(EVAL_DIR.joinpath(region)):
+            return None
+        edf = pd.read_csv(EVAL_DIR.joinpath(region))#, dtype=float)#.astype(object).infer_objects()
+        log.write(f"imported edf; first 3 rows:\n{edf.head(3)}\n")
+        #print(f"before: {edf.columns}")
+        edf.rename(columns=alphanumeric, inplace=True)
+        ecols = {edf.columns[0]: tdf.columns[0], edf.columns[1]: tdf.columns[1]}
+        edf.rename(columns=ecols, inplace=True)
+        #print(f"after: {edf.columns}")
+
+        if MONTH:
+            replacements = ps.monthify(tdf.columns)
+            tdf = tdf.rename(columns=replacements)
+            tdf = ps.keep_month(tdf, MONTH)
+
+        ######################################################
+        ## Dealing with NAs
+        ######################################################
+        # Show how many non-NA's there are in each column
+        log.write(f"Number of non-NA values in tdf by column:\n{tdf.count()}\n")
+        log.write(f"Number of non-NA values in edf by column:\n{edf.count()}\n")
+        # LSF is mostly NA in this region; replace it with 0, appropriate for a costal pixel
+        # Dict of cols with specified NA replacement value
+        bad_cols = {"LSF":0}
+        tdf.fillna(value=bad_cols, inplace=True)#[["LSF"]] = tdf[["LSF"]].fillna(0)
+        edf.fillna(value=bad_cols, inplace=True)#[["LSF"]] = edf[["LSF"]].fillna(0)
+        for col in bad_cols:
+            log.write(f"NA's in '{col}' replaced with {bad_cols[col]}.\n")
+        # Show how many non-NA's there are in each column
+        #log.write(f"Number of non-NA values in tdf by column:\n{tdf.count()}\n")
+        #log.write(f"Number of non-NA values in edf by column:\n{edf.count()}\n")
+
+        tdf = tdf.dropna()#thresh=4).fillna(0)
+        log.write(f"First 3 rows of tdf:\n{tdf.head(3)}\n")
+        #log.write(f"Number of non-NA values in tdf by column:\n{tdf.count()}\n")
+        edf = edf.dropna()#thresh=4).fillna(0)
+        log.write(f"First 3 rows of edf:\n{edf.head(3)}\n")
+        #log.write(f"Number of non-NA values in edf by column:\n{edf.count()}\n")
+        ############################################
+
+        trows = tdf.shape[0]
+        if trows:
+            log.write(f"There are {trows} training points in {region}.\n")
+        else:
+            log.write(f"Warning: there are no training points in {region}!\n")
+            return None
+
+        erows = edf.shape[0]
+        if erows:
+            log.write(f"There are {erows} evaluation points in {region}.\n")
+        else:
+            log.write(f"Warning: there are no evaluation points in {region}!\n")
+            return None
+
+        points = {}
+        if floor(VALIDATE)==1:
+            before = tdf[tdf.columns[:3]]#.dropna()
+            if VALIDATE>1:
+                log.write(f"For before.sample, {seed}.\n")
+                before = before.sample(frac=(VALIDATE - 1), random_state=seed)
+                tdf.drop(before.index.tolist(), inplace=True)
+                trows = tdf.shape[0]
+                if trows:
+                    log.write(f"There are {trows} training points in {region}.\n")
+                else:
+                    log.write(f"Warning: there are no training points in {region}!\n")
+                    return None
+            brows = before.shape[0]
+            if brows:
+                log.write(f"There are {brows} validation points in {region}.\n")
+            else:
+                log.write(f"Warning: there are no validation points in {region}!\n")
+                return None
+            points["validation"] = brows
+            before_path = SM_BEFORE.joinpath(region)
+            before.to_csv(path_or_buf=before_path, index=False, header=False, na_rep="NA")
+            if JOB["BUFFER"] or JOB["SUPER"]:
+                log.write("Trimming validation file back down to {region}.\n")
+                crop_args = [JOB["CROP_PATH"], before_path, before_path, r]
+                log.write(f"{crop_args}\n")
+                bash(crop_args)
+
+        if JOB["USE_PCA"]:
+            params = pca.get_params(tdf)
+            log.write(f"Performing PCA.\n")
+            #log.write(f"tdf pre-PCA: {tdf.shape}\n{tdf.head(3)}\n")
+            #log.write(f"edf pre-PCA: {edf.shape}\n{edf.head(3)}\n")
+            log.write(f"pre-PCA:\n{params}\n")
+            if len(params) > min(tdf.shape[0], edf.shape[0]):
+                log.write(f"Error: region {region} skipped! You have {tdf.shape[0]} rows of training data and {edf.shape[0]} rows of evaluation data, but you need at least {len(params)} of each to perform PCA on your params.\n")
+                return None
+
+            # Fit and eval transform cached per region, shared by the months with the same training points
+            PCA_CACHE = JOB["PCA_CACHE"].joinpath(pathlib.Path(region).stem)
+            tdf, edf, comps, reused = pca.cached_joint_pca(tdf, edf, params, PCA_CACHE)
+            if reused:
+                log.write(f"PCA {' and '.join(reused)} of {region} reused from {PCA_CACHE}.\n")
+            log.write(f"post-PCA:\n{tdf.shape}\n{tdf.head(3)}\n{edf.shape}\n{edf.head(3)}\n{comps}\n")
+            log.write(f"Completed PCA for {region} with these eigenvalues:\n{comps}\n")
+
+            trows = tdf.shape[0]
+            if trows:
+                log.write(f"There are {trows} training points in {region}.\n")
+            else:
+                log.write(f"Warning: there are no training points in {region}!\n")
+                return None
+
+            erows = edf.shape[0]
+            if erows:
+                log.write(f"There are {erows} evaluation points in {region}.\n")
+            else:
+                log.write(f"Warning: there are no evaluation points in {region}!\n")
+                return None
+
+        tdf.to_csv(path_or_buf=JOB["TRAIN_DIR_TEMP"].joinpath(region), index=False)
+        edf.to_csv(path_or_buf=JOB["EVAL_DIR_TEMP"].joinpath(region), index=False)
+        points.update({"train": trows, "eval": erows})
+        return points
+
+# Runs step(JOB, reg_type, reg) for every region, in a pool of WORKERS processes when WORKERS > 1.
+# Returns {(reg_type, reg): result}.
+def for_regions(step, JOB, REG_LIST, WORKERS=1):
+    REG_LIST = [tuple(region) for region in REG_LIST]
+    if WORKERS > 1 and len(REG_LIST) > 1:
+        with ProcessPoolExecutor(max_workers=min(WORKERS, len(REG_LIST))) as executor:
+            futures = {region: executor.submit(step, JOB, *region) for region in REG_LIST}
+            return {region: future.result() for region, future in futures.items()}
+    return {region: step(JOB, *region) for region in REG_LIST}
+
+
 # This is a wrapper for all the data-processing scripts below.
 #
 #       Arguments:
 #         MONTH_DICT      A dictionary from the scope above this level, to be filled by this function
+#                         (with the points of each region kept, returned by the workers)
 #         PARAMS_FILE     _______
 #         LOG_FILE        Path for the log file
 #         SM_FILE         File with sm data
@@ -43,35 +291,30 @@ from utils import *
 #                         Default 0, nothing changed
 #         MIN_T_POINTS    Minimum number of training points required in each region;
 #                         Default -1 doesn't check
+#         WORKERS         Number of processes curating the regions in parallel;
+#                         Default 1, the regions are curated one after the other
 #         
 #       Output:
 #         The output folder depends on which preprocessing steps are taken
 #         A log file is generated in LOG_DIR/proc-log#.txt,
 #          where # is the least unused natural number
-
-def curate(MONTH_DICT, PARAMS_FILE, LOG_FILE, SM_FILE, COV_FILE, COV_LAYERS, EVAL_FILE, SHAPE_DIR, 
-           REG_LIST, BUFFER, TRAIN_DIR, MONTH, 
-           EVAL_DIR, USE_PCA, VALIDATE, STATS_FILE="", RAND=0, SUPER=0, MIN_T_POINTS=-1):
+def curate(MONTH_DICT, PARAMS_FILE, LOG_FILE, SM_FILE, COV_FILE, COV_LAYERS, EVAL_FILE, SHAPE_DIR,
+           REG_LIST, BUFFER, TRAIN_DIR, MONTH,
+           EVAL_DIR, USE_PCA, VALIDATE, STATS_FILE="", RAND=0, SUPER=0, MIN_T_POINTS=-1, WORKERS=1):
     MASK_PATH = pathlib.Path("preprocessing/create_shape.R").resolve()
     CROP_PATH = pathlib.Path("preprocessing/crop_to_shape.R").resolve()
     ADD_COV_PATH = pathlib.Path("preprocessing/add_topos.R").resolve()
     DROP_COLS_PATH = pathlib.Path("preprocessing/drop_cols.py").resolve()
-    
-    # Prepare shape for cropping.
-    def create_shape(reg_type, reg, SHAPE_DIR=SHAPE_DIR):
-        if not SHAPE_DIR.is_dir():
-            SHAPE_DIR.mkdir(parents=True)
-        SHAPE_FILE = SHAPE_DIR.joinpath(f"{reg}.rds")
-        if SHAPE_FILE.is_file():
-            log.write(f"shape for {reg} exists in {SHAPE_DIR}\n")
-        else:
-            shape_args = [MASK_PATH, reg_type, reg, SHAPE_FILE]
-            log.write(f"{shape_args}\n")
-            #print(shape_args)
-            bash(shape_args)
-            log.write(f"Created shape for {reg} in {SHAPE_DIR}")
-        return SHAPE_FILE
-    
+
+    # Crop a raster source to every region in one read. Returns the regions left to the R scripts,
+    # {(reg_type, reg): shape region}; cropper is None when region_crop can not be used.
+    def crop_regions(cropper, SOURCE, outputs, buffer=0, names=[]):
+        if cropper is not None and rc.is_raster(SOURCE):
+            counts = cropper.crop(SOURCE, [(region, out_file) for _, region, out_file in outputs], names, buffer)
+            log.write(f"Cropped {SOURCE} to {len(counts)} regions in one pass: {counts}\n")
+            outputs = [(key, region, out_file) for key, region, out_file in outputs if not cropper.supports(region)]
+        return {key: region for key, region, out_file in outputs}
+
     print(f"Curation log file: {LOG_FILE}")
     with open(LOG_FILE, "w") as log:
         log.write("----------------------------------------\n")
@@ -82,7 +325,7 @@ def curate(MONTH_DICT, PARAMS_FILE, LOG_FILE, SM_FILE, COV_FILE, COV_LAYERS, EVA
         for i in args:
             log.write(f"{i}={vals[i]}\n")
         log.write("----------------------------------------\n")
-        
+
         # Establish random seed:
         if (VALIDATE<=1) or (VALIDATE>=2):
             seed=0
@@ -92,10 +335,10 @@ def curate(MONTH_DICT, PARAMS_FILE, LOG_FILE, SM_FILE, COV_FILE, COV_LAYERS, EVA
             else:
                 seed = randint(2**16)
             log.write(f"For randomization, using {seed}.\n")
-        
+
         #suffix = ""
- 
-        
+
+
         MONTH_DICT[MONTH] = {}
         suffix = f"month{MONTH}"
         if SUPER:
@@ -107,12 +350,29 @@ def curate(MONTH_DICT, PARAMS_FILE, LOG_FILE, SM_FILE, COV_FILE, COV_LAYERS, EVA
             suffix += "-PCA"
         if seed:
             suffix += f"-{VALIDATE-1:.2f}_{seed}"
-            MONTH_DICT[MONTH]["seed"] = seed 
-       
-            
+            MONTH_DICT[MONTH]["seed"] = seed
+
+        REG_LIST = [tuple(region) for region in REG_LIST]
+        if WORKERS > 1:
+            log.write(f"Curating the regions in {WORKERS} processes, the log of each region follows its step.\n")
+
 ########################################
 # Create train and eval files
 
+        # Region polygons are loaded once for every source
+        shape_regions = []
+        for reg_type, reg in REG_LIST:
+            if SUPER and (reg_type=="ECOREGION" or reg_type=="CEC"):
+                shape_regions.append((reg_type, ".".join(reg.split(".")[:-1])))
+            shape_regions.append((reg_type, reg))
+        try:
+            cropper = rc.RegionCropper(shape_regions, SHAPE_DIR) if rc and (SM_FILE or EVAL_FILE or COV_FILE) else None
+            if cropper is not None and cropper.missing:
+                log.write(f"No polygon in Python for {cropper.missing}, cropped with create_shape.R.\n")
+        except RuntimeError as e:
+            log.write(f"Region cropping with R only: {e}\n")
+            cropper = None
+
         if VALIDATE:
             SM_BEFORE = TRAIN_DIR.parent.joinpath("original_sm-"+suffix)
             log.write(f"Soil Moisture data from before preprocessing will go in {SM_BEFORE}\n")
@@ -121,86 +381,58 @@ def curate(MONTH_DICT, PARAMS_FILE, LOG_FILE, SM_FILE, COV_FILE, COV_LAYERS, EVA
         else:
             SM_BEFORE = None
 
+        JOB = {"LOG_FILE": LOG_FILE, "MONTH": MONTH, "SHAPE_DIR": SHAPE_DIR,
+               "MASK_PATH": MASK_PATH, "CROP_PATH": CROP_PATH, "ADD_COV_PATH": ADD_COV_PATH, "DROP_COLS_PATH": DROP_COLS_PATH,
+               "SM_FILE": SM_FILE, "COV_FILE": COV_FILE, "COV_LAYERS": COV_LAYERS, "EVAL_FILE": EVAL_FILE,
+               "TRAIN_DIR": TRAIN_DIR, "EVAL_DIR": EVAL_DIR, "SM_BEFORE": SM_BEFORE,
+               "BUFFER": BUFFER, "SUPER": SUPER, "VALIDATE": VALIDATE, "USE_PCA": USE_PCA, "seed": seed,
+               "PCA_CACHE": TRAIN_DIR.parent.joinpath("pca_cache")}
+        # Sources each region still has to crop with the R scripts, and the region of the shape
+        R_CROP = {region: {} for region in REG_LIST}
+
         if SM_FILE:
             log.write("Extracting sm data from the specified source.\n")
+            if not TRAIN_DIR.is_dir():
+                TRAIN_DIR.mkdir(parents=True)
+            outputs = []
             for reg_type,reg in REG_LIST:
-                if not TRAIN_DIR.is_dir():
-                    TRAIN_DIR.mkdir(parents=True)
-
                 REG_TR_FILE = TRAIN_DIR.joinpath(f"{reg_type}_{reg}.csv")
+                shape_reg = reg
                 if SUPER and (reg_type=="ECOREGION" or reg_type=="CEC"):
-                    reg = ".".join(reg.split(".")[:-1])
-
-                SHAPE_FILE = create_shape(reg_type, reg)
-
-                # Crop soil moisture file to shape.
-                crop_args = [CROP_PATH, SM_FILE, SHAPE_FILE, REG_TR_FILE, BUFFER]
-                #print(crop_args)
-                log.write(f"{crop_args}\n")
-                bash(crop_args)
+                    shape_reg = ".".join(reg.split(".")[:-1])
+                outputs.append(((reg_type, reg), (reg_type, shape_reg), REG_TR_FILE))
 
-                if COV_FILE:
-                    cov_args = [ADD_COV_PATH, REG_TR_FILE, COV_FILE, REG_TR_FILE] + COV_LAYERS
-                    log.write(f"{cov_args}\n")
-                    bash(cov_args)
+            # Crop soil moisture file to shapes.
+            for key, region in crop_regions(cropper, SM_FILE, outputs, BUFFER).items():
+                R_CROP[key]["SM"] = region
         else:
             log.write("No SM_FILE specified, so train folder assumed populated.\n")
-                
-        if EVAL_FILE:
-
-            log.write("Creating eval files from specified source.\n")
-            for reg_type, reg in REG_LIST:
-                log.write(f"Creating EVAL file for {reg}.\n")
-                if not EVAL_DIR.is_dir():
-                    EVAL_DIR.mkdir(parents=True)
-
-                REG_EV_FILE = EVAL_DIR.joinpath(f"{reg_type}_{reg}.csv")
-
-                SHAPE_FILE = create_shape(reg_type, reg)
-
-                # Crop evaluation file to shape.
-                crop_args = [CROP_PATH, EVAL_FILE, SHAPE_FILE, REG_EV_FILE]
-                log.write(f"{crop_args}\n")
-                bash(crop_args)
-
-                if VALIDATE==2:
-                    VALID_FILE = SM_BEFORE.joinpath(REG_EV_FILE.name)
-                    log.write(f"cp {REG_EV_FILE} {VALID_FILE}")
-                    bash(["cp", REG_EV_FILE, VALID_FILE])
-
-                print(f"{DROP_COLS_PATH} {REG_EV_FILE} {REG_EV_FILE} -k 0,1")
-                bash([DROP_COLS_PATH, REG_EV_FILE, REG_EV_FILE, "-k", "0,1"])
-
-                if COV_FILE:
-                    cov_args = [ADD_COV_PATH, REG_EV_FILE, COV_FILE, REG_EV_FILE] + COV_LAYERS
-                    log.write(f"{cov_args}\n")
-                    bash(cov_args)
-
-        elif COV_FILE:
-            log.write("Extracting covariate data from the specified source.\n")
-            for reg_type, reg in REG_LIST:
-                log.write(f"Creating EVAL file for {reg}.\n")
-                if not EVAL_DIR.is_dir():
-                    EVAL_DIR.mkdir(parents=True)
-
-                REG_EV_FILE = EVAL_DIR.joinpath(f"{reg_type}_{reg}.csv")
-
-                SHAPE_FILE = create_shape(reg_type, reg)
-
-                # Crop covariate file to shape.
-                crop_args = [CROP_PATH, COV_FILE, SHAPE_FILE, REG_EV_FILE, 0] + COV_LAYERS
-                #print(crop_args)
-                log.write(f"{crop_args}\n")
-                bash(crop_args)
-
-                if VALIDATE==2:
-                    VALID_FILE = SM_BEFORE.joinpath(REG_EV_FILE.name)
-                    log.write(f"cp {REG_EV_FILE} {VALID_FILE}")
-                    bash(["cp", REG_EV_FILE, VALID_FILE])
 
+        if EVAL_FILE or COV_FILE:
+            if EVAL_FILE:
+                log.write("Creating eval files from specified source.\n")
+            else:
+                log.write("Extracting covariate data from the specified source.\n")
+            if not EVAL_DIR.is_dir():
+                EVAL_DIR.mkdir(parents=True)
+
+            # Crop evaluation file, or else the covariate file, to shapes.
+            outputs = [(region, region, EVAL_DIR.joinpath(f"{region[0]}_{region[1]}.csv")) for region in REG_LIST]
+            if EVAL_FILE:
+                for key, region in crop_regions(cropper, EVAL_FILE, outputs).items():
+                    R_CROP[key]["EVAL"] = region
+            else:
+                for key, region in crop_regions(cropper, COV_FILE, outputs, 0, COV_LAYERS).items():
+                    R_CROP[key]["COV"] = region
         else:
             log.write("No EVAL_FILE or COV_FILE specified, so eval folder assumed populated.\n")
 
+        # Covariates, validation copies and the crops left to R, region by region
+        if SM_FILE or EVAL_FILE or COV_FILE:
+            JOB["R_CROP"] = R_CROP
+            for_regions(create_region, JOB, REG_LIST, WORKERS)
+            merge_region_logs(log, LOG_FILE, MONTH, REG_LIST)
+
 ########################################
 # Compute statistics on train files
 
@@ -217,137 +449,21 @@ def curate(MONTH_DICT, PARAMS_FILE, LOG_FILE, SM_FILE, COV_FILE, COV_LAYERS, EVA
         if TRAIN_DIR_TEMP.is_dir():
             rmtree(TRAIN_DIR_TEMP)
         TRAIN_DIR_TEMP.mkdir(parents=True)
-        
+
         EVAL_DIR_TEMP = append_to_folder(EVAL_DIR, "-postproc-"+suffix)
         log.write(f"Processed evaluation data to go in {EVAL_DIR_TEMP}\n")
         if EVAL_DIR_TEMP.is_dir():
             rmtree(EVAL_DIR_TEMP)
         EVAL_DIR_TEMP.mkdir(parents=True)
 
-        for reg_type, reg in REG_LIST:
-            region = f"{reg_type}_{reg}.csv"
-            if not os.path.isfile(TRAIN_DIR.joinpath(region)):
-                continue
-                
-            tdf = pd.read_csv(TRAIN_DIR.joinpath(region))#, dtype=float)#.astype(object).infer_objects()
-            #print(f"before: {tdf.columns}")
-            tdf.rename(columns=alphanumeric, inplace=True) 
-            #print(f"after: {tdf.columns}")
-            
-            if not os.path.isfile(EVAL_DIR.joinpath(region)):
-                continue
-            edf = pd.read_csv(EVAL_DIR.joinpath(region))#, dtype=float)#.astype(object).infer_objects()  
-            log.write(f"imported edf; first 3 rows:\n{edf.head(3)}\n")
-            #print(f"before: {edf.columns}")
-            edf.rename(columns=alphanumeric, inplace=True)
-            ecols = {edf.columns[0]: tdf.columns[0], edf.columns[1]: tdf.columns[1]} 
-            edf.rename(columns=ecols, inplace=True)
-            #print(f"after: {edf.columns}")
-
-            if MONTH:
-                replacements = ps.monthify(tdf.columns)
-                tdf = tdf.rename(columns=replacements)
-                tdf = ps.keep_month(tdf, MONTH)
-            
-            ######################################################
-            ## Dealing with NAs
-            ######################################################
-            # Show how many non-NA's there are in each column
-            log.write(f"Number of non-NA values in tdf by column:\n{tdf.count()}\n")
-            log.write(f"Number of non-NA values in edf by column:\n{edf.count()}\n")
-            # LSF is mostly NA in this region; replace it with 0, appropriate for a costal pixel
-            # Dict of cols with specified NA replacement value
-            bad_cols = {"LSF":0}
-            tdf.fillna(value=bad_cols, inplace=True)#[["LSF"]] = tdf[["LSF"]].fillna(0)
-            edf.fillna(value=bad_cols, inplace=True)#[["LSF"]] = edf[["LSF"]].fillna(0)
-            for col in bad_cols:
-                log.write(f"NA's in '{col}' replaced with {bad_cols[col]}.\n")
-            # Show how many non-NA's there are in each column
-            #log.write(f"Number of non-NA values in tdf by column:\n{tdf.count()}\n")
-            #log.write(f"Number of non-NA values in edf by column:\n{edf.count()}\n")
-            
-            tdf = tdf.dropna()#thresh=4).fillna(0)
-            log.write(f"First 3 rows of tdf:\n{tdf.head(3)}\n")
-            #log.write(f"Number of non-NA values in tdf by column:\n{tdf.count()}\n")
-            edf = edf.dropna()#thresh=4).fillna(0)
-            log.write(f"First 3 rows of edf:\n{edf.head(3)}\n")
-            #log.write(f"Number of non-NA values in edf by column:\n{edf.count()}\n")
-            ############################################
-            
-            trows = tdf.shape[0]
-            if trows:
-                log.write(f"There are {trows} training points in {region}.\n")
-            else:
-                log.write(f"Warning: there are no training points in {region}!\n")
-                continue
-            
-            erows = edf.shape[0]
-            if erows:
-                log.write(f"There are {erows} evaluation points in {region}.\n")
-            else:
-                log.write(f"Warning: there are no evaluation points in {region}!\n")
-                continue
-            
-            if floor(VALIDATE)==1:
-                before = tdf[tdf.columns[:3]]#.dropna() 
-                if VALIDATE>1:
-                    log.write(f"For before.sample, {seed}.\n")
-                    before = before.sample(frac=(VALIDATE - 1), random_state=seed)
-                    tdf.drop(before.index.tolist(), inplace=True)
-                    trows = tdf.shape[0]
-                    if trows:
-                        log.write(f"There are {trows} training points in {region}.\n")
-                    else:
-                        log.write(f"Warning: there are no training points in {region}!\n")
-                        continue
-                brows = before.shape[0]
-                if brows:
-                    log.write(f"There are {brows} validation points in {region}.\n")
-                else:
-                    log.write(f"Warning: there are no validation points in {region}!\n")
-                    continue
-                before_path = SM_BEFORE.joinpath(region)
-                before.to_csv(path_or_buf=before_path, index=False, header=False, na_rep="NA")
-                if BUFFER or SUPER:
-                    log.write("Trimming validation file back down to {region}.\n")
-                    crop_args = [CROP_PATH, before_path, before_path, r]
-                    log.write(f"{crop_args}\n")
-                    bash(crop_args)
-            
-            if USE_PCA:
-                params = pca.get_params(tdf)
-                log.write(f"Performing PCA.\n")
-                #log.write(f"tdf pre-PCA: {tdf.shape}\n{tdf.head(3)}\n")
-                #log.write(f"edf pre-PCA: {edf.shape}\n{edf.head(3)}\n")
-                log.write(f"pre-PCA:\n{params}\n")
-                if len(params) > min(tdf.shape[0], edf.shape[0]):
-                    log.write(f"Error: region {region} skipped! You have {tdf.shape[0]} rows of training data and {edf.shape[0]} rows of evaluation data, but you need at least {len(params)} of each to perform PCA on your params.\n")
-                    continue
-                                
-                tdf, edf, comps = pca.joint_pca(tdf, edf, params)
-                log.write(f"post-PCA:\n{tdf.shape}\n{tdf.head(3)}\n{edf.shape}\n{edf.head(3)}\n{comps}\n")
-                log.write(f"Completed PCA for {region} with these eigenvalues:\n{comps}\n")
-
-                trows = tdf.shape[0]
-                if trows:
-                    log.write(f"There are {trows} training points in {region}.\n")
-                else:
-                    log.write(f"Warning: there are no training points in {region}!\n")
-                    continue
-
-                erows = edf.shape[0]
-                if erows:
-                    log.write(f"There are {erows} evaluation points in {region}.\n")
-                else:
-                    log.write(f"Warning: there are no evaluation points in {region}!\n")
-                    continue
-               
-            tdf.to_csv(path_or_buf=TRAIN_DIR_TEMP.joinpath(region), index=False)
-            edf.to_csv(path_or_buf=EVAL_DIR_TEMP.joinpath(region), index=False)
+        JOB.update({"TRAIN_DIR_TEMP": TRAIN_DIR_TEMP, "EVAL_DIR_TEMP": EVAL_DIR_TEMP})
+        points = for_regions(process_region, JOB, REG_LIST, WORKERS)
+        merge_region_logs(log, LOG_FILE, MONTH, REG_LIST)
+        # Points of the regions kept, returned by the workers
+        MONTH_DICT[MONTH]["points"] = {f"{reg_type}_{reg}": n for (reg_type, reg), n in points.items() if n is not None}
 
         TRAIN_DIR = TRAIN_DIR_TEMP
         EVAL_DIR = EVAL_DIR_TEMP
-        
 
         # Update region list to only include those regions with at least a minimum number of test points
         if (MIN_T_POINTS > -1):
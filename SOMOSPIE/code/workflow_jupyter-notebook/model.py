@@ -3,6 +3,13 @@ from os import listdir
 from utils import *
 from itertools import product as iterprod
 from time import time
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append("./tools")
+sys.path.append("./modeling")
+import telemetry as tm
+import model_runner as runner
 
 
 # This is a wrapper that handles a single call to any of the models
@@ -28,6 +35,8 @@ from time import time
 #         NOTE            An optional output suffix such as __pca in case you are 
 #                         rerunning a model with processed data and need the output
 #                         model file to have a distinguishing name
+#         WORKERS         Number of processes running the model/parameter combinations
+#                         of a region; default 1 runs them one after the other
 #
 #     Every model script should work with .csv files in which
 #         the top row is the header data,
@@ -35,11 +44,60 @@ from time import time
 #         the third column is the sm data,
 #         all other columns are covariates
 
-def model(REGION, TRAIN_DIR, EVAL_DIR, OUT_DIR, MODELS, NOTE):
+def count_rows(csv_file):
+    # Predictions written by the model, without the header
+    if not csv_file.exists():
+        return 0
+    with open(csv_file, "r") as f:
+        return max(0, sum(1 for _ in f) - 1)
 
-    HYPPO_MODEL = pathlib.Path("modeling/hyppo.py").resolve()
-    KNN_MODEL = pathlib.Path("modeling/knn.py").resolve()
-    RF_MODEL = pathlib.Path("modeling/rf.py").resolve()
+
+# Train and eval data of the region being modeled, loaded once by model() and inherited
+# by the forked workers instead of being pickled for every combination
+REGION_DATA = {}
+
+
+# Runs one model/parameter combination of a region in this process, with its own log file
+def run_combo(REGION, MODEL, bash_suf, file_suf, TR, EV, PRED):
+    t0 = time()
+    stage = tm.start("model_run", model=MODEL, region=str(REGION), args=file_suf)
+
+    # Specify paths of output files
+    file_name = MODEL + file_suf
+    PRD = PRED.joinpath(f"{file_name}.csv")
+    LOG = PRED.joinpath(f"{file_name}.log")
+
+    # Open the log file and start writing
+    with open(LOG, "w") as log:
+        log.write(f"t0={t0}\n")
+        log.write(f"Prediction file: {PRD}\n")
+        log.write(f"Log file: {LOG}\n")
+        log.write(f"{REGION} {MODEL}\n")
+        log.write(f"bash_suffix: {bash_suf}\n")
+
+    if MODEL in runner.MODELS:
+        with open(LOG, "a") as log:
+            log.write(f"model_args: {runner.model_args(MODEL, TR, EV, PRD, LOG, bash_suf)}\n")
+        # A failing model only loses its predictions, as when it ran in its own interpreter
+        try:
+            runner.run(MODEL, bash_suf, REGION_DATA, TR, EV, PRD, LOG)
+        except Exception:
+            print(f"{MODEL}{file_suf} failed on {REGION}, see {LOG}")
+            with open(LOG, "a") as log:
+                log.write(traceback.format_exc())
+    else:
+        print(f"Model \"{MODEL}\" unknown!")
+        with open(LOG, "a") as log:
+            log.write(f"Model \"{MODEL}\" unknown!\n")
+
+    t1 = time()
+    stage.finish(inputs=[TR, EV], outputs=[PRD], rows=count_rows(PRD))
+    with open(LOG, "a") as log:
+        log.write(f"t1={t1}\n")
+        log.write(f"t={t1 - t0}\n")
+
+
+def model(REGION, TRAIN_DIR, EVAL_DIR, OUT_DIR, MODELS, NOTE, WORKERS=1):
     
     # If 0 is given instead of a specified region, 
     # create list of all regions in the TRAIN_DIR
@@ -62,6 +120,8 @@ def model(REGION, TRAIN_DIR, EVAL_DIR, OUT_DIR, MODELS, NOTE):
             bash_suffixes = [list(zip(params, ac)) for ac in arg_combos]
             file_suffixes = ["".join([f"{par}{arg}" for par, arg in bashix]) for bashix in bash_suffixes]
             suffixes[MODEL] = list(zip(bash_suffixes, file_suffixes))
+    combos = [(MODEL, bash_suf, file_suf) for MODEL in MODELS for bash_suf, file_suf in suffixes[MODEL]]
+
     for REGION in REGIONS:
         # Specify train and predi files
         TR = TRAIN_DIR.joinpath(REGION)
@@ -72,60 +132,23 @@ def model(REGION, TRAIN_DIR, EVAL_DIR, OUT_DIR, MODELS, NOTE):
         PRED = OUT.joinpath(SUB_PRED)
         if not PRED.is_dir():
             PRED.mkdir(parents=True)
-        
-        for MODEL in MODELS:
-
-            # The following has been extracted outside the REGIONS loop for a one-time creation
-            #paramdict = MODELS[MODEL]
-            #params = paramdict.keys()
-            #argums = paramdict.values()
-            #arg_combos = iterprod(*argums)
-            ## Don't print the following! It exhausts the generator.
-            ###print(f"The possible combinations of arguments are: {list(arg_combos)}")
-            #
-            #for ac in arg_combos:
-            #    file_name = f"{MODEL}"#{NOTE}"
-            #    bash_suffix = []
-            #    for p, a in zip(params, ac):
-            #        file_name += f"{p}{a}"
-            #        bash_suffix.extend([p, a])
-     
-            for bash_suf, file_suf in suffixes[MODEL]:
-                
-                t0 = time()
-                
-                # Specify paths of output files
-                file_name = MODEL + file_suf
-                PRD = PRED.joinpath(f"{file_name}.csv")
-                LOG = PRED.joinpath(f"{file_name}.log")
-                
-                # Open the log file and start writing
-                with open(LOG, "w") as log:
-                    log.write(f"t0={t0}\n")
-                    log.write(f"Prediction file: {PRD}\n")
-                    log.write(f"Log file: {LOG}\n")
-                    log.write(f"{REGION} {MODEL}\n")
-                    log.write(f"bash_suffix: {bash_suf}\n")
-
-                if (MODEL in ["HYPPO", "KNN", "SBM"]):
-                    bash_args = [HYPPO_MODEL, "-t", TR, "-e", EV, "-m", MODEL, "-o", PRD, "-l", LOG]
-                elif (MODEL == "1NN"):
-                    bash_args = [HYPPO_MODEL, "-t", TR, "-e", EV, "-m", "KNN", "-o", PRD, "-s", 0, "-S", "1,2", "-v", 2, "-k", 1, "-l", LOG]
-                elif (MODEL == "KKNN"):
-                    bash_args = [KNN_MODEL, "-t", TR, "-e", EV, "-o", PRD, "-l", LOG]
-                elif (MODEL == "RF"):
-                    bash_args = [RF_MODEL, "-t", TR, "-e", EV, "-o", PRD, "-l", LOG]
-                else:
-                    print(f"Model \"{MODEL}\" unknown!")
-                    bash_args = ["echo", f"Model \"{MODEL}\" unknown!"]
-
-                for bashix in bash_suf:
-                    bash_args.extend(bashix)
-                with open(LOG, "a") as log:
-                    log.write(f"bash_args: {bash_args}\n")
-                bash(bash_args)
-                
-                t1 = time()
-                with open(LOG, "a") as log:
-                    log.write(f"t1={t1}\n")
-                    log.write(f"t={t1 - t0}\n")
+
+        # The train and eval files are read once for all the combinations of the region
+        REGION_DATA.clear()
+        try:
+            REGION_DATA.update(runner.load_region(TR, EV))
+        except (OSError, ValueError) as e:
+            print(f"Skipping {REGION}: {e}")
+            continue
+
+        if WORKERS > 1 and len(combos) > 1:
+            # Forked after loading, so the workers share the region data
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=min(WORKERS, len(combos)), mp_context=context) as executor:
+                futures = [executor.submit(run_combo, REGION, MODEL, bash_suf, file_suf, TR, EV, PRED)
+                           for MODEL, bash_suf, file_suf in combos]
+                for future in futures:
+                    future.result()
+        else:
+            for MODEL, bash_suf, file_suf in combos:
+                run_combo(REGION, MODEL, bash_suf, file_suf, TR, EV, PRED)
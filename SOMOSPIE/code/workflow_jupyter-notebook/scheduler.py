@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Resource-aware scheduler for the task graph of SOMOSPIE_wrapper.py.
+#
+# Each Task names the tasks it depends on and hints the cores and memory (MB) it needs. Tasks run in
+# a pool of forked processes when their dependencies are done and the free cores and memory fit
+# their hints; a task with more cores than the node is given the whole node. SOMOSPIE_CORES,
+# OMP_NUM_THREADS and LOKY_MAX_CPU_COUNT are set to the cores of the task, so the models using
+# n_jobs=-1 stay within them.
+#
+# A task may add tasks once it is done (then), e.g. the models of the regions a curation kept.
+# The status and result of every task are saved to a JSON state file after each task: a run
+# interrupted and started again with the same state file skips the tasks done, and adds the tasks
+# that depend on their results again.
+#
+# Usage:
+#     scheduler = Scheduler("job.tasks.json", cores=16)
+#     scheduler.add(Task("curate-2017-4", curate_month, (2017, 4), cpus=4, then=add_models))
+#     scheduler.run()
+
+import json
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def node_cores():
+    return len(os.sched_getaffinity(0))
+
+
+def node_memory_mb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20
+
+
+def run_task(func, args, cpus):
+    # Runs in the worker: the libraries started by the task use its cores only
+    for var in ["SOMOSPIE_CORES", "OMP_NUM_THREADS", "LOKY_MAX_CPU_COUNT"]:
+        os.environ[var] = str(cpus)
+    return func(*args)
+
+
+class Task:
+
+    def __init__(self, name, func, args=(), deps=(), cpus=1, mem_mb=0, then=None):
+        # then(result) returns the tasks to add once this one is done
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.mem_mb = mem_mb
+        self.then = then
+
+
+class Scheduler:
+
+    def __init__(self, state_file, cores=None, mem_mb=None):
+        self.state_file = state_file
+        self.cores = cores or node_cores()
+        self.mem_mb = mem_mb or 0.8 * node_memory_mb()
+        self.tasks = {}
+        self.expanded = set()
+        self.state = {}
+        if os.path.isfile(state_file):
+            with open(state_file, "r") as f:
+                # Only the tasks done are kept, the failed ones run again
+                self.state = {name: s for name, s in json.load(f).items() if s.get("status") == "done"}
+
+    def add(self, task):
+        if task.name not in self.tasks:
+            self.tasks[task.name] = task
+
+    def status(self, name):
+        return self.state.get(name, {}).get("status", "pending")
+
+    def save(self):
+        temp = f"{self.state_file}.{os.getpid()}"
+        with open(temp, "w") as f:
+            json.dump(self.state, f, indent=1, default=str)
+        os.replace(temp, self.state_file)
+
+    def finish(self, task, status, result=None):
+        # Stored as JSON, then(result) gets the same result in this run and when resuming
+        result = json.loads(json.dumps(result, default=str))
+        self.state[task.name] = {"status": status, "result": result}
+        self.save()
+        if status == "done":
+            self.expand(task)
+
+    def expand(self, task):
+        # Tasks added by a task done, in this run or in the run the state file comes from
+        if task.name in self.expanded:
+            return
+        self.expanded.add(task.name)
+        if task.then is not None:
+            for new_task in task.then(self.state[task.name]["result"]) or []:
+                self.add(new_task)
+
+    def run(self):
+        running = {}
+        free_cores, free_mem = self.cores, self.mem_mb
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=self.cores, mp_context=context) as executor:
+            while True:
+                for task in list(self.tasks.values()):
+                    if self.status(task.name) == "done":
+                        self.expand(task)
+
+                submitted = [task.name for task, cpus in running.values()]
+                for task in list(self.tasks.values()):
+                    if self.status(task.name) in ["done", "failed", "skipped"] or task.name in submitted:
+                        continue
+                    deps = [self.status(dep) for dep in task.deps]
+                    if any(status in ["failed", "skipped"] for status in deps):
+                        print(f"Skipping {task.name}: a dependency failed.")
+                        self.finish(task, "skipped")
+                        continue
+                    if any(status != "done" for status in deps):
+                        continue
+                    cpus = min(task.cpus, self.cores)
+                    # A task larger than the free memory still runs when nothing else does
+                    if cpus > free_cores or (task.mem_mb > free_mem and running):
+                        continue
+                    print(f"Running {task.name} on {cpus} cores.")
+                    running[executor.submit(run_task, task.func, task.args, cpus)] = (task, cpus)
+                    free_cores -= cpus
+                    free_mem -= task.mem_mb
+
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, cpus = running.pop(future)
+                    free_cores += cpus
+                    free_mem += task.mem_mb
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Task {task.name} failed: {e!r}")
+                        self.finish(task, "failed", repr(e))
+                        continue
+                    self.finish(task, "done", result)
+
+        pending = [name for name in self.tasks if self.status(name) != "done"]
+        if pending:
+            print(f"{len(pending)} tasks not done: {pending}")
+        return self.state
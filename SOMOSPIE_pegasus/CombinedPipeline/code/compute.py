@@ -4,6 +4,9 @@ import argparse
 import os
 import numpy as np
 from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
 
 
 def get_parser():
@@ -20,18 +23,20 @@ def from_args_to_vars (args):
 
 
 def compute_geotiled(input_file, aspect_file, hillshading_file, slope_file):
+    # Parameter tiles are intermediate files, they are merged later on, so no overviews
+    creation_options = cp.creation_options(gdal.GDT_Float32, profile='tiled')
     # Slope
-    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'])
+    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=creation_options)
     gdal.DEMProcessing(slope_file, input_file, processing='slope', options=dem_options)
     # Aspect
-    dem_options = gdal.DEMProcessingOptions(zeroForFlat=True, format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'])
+    dem_options = gdal.DEMProcessingOptions(zeroForFlat=True, format='GTiff', creationOptions=creation_options)
     gdal.DEMProcessing(aspect_file, input_file, processing='aspect', options=dem_options)
     # Hillshading
-    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'])
+    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=cp.creation_options(gdal.GDT_Byte, profile='tiled'))
     gdal.DEMProcessing('hill.tif', input_file, processing='hillshade', options=dem_options)
 
     # Change datatype of hillshading to the same as the other parameters and nodata value
-    translate_options = gdal.TranslateOptions(creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS'], outputType=gdal.GDT_Float32, callback=gdal.TermProgress_nocb)
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(gdal.GDT_Float32, profile='tiled'), outputType=gdal.GDT_Float32, callback=gdal.TermProgress_nocb)
     gdal.Translate(hillshading_file, 'hill.tif', options=translate_options)
     os.remove('hill.tif')
 
@@ -39,5 +44,8 @@ if __name__ == "__main__":
     parser = get_parser()
     args = parser.parse_args()
     input_file, aspect_file, hillshading_file, slope_file = from_args_to_vars(args)
+    grt.configure('dem', block_size=grt.get_block_size(input_file))
+    stage = tm.start('compute')
     print("Tile (", input_file, ")", "Size is :", os.path.getsize(input_file), " bytes") # For debugging
-    compute_geotiled(input_file, aspect_file, hillshading_file, slope_file)
\ No newline at end of file
+    compute_geotiled(input_file, aspect_file, hillshading_file, slope_file)
+    stage.finish(inputs=[input_file], outputs=[aspect_file, hillshading_file, slope_file])
@@ -4,6 +4,9 @@ import argparse
 import os
 import math
 from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
 
 
 def get_parser():
@@ -27,8 +30,9 @@ def from_args_to_vars (args):
 
 def crop_pixels(input_file, output_file, window):
     # Window to crop by [left_x, top_y, width, height]
+    # Tiles are intermediate files, so no overviews
     translate_options = gdal.TranslateOptions(srcWin=window,
-                                              creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'],
+                                              **cp.translate_kwargs(cp.get_data_type(input_file), profile='tiled'),
                                               callback=gdal.TermProgress_nocb)
     gdal.Translate(output_file, input_file, options=translate_options)
 
@@ -78,4 +82,7 @@ if __name__ == "__main__":
     parser=get_parser()
     args = parser.parse_args()
     mosaic, out_file, n_tiles, idx_x, idx_y = from_args_to_vars(args)
+    grt.configure('translate', block_size=grt.get_block_size(mosaic))
+    stage = tm.start('crop', tile=[idx_x, idx_y])
     crop_into_tiles(mosaic, out_file, n_tiles, idx_x, idx_y)
+    stage.finish(outputs=[out_file])
@@ -3,33 +3,65 @@
 import argparse
 import os
 import glob
+import json
 from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
 
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Arguments and data files to merge multiple tiles into a mosaic.')
     parser.add_argument('-i', "--infiles", help='Path to input tiles.', nargs='+')
-    parser.add_argument('-o', "--outfile", help='Mosaic built from input tiles.')
+    parser.add_argument('-o', "--outfile", help='Mosaic built from input tiles, if it is a .vrt the mosaic is not materialized.')
+    parser.add_argument('-r', "--report", help='Json file with the I/O bytes saved by a .vrt mosaic.', default=None)
     return parser
 
 #Translate from namespaces to Python variables 
 def from_args_to_vars (args):	
     input_files = args.infiles
     output_file = args.outfile
-    return input_files, output_file
+    report_file = args.report
+    return input_files, output_file, report_file
 
 
 def merge_tiles(input_files, output_file):
     # input_files: list of .tif files to merge
+    # If output_file is a .vrt the mosaic stays lazy: GDAL reads the tiles when the mosaic is reprojected
+    if output_file.endswith('.vrt'):
+        vrt = gdal.BuildVRT(output_file, input_files)
+        vrt = None  # closes file
+        return
+
     vrt = gdal.BuildVRT('merged.vrt', input_files)
-    translate_options = gdal.TranslateOptions(creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS'], callback=gdal.TermProgress_nocb)
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(cp.get_data_type(vrt)), callback=gdal.TermProgress_nocb)
     gdal.Translate(output_file, vrt, options=translate_options)
     vrt = None  # closes file
     os.remove('merged.vrt')
 
 
+def mosaic_io(input_files, output_file):
+    # Bytes not written (and not read back by the reprojection) because the mosaic is a VRT.
+    # The compressed mosaic would have about the size of the compressed tiles.
+    tiles_bytes = sum(os.path.getsize(f) for f in input_files)
+    lazy = output_file.endswith('.vrt')
+    mosaic_bytes = os.path.getsize(output_file)
+    return {'tiles': len(input_files), 'tiles_bytes': tiles_bytes, 'mosaic_bytes': mosaic_bytes,
+            'mosaic_bytes_not_written': tiles_bytes if lazy else 0,
+            'io_bytes_saved': 2 * tiles_bytes if lazy else 0}
+
+
 if __name__ == "__main__":
     parser=get_parser()
     args = parser.parse_args()
-    input_files, output_file = from_args_to_vars(args)
-    merge_tiles(input_files, output_file)
\ No newline at end of file
+    input_files, output_file, report_file = from_args_to_vars(args)
+    grt.configure('translate')
+    stage = tm.start('merge')
+    merge_tiles(input_files, output_file)
+
+    io = mosaic_io(input_files, output_file)
+    print("Mosaic I/O:", io)
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump(io, f, indent=2)
+    stage.finish(inputs=input_files, outputs=[output_file])
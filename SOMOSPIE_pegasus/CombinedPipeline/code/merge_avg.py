@@ -6,19 +6,24 @@ import glob
 from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
 import subprocess
 import numpy as np
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
 
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Arguments and data files to merge multiple tiles into a mosaic.')
     parser.add_argument('-i', "--infiles", help='Path to input tiles.', nargs='+')
     parser.add_argument('-o', "--outfile", help='Mosaic built from input tiles.')
+    parser.add_argument('-k', "--keep", help='If y, the mosaic keeps the projection of the tiles instead of being reprojected to EPSG:4326.', default='n')
     return parser
 
 #Translate from namespaces to Python variables 
 def from_args_to_vars (args):	
     input_files = args.infiles
     output_file = args.outfile
-    return input_files, output_file
+    keep = args.keep
+    return input_files, output_file, keep
 
 def bash(argv):
     arg_seq = [str(arg) for arg in argv]
@@ -32,7 +37,7 @@ def bash(argv):
             ' '.join(arg_seq), proc.returncode, stdout.rstrip(), stderr.rstrip()))
 
 
-def merge_avg(input_files, output_file):
+def merge_avg(input_files, output_file, profile='tiled'):
     vrt = gdal.BuildVRT('merged.vrt', input_files)
     vrt = None  # closes file
 
@@ -64,25 +69,34 @@ def average(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize,raster_ysize,
     with open('merged.vrt', 'w') as f:
         f.write(contents)
 
-    cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-co', 'TILED=YES', '-co', 'BIGTIFF=YES', '--config', 'GDAL_VRT_ENABLE_PYTHON', 'YES', 'merged.vrt', output_file]
+    # When the average is reprojected afterwards, it is written without overviews
+    cmd = ['gdal_translate'] + cp.translate_args(gdal.GDT_Float32, profile) + ['--config', 'GDAL_VRT_ENABLE_PYTHON', 'YES', 'merged.vrt', output_file]
     bash(cmd)
     os.remove('merged.vrt')
 
 
 def reproject(input_file, output_file, projection):
     # Projection can be EPSG:4326, .... or the path to a wkt file
-    warp_options = gdal.WarpOptions(dstSRS=projection, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS'], multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'], dstNodata=np.nan, callback=gdal.TermProgress_nocb)
+    warp_options = gdal.WarpOptions(dstSRS=projection, creationOptions=cp.creation_options(cp.get_data_type(input_file)), multithread=True, warpOptions=['NUM_THREADS={}'.format(grt.num_threads())], warpMemoryLimit=grt.warp_memory(), dstNodata=np.nan, callback=gdal.TermProgress_nocb)
     warp = gdal.Warp(output_file, input_file, options=warp_options)
     warp = None  # Closes the files
+    cp.finalize(output_file)
 
 
 if __name__ == "__main__":	
     parser=get_parser()
     args = parser.parse_args()
-    input_files, output_file = from_args_to_vars(args)
+    input_files, output_file, keep = from_args_to_vars(args)
+    grt.configure('warp')
+    stage = tm.start('merge_avg', tiles=len(input_files))
 
     for input_file in input_files:
         print("Tile (", input_file, ")", "Size is :", os.path.getsize(input_file), " bytes")
 
-    merge_avg(input_files, output_file)
-    reproject(output_file, output_file, 'EPSG:4326')
+    if keep == 'y':
+        # The terrain parameters are warped later, straight to the grid where they are used
+        merge_avg(input_files, output_file, profile=None)
+    else:
+        merge_avg(input_files, output_file)
+        reproject(output_file, output_file, 'EPSG:4326')
+    stage.finish(inputs=input_files, outputs=[output_file])
@@ -4,37 +4,56 @@ import argparse
 import os
 import numpy as np
 from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
+import chunked_warp
 
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Arguments and data files for executing Nearest Neighbors Regression.')
-    parser.add_argument('-i', "--infile", help='Input file (DEM).')
+    parser.add_argument('-i', "--infile", help='Input file (DEM), can be a .vrt mosaic or a list of tiles.', nargs='+')
     parser.add_argument('-o', "--outfile", help='Output file (reprojected DEM).')
     parser.add_argument('-p', "--projection", help='Projection, can be an EPSG identifier such as EPSG:4326 or the path to a wkt file')
     parser.add_argument('-n', "--nodata", help='If y, nodata value will be set to np.nan.', default='n')
+    parser.add_argument('-w', "--workers", help='If more than 1, the output is warped in chunks by this number of processes (resumable).', type=int, default=1)
     return parser 
 
 #Translate from namespaces to Python variables 
 def from_args_to_vars (args):	
-    input_file = args.infile
+    # A list of tiles is warped directly, as a lazy mosaic
+    input_file = args.infile[0] if len(args.infile) == 1 else args.infile
     output_file = args.outfile
     projection = args.projection
     nodata = args.nodata
-    return input_file, output_file, projection, nodata
+    workers = args.workers
+    return input_file, output_file, projection, nodata, workers
 
 
 def reproject(input_file, output_file, projection, nodata='n'):
     # Projection can be EPSG:4326, .... or the path to a wkt file
+    creation_options = cp.creation_options(cp.get_data_type(input_file))
     if nodata == 'y':
-        warp_options = gdal.WarpOptions(dstSRS=projection, dstNodata=np.nan, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS'], multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'], callback=gdal.TermProgress_nocb)
+        warp_options = gdal.WarpOptions(dstSRS=projection, dstNodata=np.nan, creationOptions=creation_options, multithread=True, warpOptions=['NUM_THREADS={}'.format(grt.num_threads())], warpMemoryLimit=grt.warp_memory(), callback=gdal.TermProgress_nocb)
     else:
-        warp_options = gdal.WarpOptions(dstSRS=projection, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS'], callback=gdal.TermProgress_nocb, multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'])
+        warp_options = gdal.WarpOptions(dstSRS=projection, creationOptions=creation_options, callback=gdal.TermProgress_nocb, multithread=True, warpOptions=['NUM_THREADS={}'.format(grt.num_threads())], warpMemoryLimit=grt.warp_memory())
     warp = gdal.Warp(output_file, input_file, options=warp_options)
     warp = None  # Closes the files
+    cp.finalize(output_file)
 
 
 if __name__ == "__main__":	
     parser=get_parser()
     args = parser.parse_args()
-    input_file, output_file, projection, nodata = from_args_to_vars(args)
-    reproject(input_file, output_file, projection, nodata)
\ No newline at end of file
+    input_file, output_file, projection, nodata, workers = from_args_to_vars(args)
+    grt.configure('warp', workers=workers)
+    stage = tm.start('reproject', workers=workers)
+    if isinstance(input_file, list):
+        # Without the lazy mosaic, a compressed mosaic of about the size of the tiles would be written and read back
+        tiles_bytes = sum(os.path.getsize(f) for f in input_file)
+        print("Lazy mosaic of", len(input_file), "tiles:", tiles_bytes, "bytes, about", 2 * tiles_bytes, "bytes of I/O saved")
+    if workers > 1:
+        chunked_warp.chunked_reproject(input_file, output_file, projection, nodata, workers)
+    else:
+        reproject(input_file, output_file, projection, nodata)
+    stage.finish(inputs=input_file if isinstance(input_file, list) else [input_file], outputs=[output_file])
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Reprojection planner: terrain parameters are warped once, straight from their native projection
+# to the grid where they are used (the satellite grid for training, the evaluation grid for tiles),
+# instead of going through intermediate full resolution EPSG:4326 mosaics.
+#
+# A grid is a dictionary {'srs': wkt, 'bounds': [xmin, ymin, xmax, ymax], 'xres': float, 'yres': float,
+# 'width': int, 'height': int} and can be saved as json so every job warps to exactly the same pixels.
+#
+# Command-line example (evaluation grid for a region, at the native resolution of the DEM):
+# ./reproject_plan.py -i elevation_m.tif -s LA_County_Boundary.zip -p EPSG:4326 -o eval_grid.json
+
+import argparse
+import functools
+import json
+import math
+import numpy as np
+from osgeo import gdal, ogr, osr # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Arguments and data files to plan the target grid of a reprojection.')
+    parser.add_argument('-i', "--infile", help='Raster to reproject (its resolution is used when no reference is given).')
+    parser.add_argument('-r', "--reference", help='Raster whose grid is used as target (e.g. satellite soil moisture).', default=None)
+    parser.add_argument('-s', "--shpfile", help='Shp file (or zip) with the region, the grid is restricted to its extent.', default=None)
+    parser.add_argument('-p', "--projection", help='Target projection, EPSG identifier or path to a wkt file.', default='EPSG:4326')
+    parser.add_argument('-o', "--outfile", help='Json file with the grid.')
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    return args.infile, args.reference, args.shpfile, args.projection, args.outfile
+
+
+@functools.lru_cache(maxsize=None)
+def get_srs(projection):
+    # projection: EPSG identifier, path to a wkt file or wkt string
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(projection)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(src_wkt, dst_wkt):
+    # Coordinate transformations are expensive to build, they are shared by every call in the process
+    return osr.CoordinateTransformation(get_srs(src_wkt), get_srs(dst_wkt))
+
+
+def transform_bounds(bounds, src_wkt, dst_wkt, densify=21):
+    # Transform [xmin, ymin, xmax, ymax] sampling points along the edges, curved edges included
+    if get_srs(src_wkt).IsSame(get_srs(dst_wkt)):
+        return list(bounds)
+    xmin, ymin, xmax, ymax = bounds
+    xs = np.linspace(xmin, xmax, densify)
+    ys = np.linspace(ymin, ymax, densify)
+    points = [(x, ymin) for x in xs] + [(x, ymax) for x in xs] + [(xmin, y) for y in ys] + [(xmax, y) for y in ys]
+    transformed = np.array(get_transformer(src_wkt, dst_wkt).TransformPoints(points))[:, :2]
+    transformed = transformed[np.isfinite(transformed).all(axis=1)]
+    return [transformed[:, 0].min(), transformed[:, 1].min(), transformed[:, 0].max(), transformed[:, 1].max()]
+
+
+def make_grid(srs_wkt, bounds, xres, yres, origin=(0.0, 0.0)):
+    # Bounds are snapped outwards to the pixel lattice that goes through origin
+    xres, yres = abs(xres), abs(yres)
+    xmin = origin[0] + math.floor((bounds[0] - origin[0]) / xres) * xres
+    xmax = origin[0] + math.ceil((bounds[2] - origin[0]) / xres) * xres
+    ymin = origin[1] + math.floor((bounds[1] - origin[1]) / yres) * yres
+    ymax = origin[1] + math.ceil((bounds[3] - origin[1]) / yres) * yres
+    return {'srs': srs_wkt, 'bounds': [xmin, ymin, xmax, ymax], 'xres': xres, 'yres': yres,
+            'width': int(round((xmax - xmin) / xres)), 'height': int(round((ymax - ymin) / yres))}
+
+
+def grid_from_raster(raster):
+    # Grid of an existing raster, e.g. the satellite soil moisture file
+    ds = gdal.Open(str(raster), 0)
+    xmin, xres, _, ymax, _, yres = ds.GetGeoTransform()
+    xmax = xmin + xres * ds.RasterXSize
+    ymin = ymax + yres * ds.RasterYSize
+    grid = {'srs': ds.GetProjection(), 'bounds': [xmin, ymin, xmax, ymax], 'xres': abs(xres), 'yres': abs(yres),
+            'width': ds.RasterXSize, 'height': ds.RasterYSize}
+    ds = None
+    return grid
+
+
+def subgrid(grid, bounds):
+    # Part of grid covering bounds (given in the grid projection), aligned with the pixels of grid
+    xmin, ymin, xmax, ymax = grid['bounds']
+    bounds = [max(bounds[0], xmin), max(bounds[1], ymin), min(bounds[2], xmax), min(bounds[3], ymax)]
+    return make_grid(grid['srs'], bounds, grid['xres'], grid['yres'], origin=(xmin, ymax))
+
+
+def tile_window(grid, n_tiles, idx_x, idx_y):
+    # Same windows [col, row, ncols, nrows] as crop_tile in generate_eval.py
+    x_win_size = int(math.ceil(grid['width'] / n_tiles))
+    y_win_size = int(math.ceil(grid['height'] / n_tiles))
+    col = range(0, grid['width'], x_win_size)[idx_x]
+    row = range(0, grid['height'], y_win_size)[idx_y]
+    return [col, row, min(x_win_size, grid['width'] - col), min(y_win_size, grid['height'] - row)]
+
+
+def tile_grid(grid, n_tiles, idx_x, idx_y):
+    # Grid of a tile, so a tile can be warped without warping the whole region
+    col, row, ncols, nrows = tile_window(grid, n_tiles, idx_x, idx_y)
+    xmin = grid['bounds'][0] + col * grid['xres']
+    ymax = grid['bounds'][3] - row * grid['yres']
+    return {'srs': grid['srs'], 'bounds': [xmin, ymax - nrows * grid['yres'], xmin + ncols * grid['xres'], ymax],
+            'xres': grid['xres'], 'yres': grid['yres'], 'width': ncols, 'height': nrows}
+
+
+@functools.lru_cache(maxsize=None)
+def suggested_resolution(raster, projection):
+    # Resolution gdalwarp would choose to keep the detail of raster in the target projection.
+    # The warped VRT is only a description, no pixel is processed.
+    vrt = gdal.Warp('', raster, options=gdal.WarpOptions(format='VRT', dstSRS=projection))
+    _, xres, _, _, _, yres = vrt.GetGeoTransform()
+    vrt = None
+    return abs(xres), abs(yres)
+
+
+def get_shp_extent(shp_file, dst_wkt):
+    ds = ogr.Open(str(shp_file))
+    layer = ds.GetLayer()
+    xmin, xmax, ymin, ymax = layer.GetExtent()
+    src_srs = layer.GetSpatialRef()
+    src_wkt = src_srs.ExportToWkt() if src_srs is not None else get_srs('EPSG:4326').ExportToWkt()
+    ds = None
+    return transform_bounds([xmin, ymin, xmax, ymax], src_wkt, dst_wkt)
+
+
+def raster_extent(raster, dst_wkt):
+    grid = grid_from_raster(raster)
+    return transform_bounds(grid['bounds'], grid['srs'], dst_wkt)
+
+
+def plan_grid(input_file, reference=None, shp_file=None, projection='EPSG:4326'):
+    if reference is not None:
+        # Target is the grid of the reference raster, restricted to the region
+        grid = grid_from_raster(reference)
+        if shp_file is not None:
+            grid = subgrid(grid, get_shp_extent(shp_file, grid['srs']))
+        return grid
+
+    # Target keeps the native detail of the input, in the new projection
+    dst_wkt = get_srs(projection).ExportToWkt()
+    xres, yres = suggested_resolution(str(input_file), projection)
+    bounds = raster_extent(input_file, dst_wkt)
+    if shp_file is not None:
+        shp_bounds = get_shp_extent(shp_file, dst_wkt)
+        bounds = [max(bounds[0], shp_bounds[0]), max(bounds[1], shp_bounds[1]),
+                  min(bounds[2], shp_bounds[2]), min(bounds[3], shp_bounds[3])]
+    return make_grid(dst_wkt, bounds, xres, yres)
+
+
+def save_grid(grid, output_file):
+    with open(output_file, 'w') as f:
+        json.dump(grid, f, indent=2)
+
+
+def load_grid(grid_file):
+    with open(grid_file, 'r') as f:
+        return json.load(f)
+
+
+def warp_to_grid(input_files, output_file, grid, shp_file=None, resampling='bilinear', profile=None, fmt='GTiff'):
+    # Single warp from the native projection of input_files to grid, cropped to the region if shp_file is given
+    warp_options = gdal.WarpOptions(format=fmt, dstSRS=grid['srs'], outputBounds=grid['bounds'],
+                                    width=grid['width'], height=grid['height'], resampleAlg=resampling,
+                                    cutlineDSName=shp_file, dstNodata=np.nan,
+                                    creationOptions=cp.creation_options(gdal.GDT_Float32, profile) if fmt == 'GTiff' else None,
+                                    outputType=gdal.GDT_Float32, multithread=True, warpOptions=['NUM_THREADS={}'.format(grt.num_threads())], warpMemoryLimit=grt.warp_memory(),
+                                    callback=gdal.TermProgress_nocb)
+    warp = gdal.Warp(output_file, input_files, options=warp_options)
+    warp = None  # Closes the files
+    if fmt == 'GTiff':
+        cp.finalize(output_file, profile)
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    input_file, reference, shp_file, projection, output_file = from_args_to_vars(args)
+    grt.configure()
+    stage = tm.start('reproject_plan')
+    grid = plan_grid(input_file, reference, shp_file, projection)
+    print("Grid:", {k: v for k, v in grid.items() if k != 'srs'})
+    save_grid(grid, output_file)
+    stage.finish(pixels=grid['width'] * grid['height'])
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Stage telemetry shared by the entry points of SOMOSPIE.
+#
+# Each stage records its wall time, cpu time (the process and the subprocesses it waited for), peak RSS,
+# bytes read and written and the pixels/rows it processed, as one JSON line appended to the file in
+# SOMOSPIE_TELEMETRY (telemetry.jsonl in the working directory by default, 'off' disables it). The line
+# is also printed with the prefix "[telemetry]", so it ends up in the Pegasus and local executor job logs.
+# SOMOSPIE_RUN_ID groups the stages of a run. telemetry_report.py aggregates them.
+#
+# Usage:
+#     stage = tm.start('reproject', tiles=4)
+#     ...
+#     stage.finish(inputs=[input_file], outputs=[output_file])
+# or
+#     with tm.stage('curate', month=4) as stage:
+#         ...
+#         stage.add(rows=len(df))
+#         stage.files(outputs=[csv_file])
+
+import json
+import os
+import resource
+import socket
+import time
+
+PREFIX = '[telemetry]'
+
+
+def telemetry_file():
+    return os.environ.get('SOMOSPIE_TELEMETRY', 'telemetry.jsonl')
+
+
+def run_id():
+    return os.environ.get('SOMOSPIE_RUN_ID', '')
+
+
+def _io_counters():
+    # Bytes read and written by the process, through any file (linux only)
+    counters = {'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def _cpu_times():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime
+
+
+def peak_rss_mb():
+    # Peak of the process so far, or of the largest subprocess it waited for (ru_maxrss is in KB on linux)
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def file_bytes(paths):
+    return sum(os.path.getsize(p) for p in map(str, paths) if os.path.isfile(p))
+
+
+def raster_pixels(paths):
+    # Pixels of every band of the rasters, the GDAL stages count their throughput with it
+    from osgeo import gdal
+    pixels = 0
+    for path in map(str, paths):
+        ds = gdal.Open(path, 0)
+        if ds is not None:
+            pixels += ds.RasterXSize * ds.RasterYSize * ds.RasterCount
+        ds = None
+    return pixels
+
+
+def emit(record):
+    line = json.dumps(record, default=str)
+    print(PREFIX, line, flush=True)
+    output = telemetry_file()
+    if output and output != 'off':
+        with open(output, 'a') as f:
+            f.write(line + '\n')
+
+
+class Stage:
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.counts = {'pixels': 0, 'rows': 0}
+        self.inputs = []
+        self.outputs = []
+
+    def start(self):
+        self.t0 = time.time()
+        self.cpu0 = _cpu_times()
+        self.io0 = _io_counters()
+        return self
+
+    def add(self, pixels=0, rows=0):
+        self.counts['pixels'] += int(pixels)
+        self.counts['rows'] += int(rows)
+
+    def files(self, inputs=(), outputs=()):
+        self.inputs.extend(inputs)
+        self.outputs.extend(outputs)
+
+    def finish(self, inputs=(), outputs=(), pixels=None, rows=None, status='ok', **fields):
+        # inputs/outputs: files of the stage, their sizes are the bytes read/written. Without files the
+        # process counters are used. The pixels of the output rasters are counted when not given.
+        self.files(inputs, outputs)
+        inputs, outputs = self.inputs, self.outputs
+        t1 = time.time()
+        cpu1 = _cpu_times()
+        io1 = _io_counters()
+        if pixels is None and outputs:
+            try:
+                pixels = raster_pixels([p for p in outputs if str(p).endswith(('.tif', '.vrt'))])
+            except ImportError:
+                pixels = 0
+        self.add(pixels or 0, rows or 0)
+
+        record = {
+            'run': run_id(),
+            'stage': self.name,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'start': self.t0,
+            'end': t1,
+            'wall': t1 - self.t0,
+            'user': cpu1[0] - self.cpu0[0],
+            'sys': cpu1[1] - self.cpu0[1],
+            'cpu': (cpu1[0] - self.cpu0[0]) + (cpu1[1] - self.cpu0[1]),
+            'peak_rss_mb': peak_rss_mb(),
+            'bytes_read': file_bytes(inputs) if inputs else io1['rchar'] - self.io0['rchar'],
+            'bytes_written': file_bytes(outputs) if outputs else io1['wchar'] - self.io0['wchar'],
+            'pixels': self.counts['pixels'],
+            'rows': self.counts['rows'],
+            'status': status,
+        }
+        record.update(self.fields)
+        record.update(fields)
+        emit(record)
+        return record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(status='ok' if exc_type is None else 'failed')
+        return False
+
+
+def start(name, **fields):
+    return Stage(name, **fields).start()
+
+
+def stage(name, **fields):
+    return Stage(name, **fields)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Resamples and crops the terrain parameters to the soil moisture grid once, for the 12 monthly training
+# files: the result is a stack with one band per parameter on the satellite grid restricted to the region.
+# generate_train.py -t then only warps the band of its month and references the stack from a VRT.
+#
+# Command-line example:
+# ./terrain_stack.py -i 01.tif -f aspect.tif elevation_m.tif hillshading.tif slope.tif -p aspect elevation hillshading slope -s LA_County_Boundary.zip -o terrain_stack.tif
+
+import argparse
+import glob
+import os
+import zipfile
+from pathlib import Path
+from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
+import reproject_plan as pl
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Arguments and data files to resample the terrain parameters to the soil moisture grid once.')
+    parser.add_argument('-i', "--infile", help='Satellite soil moisture GeoTIF file, any month (only its grid is used).')
+    parser.add_argument('-f', "--paramfiles", help='Terrain parameters GeoTIF files.', nargs='+')
+    parser.add_argument('-p', "--params", help='Terrain parameter identifiers, used as band names.', nargs='+')
+    parser.add_argument('-s', "--shpfile", help='Shp file to crop into region, in zip.')
+    parser.add_argument('-r', "--resampling", help='Resampling used to warp the terrain parameters to the satellite grid.', default='near')
+    parser.add_argument('-o', "--outfile", help='Stack of the terrain parameters on the satellite grid.')
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    return args.infile, args.paramfiles, args.params, args.shpfile, args.resampling, args.outfile
+
+
+def get_shp(zip_file):
+    Path('shp_file').mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        zip_ref.extractall('./shp_file')
+
+    shp_file = glob.glob('./shp_file/*.shp')[0]
+    return shp_file
+
+
+def terrain_stack(satellite_file, parameter_files, parameter_names, shp_file, output_file, resampling='near'):
+    grid = pl.plan_grid(satellite_file, reference=satellite_file, shp_file=shp_file)
+    warped_files = []
+    for input_file in parameter_files:
+        warped_file = 'terrain_{}'.format(os.path.basename(input_file))
+        pl.warp_to_grid(input_file, warped_file, grid, shp_file, resampling=resampling, profile='tiled')
+        warped_files.append(warped_file)
+
+    vrt = gdal.BuildVRT('terrain.vrt', warped_files, options=gdal.BuildVRTOptions(separate=True))
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(gdal.GDT_Float32, profile='tiled'), callback=gdal.TermProgress_nocb)
+    gdal.Translate(output_file, vrt, options=translate_options)
+    vrt = None
+    os.remove('terrain.vrt')
+    for warped_file in warped_files:
+        os.remove(warped_file)
+
+    ds = gdal.Open(output_file, 1)
+    for i, name in enumerate(parameter_names):
+        ds.GetRasterBand(i + 1).SetDescription(name)
+    ds = None
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    satellite_file, parameter_files, parameter_names, shp_file, resampling, output_file = from_args_to_vars(args)
+    grt.configure('warp')
+    stage = tm.start('terrain_stack')
+
+    shp_file = get_shp(shp_file)
+    terrain_stack(satellite_file, parameter_files, parameter_names, shp_file, output_file, resampling)
+    stage.finish(inputs=parameter_files, outputs=[output_file])
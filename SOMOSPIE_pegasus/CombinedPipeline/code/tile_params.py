@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Crop and compute fused in a single job: the tile (with its buffer) is only a VRT window of the DEM,
+# so it is never written, and the terrain parameters are computed from it directly.
+#
+# Command-line example:
+# ./tile_params.py -i elevation_m.tif -n 4 -x 0 -y 1 -o aspect_tile_0001.tif hillshading_tile_0001.tif slope_tile_0001.tif
+
+import argparse
+import math
+import os
+from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Arguments and data files for cropping a DEM tile and computing its terrain parameters.')
+    parser.add_argument('-i', "--infile", help='Input file (DEM).')
+    parser.add_argument('-n', "--ntiles", help='Number of tiles (Must be a square number).')
+    parser.add_argument('-x', "--xnum", help='Number of the tile in the x dimension.')
+    parser.add_argument('-y', "--ynum", help='Number of the tile in the y dimension.')
+    parser.add_argument('-o', "--outfile", help='Output files (aspect, hillshading, slope).', nargs='+')
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    aspect_file, hillshading_file, slope_file = args.outfile
+    return args.infile, int(args.ntiles), int(args.xnum), int(args.ynum), aspect_file, hillshading_file, slope_file
+
+
+def tile_window(mosaic, n_tiles, idx_x, idx_y, buffer=10):
+    # Same window as crop.py: [left_x, top_y, width, height] with a buffer of 10 pixels
+    ds = gdal.Open(mosaic, 0)
+    cols = ds.RasterXSize
+    rows = ds.RasterYSize
+    ds = None
+    x_win_size = int(math.ceil(cols / n_tiles))
+    y_win_size = int(math.ceil(rows / n_tiles))
+
+    idx_x = range(0, cols, x_win_size)[idx_x]
+    idx_y = range(0, rows, y_win_size)[idx_y]
+    nrows = y_win_size if idx_y + y_win_size < rows else rows - idx_y
+    ncols = x_win_size if idx_x + x_win_size < cols else cols - idx_x
+
+    win = [max(0, idx_x - buffer), max(0, idx_y - buffer), ncols, nrows]
+    w = win[2] + 2*buffer
+    win[2] = w if win[0] + w < cols else cols - win[0]
+    h = win[3] + 2*buffer
+    win[3] = h if win[1] + h < rows else rows - win[1]
+    return win
+
+
+def tile_params(mosaic, n_tiles, idx_x, idx_y, aspect_file, hillshading_file, slope_file):
+    tile = '/vsimem/tile.vrt'
+    gdal.Translate(tile, mosaic, options=gdal.TranslateOptions(format='VRT', srcWin=tile_window(mosaic, n_tiles, idx_x, idx_y)))
+
+    # Parameter tiles are intermediate files, they are merged later on, so no overviews
+    creation_options = cp.creation_options(gdal.GDT_Float32, profile='tiled')
+    # Slope
+    dem_options = gdal.DEMProcessingOptions(format='GTiff', creationOptions=creation_options)
+    gdal.DEMProcessing(slope_file, tile, processing='slope', options=dem_options)
+    # Aspect
+    dem_options = gdal.DEMProcessingOptions(zeroForFlat=True, format='GTiff', creationOptions=creation_options)
+    gdal.DEMProcessing(aspect_file, tile, processing='aspect', options=dem_options)
+    # Hillshading, changed to the same datatype as the other parameters
+    hill = gdal.DEMProcessing('/vsimem/hill.tif', tile, processing='hillshade', options=gdal.DEMProcessingOptions(format='GTiff'))
+    hill = None
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(gdal.GDT_Float32, profile='tiled'), outputType=gdal.GDT_Float32, callback=gdal.TermProgress_nocb)
+    gdal.Translate(hillshading_file, '/vsimem/hill.tif', options=translate_options)
+
+    gdal.Unlink('/vsimem/hill.tif')
+    gdal.Unlink(tile)
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    mosaic, n_tiles, idx_x, idx_y, aspect_file, hillshading_file, slope_file = from_args_to_vars(args)
+    grt.configure('dem')
+    stage = tm.start('tile_params', tile=[idx_x, idx_y])
+    tile_params(mosaic, n_tiles, idx_x, idx_y, aspect_file, hillshading_file, slope_file)
+    for f in [aspect_file, hillshading_file, slope_file]:
+        print(f, "Size is :", os.path.getsize(f), " bytes")
+    stage.finish(outputs=[aspect_file, hillshading_file, slope_file])
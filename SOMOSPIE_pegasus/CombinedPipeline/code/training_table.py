@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Builds the training data of a region and year in one pass, as a single columnar table:
+# x, y, the terrain parameters (stored once) and one soil moisture column per month (sm_01 ... sm_12).
+# train_model.py -c <month> selects a month by reading only the columns it needs.
+#
+# Command-line example:
+# ./training_table.py -t terrain_stack.tif -i 01.tif 02.tif ... 12.tif -s LA_County_Boundary.zip -o 2010_training.parquet
+
+import argparse
+import glob
+import os
+import zipfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import gdal_runtime as grt
+import telemetry as tm
+import reproject_plan as pl
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Arguments and data files to build the multi-month training table.')
+    parser.add_argument('-t', "--terrain", help='Terrain parameters on the satellite grid (from terrain_stack.py).')
+    parser.add_argument('-i', "--infiles", help='Satellite soil moisture GeoTIF files, one per month.', nargs='+')
+    parser.add_argument('-m', "--months", help='Month of each soil moisture file (1 to 12 by default).', nargs='+', type=int, default=None)
+    parser.add_argument('-s', "--shpfile", help='Shp file to crop into region, in zip.')
+    parser.add_argument('-o', "--outfile", help='Training table, parquet (or csv if the name ends with .csv).')
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    months = args.months if args.months else list(range(1, len(args.infiles) + 1))
+    return args.terrain, args.infiles, months, args.shpfile, args.outfile
+
+
+def get_shp(zip_file):
+    Path('shp_file').mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        zip_ref.extractall('./shp_file')
+
+    shp_file = glob.glob('./shp_file/*.shp')[0]
+    return shp_file
+
+
+def month_column(month):
+    return 'sm_{0:02d}'.format(month)
+
+
+def read_bands(ds):
+    # All the bands as float32 (bands, rows, cols), nodata as nan
+    data = ds.ReadAsArray().astype(np.float32).reshape(ds.RasterCount, ds.RasterYSize, ds.RasterXSize)
+    for k in range(ds.RasterCount):
+        nodata = ds.GetRasterBand(k + 1).GetNoDataValue()
+        if nodata is not None and not np.isnan(nodata):
+            data[k][data[k] == nodata] = np.nan
+    return data
+
+
+def pixel_coordinates(ds):
+    # Coordinates of the pixel centers, row by row as in train_model.tif2df
+    xmin, xres, _, ymax, _, yres = ds.GetGeoTransform()
+    x = xmin + xres * (np.arange(ds.RasterXSize) + 0.5)
+    y = ymax + yres * (np.arange(ds.RasterYSize) + 0.5)
+    return np.tile(x, ds.RasterYSize), np.repeat(y, ds.RasterXSize)
+
+
+def build_table(terrain_file, satellite_files, months, shp_file):
+    ds = gdal.Open(terrain_file, 0)
+    names = [ds.GetRasterBand(k + 1).GetDescription() or 'band_{}'.format(k + 1) for k in range(ds.RasterCount)]
+    covariates = read_bands(ds).reshape(ds.RasterCount, -1)
+    x, y = pixel_coordinates(ds)
+    ds = None
+
+    # The covariates are stored once, for the pixels where all of them are defined
+    valid = np.isfinite(covariates).all(axis=0)
+    columns = {'x': x[valid], 'y': y[valid]}
+    for k, name in enumerate(names):
+        columns[name] = covariates[k, valid]
+
+    # Each month is warped onto the grid of the terrain stack and adds a single column
+    grid = pl.grid_from_raster(terrain_file)
+    for satellite_file, month in zip(satellite_files, months):
+        month_file = '/vsimem/{}.tif'.format(month_column(month))
+        pl.warp_to_grid(satellite_file, month_file, grid, shp_file, resampling='near', profile='tiled')
+        ds = gdal.Open(month_file, 0)
+        columns[month_column(month)] = read_bands(ds)[0].reshape(-1)[valid]
+        ds = None
+        gdal.Unlink(month_file)
+
+    df = pd.DataFrame(columns)
+    sm_columns = [month_column(m) for m in months]
+    return df.dropna(subset=sm_columns, how='all').reset_index(drop=True)
+
+
+def write_table(df, output_file):
+    if output_file.endswith('.csv'):
+        df.to_csv(output_file, index=None)
+    else:
+        df.to_parquet(output_file, index=False)
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    terrain_file, satellite_files, months, shp_file, output_file = from_args_to_vars(args)
+    grt.configure('read')
+    stage = tm.start('training_table')
+
+    shp_file = get_shp(shp_file)
+    df = build_table(terrain_file, satellite_files, months, shp_file)
+    write_table(df, output_file)
+    print("Training table:", df.shape, "columns:", list(df.columns))
+    stage.finish(inputs=[terrain_file, *satellite_files], outputs=[output_file], rows=len(df))
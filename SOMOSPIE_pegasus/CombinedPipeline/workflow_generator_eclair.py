@@ -27,16 +27,35 @@ class DataTransformationWorkflow:
     #file describing the projection to be used, NAD_83.wkt contains the North America specific conus representation
     #WGS_84.wkt contains the global one for all representation, less precise but generic
     data_projection_conf = "NAD_83.wkt"
+    #one multi-month training table (covariates once, one soil moisture column per month) instead of 12 training GeoTIFFs
+    training_table = True
+    #model trained once per month (knn or rf), shared by the evaluation jobs of every tile
+    model = "knn"
 
 
     # --- Init ---------------------------------------------------------------------
-    def __init__(self, year, daxfile="workflow.yml", singularity=False):
+    def __init__(self, year, daxfile="workflow.yml", singularity=False, fuse=True, debug=False, cluster_size=0, eval_cluster_size=None, dem_bytes=None):
         self.daxfile = daxfile
         self.year = year
         self.singularity = singularity
+        # Crop and compute of each tile in a single job (tile_params.py)
+        self.fuse = fuse
+        # Intermediate files (tiles, parameter tiles, region and terrain stacks) are only staged out for debugging
+        self.debug = debug
+        # Horizontal clustering of the per-tile and per-month jobs, 0 or 1 disables it
+        self.cluster_size = cluster_size
+        # Clustering of the 12 x n_tiles**2 evaluate_model jobs, same as the other jobs by default
+        self.eval_cluster_size = cluster_size if eval_cluster_size is None else eval_cluster_size
+        # Size in bytes of the reprojected DEM, to report the expected transfer in bytes
+        self.dem_bytes = dem_bytes
+        # Expected size of the outputs, in units of the reprojected DEM
+        self.transfer = {'files': 0, 'staged': 0.0, 'all': 0.0}
         self.wf_dir = Path(__file__).parent.resolve()
         self.version = "v07.1"
         self.wf_name = f"somospie-data-wf-{self.year}"
+
+        # Python modules imported by the job scripts, staged along with them
+        self.code_modules = [File("creation_profile.py"), File("reproject_plan.py"), File("chunked_warp.py"), File("gdal_runtime.py"), File("telemetry.py")]
         
         # Read file with links
         self.input_tiles = []
@@ -173,6 +192,14 @@ class DataTransformationWorkflow:
                 container=base_container
             )
 
+        tile_params = Transformation(
+                "tile_params",
+                site="local",
+                pfn=os.path.join(self.wf_dir, "code/tile_params.py"),
+                is_stageable=True,
+                container=base_container
+            )
+
         merge_avg = Transformation(
                 "merge_avg",
                 site="local",
@@ -189,6 +216,38 @@ class DataTransformationWorkflow:
                 container=base_container
             )
 
+        reproject_plan = Transformation(
+                "reproject_plan",
+                site="local",
+                pfn=os.path.join(self.wf_dir, "code/reproject_plan.py"),
+                is_stageable=True,
+                container=base_container
+            )
+
+        region_stack = Transformation(
+                "region_stack",
+                site="local",
+                pfn=os.path.join(self.wf_dir, "code/region_stack.py"),
+                is_stageable=True,
+                container=base_container
+            )
+
+        terrain_stack = Transformation(
+                "terrain_stack",
+                site="local",
+                pfn=os.path.join(self.wf_dir, "code/terrain_stack.py"),
+                is_stageable=True,
+                container=base_container
+            )
+
+        training_table = Transformation(
+                "training_table",
+                site="local",
+                pfn=os.path.join(self.wf_dir, "code/training_table.py"),
+                is_stageable=True,
+                container=base_container
+            )
+
         generate_train = Transformation(
                 "generate_train",
                 site="local",
@@ -197,6 +256,22 @@ class DataTransformationWorkflow:
                 container=base_container
             )
 
+        train_model = Transformation(
+                "train_model",
+                site="local",
+                pfn=os.path.join(self.wf_dir, "code/train_model.py"),
+                is_stageable=True,
+                container=base_container
+            )
+
+        evaluate_model = Transformation(
+                "evaluate_model",
+                site="local",
+                pfn=os.path.join(self.wf_dir, "code/evaluate_model.py"),
+                is_stageable=True,
+                container=base_container
+            )
+
         generate_eval = Transformation(
                 "generate_eval",
                 site="local",
@@ -206,7 +281,14 @@ class DataTransformationWorkflow:
             )
 
         self.tc.add_containers(base_container)
-        self.tc.add_transformations(merge, reproject, crop, compute, merge_avg, get_sm, generate_train, generate_eval)
+        self.tc.add_transformations(merge, reproject, crop, compute, tile_params, merge_avg, get_sm, reproject_plan, region_stack, terrain_stack, training_table, generate_train, generate_eval, train_model, evaluate_model)
+
+        # Per-tile and per-month jobs are grouped into clustered jobs
+        if self.cluster_size > 1:
+            for transformation in [crop, compute, tile_params, generate_train, generate_eval]:
+                transformation.add_pegasus_profile(clusters_size=self.cluster_size)
+        if self.eval_cluster_size > 1:
+            evaluate_model.add_pegasus_profile(clusters_size=self.eval_cluster_size)
 
      # --- Replica Catalog ----------------------------------------------------------
     def create_replica_catalog(self):
@@ -215,6 +297,9 @@ class DataTransformationWorkflow:
         self.rc.add_replica(site="local", lfn=self.data_projection_conf, pfn=os.path.join(self.wf_dir, "config", self.data_projection_conf))
         self.rc.add_replica(site="local", lfn=self.data_shp_zip, pfn=os.path.join(self.wf_dir, "config", self.data_shp_zip))
 
+        for module in self.code_modules:
+            self.rc.add_replica(site="local", lfn=module, pfn=os.path.join(self.wf_dir, "code", module.lfn))
+
         for i in range(len(self.input_tiles)):
             self.rc.add_replica("AmazonS3", self.input_tiles[i], self.input_tiles_pfns[i])
         
@@ -222,26 +307,42 @@ class DataTransformationWorkflow:
             self.rc.add_replica("ceda.ac.uk", self.soil_moisture_inputs[i], self.soil_moisture_inputs_pfns[i])
 
 
+    # --- Transfers ------------------------------------------------------------------
+    def stage_out(self, *files, intermediate=False, size=0.0):
+        # Whether files are staged out, and bookkeeping of the expected transfer (size of each file in DEM units)
+        stage = self.debug or not intermediate
+        self.transfer['all'] += size * len(files)
+        if stage:
+            self.transfer['files'] += len(files)
+            self.transfer['staged'] += size * len(files)
+        return stage
+
+    def report(self):
+        print(f"Jobs: {len(self.wf.jobs)}", f"(clustered by {self.cluster_size})" if self.cluster_size > 1 else "",
+              f"(evaluation clustered by {self.eval_cluster_size})" if self.eval_cluster_size > 1 else "")
+        print(f"Staged out files: {self.transfer['files']}")
+        if self.dem_bytes:
+            print(f"Expected transfer: {int(self.transfer['staged'] * self.dem_bytes)} bytes "
+                  f"({int(self.transfer['all'] * self.dem_bytes)} bytes staging out every intermediate file)")
+        else:
+            print(f"Expected transfer: {self.transfer['staged']:.2f} x the reprojected DEM "
+                  f"({self.transfer['all']:.2f} x staging out every intermediate file)")
+
+
     # --- Workflow -------------------------------------------------------------------
     def create_workflow(self):
         self.wf = Workflow(self.wf_name, infer_dependencies=True)
 
         #### GeoTiled Workflow Part ####
 
-        mosaic = File("mosaic.tif")
-        job_merge = Job("merge")\
-                .add_args("-i", *self.input_tiles, "-o", mosaic)\
-                .add_inputs(*self.input_tiles, bypass_staging=True)\
-                .add_outputs(mosaic, stage_out=True)
-
-        self.wf.add_jobs(job_merge)
-
+        # The downloaded tiles are reprojected directly as a lazy mosaic, no mosaic.tif is written
         dem_m = File("elevation_m.tif")
         projection = File(self.data_projection_conf)
         job_reproject = Job("reproject")\
-                    .add_args("-p", projection,"-i", mosaic, "-o", dem_m)\
-                    .add_inputs(mosaic, projection)\
-                    .add_outputs(dem_m, stage_out=True)
+                    .add_args("-p", projection,"-i", *self.input_tiles, "-o", dem_m)\
+                    .add_inputs(*self.input_tiles, bypass_staging=True)\
+                    .add_inputs(projection)\
+                    .add_outputs(dem_m, stage_out=self.stage_out(dem_m, size=1.0))
 
         self.wf.add_jobs(job_reproject)
 
@@ -249,6 +350,8 @@ class DataTransformationWorkflow:
         aspect_tiles = []
         hillshading_tiles = []
         slope_tiles = []
+        # Fraction of the DEM in a tile (crop.py splits each dimension in n_tiles**2), the whole DEM without tiling
+        tile_size = 1.0 / self.n_tiles**4 if self.n_tiles > 0 else 1.0
 
         tile_count = 0
         for i in range(self.n_tiles):
@@ -257,51 +360,54 @@ class DataTransformationWorkflow:
                 aspect_tiles.append(File("aspect_tile_{0:04d}.tif".format(tile_count)))
                 hillshading_tiles.append(File("hillshading_tile_{0:04d}.tif".format(tile_count)))
                 slope_tiles.append(File("slope_tile_{0:04d}.tif".format(tile_count)))
-
-                job_crop = Job("crop")\
-                            .add_args("-n", self.n_tiles**2, "-x", i, "-y", j, "-i", dem_m, "-o", tile)\
-                            .add_inputs(dem_m)\
-                            .add_outputs(tile, stage_out=True)
-
-                job_compute = Job("compute")\
-                            .add_args("-i", tile, "-o", aspect_tiles[-1], hillshading_tiles[-1], slope_tiles[-1])\
-                            .add_inputs(tile)\
-                            .add_outputs(aspect_tiles[-1], hillshading_tiles[-1], slope_tiles[-1], stage_out=True)
+                param_tiles = [aspect_tiles[-1], hillshading_tiles[-1], slope_tiles[-1]]
+
+                if self.fuse:
+                    # The DEM tile is only a VRT window inside the job, it is never written
+                    job_tile = Job("tile_params")\
+                                .add_args("-n", self.n_tiles**2, "-x", i, "-y", j, "-i", dem_m, "-o", *param_tiles)\
+                                .add_inputs(dem_m)\
+                                .add_outputs(*param_tiles, stage_out=self.stage_out(*param_tiles, intermediate=True, size=tile_size))
+                    self.wf.add_jobs(job_tile)
+                else:
+                    job_crop = Job("crop")\
+                                .add_args("-n", self.n_tiles**2, "-x", i, "-y", j, "-i", dem_m, "-o", tile)\
+                                .add_inputs(dem_m)\
+                                .add_outputs(tile, stage_out=self.stage_out(tile, intermediate=True, size=tile_size))
+
+                    job_compute = Job("compute")\
+                                .add_args("-i", tile, "-o", *param_tiles)\
+                                .add_inputs(tile)\
+                                .add_outputs(*param_tiles, stage_out=self.stage_out(*param_tiles, intermediate=True, size=tile_size))
+                    self.wf.add_jobs(job_crop, job_compute)
 
                 tile_count += 1
-                self.wf.add_jobs(job_crop, job_compute)
-
-        # DEM reprojected to WGS84
-        dem = File("elevation.tif")
-        job_reproject = Job("reproject")\
-                    .add_args("-p", 'EPSG:4326',"-i", mosaic, "-o", dem, "-n", "y")\
-                    .add_inputs(mosaic)\
-                    .add_outputs(dem, stage_out=True)
 
-        # Mosaic of each parameter
+        # Mosaic of each parameter, kept in the projection of the tiles.
+        # The parameters are warped only once, straight to the training and evaluation grids.
         aspect = File("aspect.tif")
         job_avg0 = Job("merge_avg")\
-                .add_args("-i", *aspect_tiles, "-o", aspect)\
+                .add_args("-i", *aspect_tiles, "-o", aspect, "-k", "y")\
                 .add_inputs(*aspect_tiles)\
-                .add_outputs(aspect, stage_out=True)
+                .add_outputs(aspect, stage_out=self.stage_out(aspect, size=tile_count * tile_size))
 
         hillshading = File("hillshading.tif")
         job_avg1 = Job("merge_avg")\
-                .add_args("-i", *hillshading_tiles, "-o", hillshading)\
+                .add_args("-i", *hillshading_tiles, "-o", hillshading, "-k", "y")\
                 .add_inputs(*hillshading_tiles)\
-                .add_outputs(hillshading, stage_out=True)
+                .add_outputs(hillshading, stage_out=self.stage_out(hillshading, size=tile_count * tile_size))
 
         slope = File("slope.tif")
         job_avg2 = Job("merge_avg")\
-                .add_args("-i", *slope_tiles, "-o", slope)\
+                .add_args("-i", *slope_tiles, "-o", slope, "-k", "y")\
                 .add_inputs(*slope_tiles)\
-                .add_outputs(slope, stage_out=True)
+                .add_outputs(slope, stage_out=self.stage_out(slope, size=tile_count * tile_size))
 
-        self.wf.add_jobs(job_reproject, job_avg0, job_avg1, job_avg2)
+        self.wf.add_jobs(job_avg0, job_avg1, job_avg2)
         
         #### ML Data Preparation Workflow Part ####
 
-        param_files = [dem, aspect, hillshading, slope]
+        param_files = [aspect, dem_m, hillshading, slope]
         param_names = ["aspect", "elevation", "hillshading", "slope"]
         
         avg_files = []
@@ -313,30 +419,70 @@ class DataTransformationWorkflow:
             job_get_sm = Job("get_sm")\
                 .add_args("-y", self.year, "-m", month, "-o", avg_file)\
                 .add_inputs(*soil_moisture_inputs_month)\
-                .add_outputs(avg_file, stage_out=True)
+                .add_outputs(avg_file, stage_out=self.stage_out(avg_file))
 
             self.wf.add_jobs(job_get_sm)
 
         shp_file = File(self.data_shp_zip)
-        # Generate training files
-        for i, avg_file in enumerate(avg_files):
-            train_file = File('{0:04d}_{1:02d}.tif'.format(self.year, i + 1))
-            train_file_aux = File('{0:04d}_{1:02d}.tif.aux.xml'.format(self.year, i + 1))
-            job_generate_train = Job("generate_train")\
-                        .add_args("-i", avg_file, "-o", train_file, "-f", *param_files, "-p", *param_names, "-s", shp_file)\
-                        .add_inputs(avg_file, *param_files, shp_file)\
-                        .add_outputs(train_file, train_file_aux, stage_out=True)
-            self.wf.add_jobs(job_generate_train)
-
-        # Generate eval files
+        # Evaluation grid: EPSG:4326 at the native resolution of the DEM, over the region
+        eval_grid = File("eval_grid.json")
+        job_plan = Job("reproject_plan")\
+                .add_args("-i", dem_m, "-s", shp_file, "-p", "EPSG:4326", "-o", eval_grid)\
+                .add_inputs(dem_m, shp_file)\
+                .add_outputs(eval_grid, stage_out=self.stage_out(eval_grid, intermediate=True))
+        self.wf.add_jobs(job_plan)
+
+        # Terrain parameters resampled and cropped to the soil moisture grid once, for the 12 months
+        terrain_file = File("terrain_stack.tif")
+        job_terrain = Job("terrain_stack")\
+                .add_args("-i", avg_files[0], "-f", *param_files, "-p", *param_names, "-s", shp_file, "-o", terrain_file)\
+                .add_inputs(avg_files[0], *param_files, shp_file)\
+                .add_outputs(terrain_file, stage_out=self.stage_out(terrain_file, intermediate=True))
+        self.wf.add_jobs(job_terrain)
+
+        # Training table of the year, the months are selected by column when training
+        if self.training_table:
+            table_file = File('{0:04d}_training.parquet'.format(self.year))
+            job_training_table = Job("training_table")\
+                        .add_args("-t", terrain_file, "-i", *avg_files, "-s", shp_file, "-o", table_file)\
+                        .add_inputs(terrain_file, *avg_files, shp_file)\
+                        .add_outputs(table_file, stage_out=self.stage_out(table_file))
+            self.wf.add_jobs(job_training_table)
+        else:
+            # Otherwise one training file per month, only the band of the month is warped
+            train_files = []
+            for i, avg_file in enumerate(avg_files):
+                train_file = File('{0:04d}_{1:02d}.tif'.format(self.year, i + 1))
+                train_file_aux = File('{0:04d}_{1:02d}.tif.aux.xml'.format(self.year, i + 1))
+                job_generate_train = Job("generate_train")\
+                            .add_args("-i", avg_file, "-o", train_file, "-t", terrain_file, "-p", *param_names, "-s", shp_file)\
+                            .add_inputs(avg_file, terrain_file, shp_file)\
+                            .add_outputs(train_file, train_file_aux, stage_out=self.stage_out(train_file, train_file_aux))
+                self.wf.add_jobs(job_generate_train)
+                train_files.append(train_file)
+
+        # Parameters cropped to the region once, for every eval tile
+        region_file = File("region_stack.tif")
+        mask_file = File("region_mask.tif")
+        stage_region = self.stage_out(region_file, intermediate=True, size=4.0)
+        self.stage_out(mask_file, intermediate=True, size=0.25)
+        job_region = Job("region_stack")\
+                .add_args("-i", *param_files, "-s", shp_file, "-g", eval_grid, "-o", region_file, "-m", mask_file)\
+                .add_inputs(*param_files, shp_file, eval_grid)\
+                .add_outputs(region_file, mask_file, stage_out=stage_region)
+        self.wf.add_jobs(job_region)
+
+        # Generate eval files, each job reads its window of the region stack
+        eval_files = []
         if self.n_tiles == 0:
             eval_file = File('eval.tif')
             eval_file_aux = File("eval.tif.aux.xml")
             job_generate_eval = Job("generate_eval")\
-                    .add_args("-i", *param_files, "-p", *param_names, "-n", self.n_tiles**2, "-s", shp_file, "-o", eval_file)\
-                    .add_inputs(*param_files, shp_file)\
-                    .add_outputs(eval_file, eval_file_aux, stage_out=True)
+                    .add_args("-c", region_file, "-m", mask_file, "-p", *param_names, "-n", self.n_tiles**2, "-o", eval_file)\
+                    .add_inputs(region_file, mask_file)\
+                    .add_outputs(eval_file, eval_file_aux, stage_out=self.stage_out(eval_file, eval_file_aux, size=2.0 * tile_size))
             self.wf.add_jobs(job_generate_eval)
+            eval_files.append(eval_file)
 
         tile_count = 0
         for i in range(self.n_tiles):
@@ -345,18 +491,58 @@ class DataTransformationWorkflow:
                 eval_file = File(eval_path)
                 eval_file_aux = File(eval_path + ".aux.xml")
                 job_generate_eval = Job("generate_eval")\
-                        .add_args("-i", *param_files, "-p", *param_names, "-n", self.n_tiles**2, "-x", i, "-y", j, "-s", shp_file, "-o", eval_file)\
-                        .add_inputs(*param_files, shp_file)\
-                        .add_outputs(eval_file, eval_file_aux, stage_out=True)
+                        .add_args("-c", region_file, "-m", mask_file, "-p", *param_names, "-n", self.n_tiles**2, "-x", i, "-y", j, "-o", eval_file)\
+                        .add_inputs(region_file, mask_file)\
+                        .add_outputs(eval_file, eval_file_aux, stage_out=self.stage_out(eval_file, eval_file_aux, size=2.0 * tile_size))
                 self.wf.add_jobs(job_generate_eval)
+                eval_files.append(eval_file)
 
                 tile_count += 1
 
+        # Train once per month, the model and scaler are inputs of the evaluation of every tile
+        for month in range(1, 13):
+            model_file = File('{0:04d}_{1:02d}_{2}.pkl'.format(self.year, month, self.model))
+            scaler_file = File('{0:04d}_{1:02d}_scaler.pkl'.format(self.year, month))
+            if self.training_table:
+                job_train = Job("train_model")\
+                        .add_args("-i", table_file, "-c", month, "-m", self.model, "-o", model_file, "-s", scaler_file)\
+                        .add_inputs(table_file)
+            else:
+                job_train = Job("train_model")\
+                        .add_args("-i", train_files[month - 1], "-m", self.model, "-o", model_file, "-s", scaler_file)\
+                        .add_inputs(train_files[month - 1])
+            job_train.add_outputs(model_file, scaler_file, stage_out=self.stage_out(model_file, scaler_file))
+            self.wf.add_jobs(job_train)
+
+            # Evaluate many: one job per tile, and a lazy mosaic of the predictions of the month
+            prediction_files = []
+            for tile, eval_file in enumerate(eval_files):
+                prediction_file = File('{0:04d}_{1:02d}_predictions_{2:04d}.tif'.format(self.year, month, tile))
+                job_evaluate = Job("evaluate_model")\
+                        .add_args("-i", eval_file, "-m", model_file, "-s", scaler_file, "-o", prediction_file)\
+                        .add_inputs(eval_file, model_file, scaler_file)\
+                        .add_outputs(prediction_file, stage_out=self.stage_out(prediction_file, size=0.5 * tile_size))
+                self.wf.add_jobs(job_evaluate)
+                prediction_files.append(prediction_file)
+
+            # The VRT references the prediction tiles, which are staged out next to it
+            prediction_mosaic = File('{0:04d}_{1:02d}_predictions.vrt'.format(self.year, month))
+            job_mosaic = Job("merge")\
+                    .add_args("-i", *prediction_files, "-o", prediction_mosaic)\
+                    .add_inputs(*prediction_files)\
+                    .add_outputs(prediction_mosaic, stage_out=self.stage_out(prediction_mosaic))
+            self.wf.add_jobs(job_mosaic)
+
+        # Every job script imports the shared modules
+        for job in self.wf.jobs.values():
+            job.add_inputs(*self.code_modules)
+
 
     # --- Plan -----------------------------------------------------------------------
     def plan_workflow(self, submit=False, site="condorpool"):
         try:
-            self.wf.plan(sites=[site], output_dir="output", dir="submit", output_sites=["local"], submit=submit)
+            cluster = {"cluster": ["horizontal"]} if self.cluster_size > 1 or self.eval_cluster_size > 1 else {}
+            self.wf.plan(sites=[site], output_dir="output", dir="submit", output_sites=["local"], submit=submit, **cluster)
             if submit:
                 self.wf.wait()
         except PegasusClientError as e:
@@ -371,10 +557,19 @@ def main():
     parser.add_argument("--site", metavar="STR", type=str, default="condorpool", choices=["condorpool", "eclair"], help="Execution Site", required=False)
     parser.add_argument("--singularity", action="store_true", help="Use Singularity Instead of Docker", required=False)
     parser.add_argument("--output", metavar="STR", type=str, default="workflow.yml", help="Output file", required=False)
+    parser.add_argument("--no-fuse", action="store_true", help="Separate Crop and Compute Jobs for Each Tile", required=False)
+    parser.add_argument("--debug", action="store_true", help="Stage Out Intermediate Files", required=False)
+    parser.add_argument("--cluster-size", metavar="INT", type=int, default=0, help="Cluster Per-Tile and Per-Month Jobs Horizontally (Default: 0, no clustering)", required=False)
+    parser.add_argument("--eval-cluster-size", metavar="INT", type=int, default=None, help="Cluster the Evaluation Jobs Horizontally (Default: --cluster-size)", required=False)
+    parser.add_argument("--model", metavar="STR", type=str, default="knn", choices=["knn", "rf"], help="Model Trained per Month (Default: knn)", required=False)
+    parser.add_argument("--dem-bytes", metavar="INT", type=int, default=None, help="Size of the Reprojected DEM in Bytes, to Report the Expected Transfer", required=False)
 
     args = parser.parse_args()
 
-    workflow = DataTransformationWorkflow(year=args.year, daxfile=args.output, singularity=args.singularity)
+    workflow = DataTransformationWorkflow(year=args.year, daxfile=args.output, singularity=args.singularity,
+                                          fuse=not args.no_fuse, debug=args.debug, cluster_size=args.cluster_size,
+                                          eval_cluster_size=args.eval_cluster_size, dem_bytes=args.dem_bytes)
+    workflow.model = args.model
 
     workflow.create_pegasus_properties()
     workflow.create_sites_catalog()
@@ -383,6 +578,7 @@ def main():
     workflow.create_workflow()
 
     workflow.write()
+    workflow.report()
 
     if args.plan or args.submit:
         workflow.plan_workflow(submit=args.submit, site=args.site)
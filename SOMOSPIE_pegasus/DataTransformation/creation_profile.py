@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Creation options shared by every GeoTIFF writer in the workflow.
+#
+# Profiles:
+#   cog     tiled GeoTIFF with predictor, written in COG layout with internal overviews (default)
+#   tiled   tiled GeoTIFF with predictor, no overviews (intermediate files such as tiles)
+#   legacy  the old ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'] options
+#
+# The defaults can be changed without touching the scripts through the environment variables
+# SOMOSPIE_PROFILE, SOMOSPIE_COMPRESS (ZSTD, DEFLATE, LZW, NONE) and SOMOSPIE_BLOCKSIZE.
+# Compression threads follow GDAL_NUM_THREADS when it was set by gdal_runtime.configure().
+
+import os
+from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+
+
+PROFILE = os.environ.get('SOMOSPIE_PROFILE', 'cog')
+COMPRESS = os.environ.get('SOMOSPIE_COMPRESS', 'ZSTD')
+BLOCKSIZE = int(os.environ.get('SOMOSPIE_BLOCKSIZE', 512))
+OVERVIEW_RESAMPLING = 'AVERAGE'
+
+LEGACY_OPTIONS = ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES']
+
+
+def get_compression(compress=None):
+    # ZSTD is only available when GDAL was built with libzstd, fall back to DEFLATE otherwise
+    compress = (compress or COMPRESS).upper()
+    if compress == 'ZSTD':
+        option_list = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+        if 'ZSTD' not in option_list:
+            compress = 'DEFLATE'
+    return compress
+
+
+def get_data_type(raster):
+    # raster: path, opened dataset or list of paths (the first one is used)
+    if isinstance(raster, (list, tuple)):
+        raster = raster[0]
+    ds = gdal.Open(str(raster), 0) if isinstance(raster, (str, os.PathLike)) else raster
+    return ds.GetRasterBand(1).DataType
+
+
+def get_predictor(data_type):
+    # Floating point predictor for float rasters, horizontal differencing for integers
+    if gdal.GetDataTypeName(data_type).startswith('Float'):
+        return 3
+    return 2
+
+
+def creation_options(data_type=gdal.GDT_Float32, profile=None, compress=None, block_size=None, threads=True):
+    # Creation options for the GTiff driver (Warp, DEMProcessing, Rasterize and tiled Translate)
+    profile = profile or PROFILE
+    if profile == 'legacy':
+        return list(LEGACY_OPTIONS)
+
+    compress = get_compression(compress)
+    block_size = block_size or BLOCKSIZE
+    options = ['TILED=YES', 'BLOCKXSIZE={}'.format(block_size), 'BLOCKYSIZE={}'.format(block_size),
+               'BIGTIFF=IF_SAFER', 'COMPRESS={}'.format(compress)]
+    if compress in ['ZSTD', 'DEFLATE', 'LZW']:
+        options.append('PREDICTOR={}'.format(get_predictor(data_type)))
+    if threads:
+        options.append('NUM_THREADS={}'.format(os.environ.get('GDAL_NUM_THREADS', 'ALL_CPUS')))
+    return options
+
+
+def cog_options(data_type=gdal.GDT_Float32, compress=None, block_size=None, threads=True):
+    # Creation options for the COG driver, overviews are generated internally
+    compress = get_compression(compress)
+    block_size = block_size or BLOCKSIZE
+    options = ['BLOCKSIZE={}'.format(block_size), 'BIGTIFF=IF_SAFER', 'COMPRESS={}'.format(compress),
+               'OVERVIEWS=AUTO', 'OVERVIEW_RESAMPLING={}'.format(OVERVIEW_RESAMPLING)]
+    if compress in ['ZSTD', 'DEFLATE', 'LZW']:
+        options.append('PREDICTOR=YES')
+    if threads:
+        options.append('NUM_THREADS={}'.format(os.environ.get('GDAL_NUM_THREADS', 'ALL_CPUS')))
+    return options
+
+
+def translate_kwargs(data_type=gdal.GDT_Float32, profile=None, compress=None, block_size=None):
+    # Keyword arguments for gdal.TranslateOptions, COG is written directly by the COG driver
+    profile = profile or PROFILE
+    if profile == 'cog':
+        return dict(format='COG', creationOptions=cog_options(data_type, compress, block_size))
+    return dict(format='GTiff', creationOptions=creation_options(data_type, profile, compress, block_size))
+
+
+def translate_args(data_type=gdal.GDT_Float32, profile=None, compress=None, block_size=None):
+    # Same as translate_kwargs, as command line arguments for gdal_translate
+    kwargs = translate_kwargs(data_type, profile, compress, block_size)
+    args = ['-of', kwargs['format']]
+    for option in kwargs['creationOptions']:
+        args.extend(['-co', option])
+    return args
+
+
+def finalize(output_file, profile=None, resampling=OVERVIEW_RESAMPLING):
+    # Warp, DEMProcessing and Rasterize need a driver with Create(), so their output is a tiled
+    # GTiff. For the cog profile the overviews are added afterwards as internal overviews.
+    profile = profile or PROFILE
+    if profile != 'cog':
+        return
+
+    ds = gdal.Open(str(output_file), 1)
+    levels = []
+    size = max(ds.RasterXSize, ds.RasterYSize)
+    factor = 2
+    while size / factor >= BLOCKSIZE / 2:
+        levels.append(factor)
+        factor *= 2
+    if levels:
+        gdal.SetConfigOption('COMPRESS_OVERVIEW', get_compression())
+        gdal.SetConfigOption('PREDICTOR_OVERVIEW', str(get_predictor(ds.GetRasterBand(1).DataType)))
+        ds.BuildOverviews(resampling, levels)
+    ds = None
+
+
+def to_cog(input_file, output_file, compress=None, block_size=None):
+    # Rewrite any raster in strict COG layout (overviews before the full resolution data)
+    data_type = get_data_type(input_file)
+    translate_options = gdal.TranslateOptions(**translate_kwargs(data_type, 'cog', compress, block_size),
+                                              callback=gdal.TermProgress_nocb)
+    gdal.Translate(output_file, input_file, options=translate_options)
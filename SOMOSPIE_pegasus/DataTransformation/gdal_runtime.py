@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# GDAL runtime settings sized for the node the script runs on.
+#
+# GDAL_CACHEMAX, GDAL_NUM_THREADS, VSI_CACHE/VSI_CACHE_SIZE and the warp memory limit are derived from
+# the cores and memory available to the job (cpu affinity, cgroup limits of Condor/Docker jobs,
+# OMP_NUM_THREADS set by Condor from request_cpus), divided by the number of workers sharing the node,
+# and from the block size of the inputs. Every entry point calls configure() with its stage.
+#
+# Values the user set in the environment before this module was imported are respected (the values
+# configure() exports for the gdal subprocesses are not, so the workers of a pool get their own sizes),
+# and SOMOSPIE_CORES / SOMOSPIE_MEMORY_MB override the detection.
+
+import os
+from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+
+
+# Fraction of the memory of a worker used by the block cache and by the warper, per stage
+STAGES = {
+    'default':   {'cache': 0.25, 'warp': 0.0},
+    'warp':      {'cache': 0.20, 'warp': 0.30},  # reprojection, cropping to a shapefile
+    'dem':       {'cache': 0.40, 'warp': 0.0},   # DEMProcessing, neighbourhood reads of the tiles
+    'translate': {'cache': 0.30, 'warp': 0.0},   # mosaics, stacks, format conversion
+    'read':      {'cache': 0.15, 'warp': 0.0},   # reading rasters into numpy/pandas, memory goes to the arrays
+}
+
+MIN_CACHE_BLOCKS = 64  # The cache holds at least this many blocks of the input
+MAX_VSI_CACHE = 256 * 1024**2
+
+_settings = {}
+
+# GDAL settings of the user, recorded once before configure() exports its own. The names are exported in
+# SOMOSPIE_GDAL_USER_ENV, so a spawned worker importing this module tells them from the exported ones.
+GDAL_ENV = ['GDAL_CACHEMAX', 'GDAL_NUM_THREADS', 'VSI_CACHE', 'VSI_CACHE_SIZE']
+_user_keys = os.environ['SOMOSPIE_GDAL_USER_ENV'].split(',') if 'SOMOSPIE_GDAL_USER_ENV' in os.environ else GDAL_ENV
+USER_ENV = {key: os.environ[key] for key in _user_keys if key in os.environ}
+os.environ['SOMOSPIE_GDAL_USER_ENV'] = ','.join(USER_ENV)
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_cores():
+    override = os.environ.get('SOMOSPIE_CORES')
+    if override:
+        return max(1, int(override))
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+    # cgroup v2
+    cpu_max = _read('/sys/fs/cgroup/cpu.max')
+    if cpu_max and not cpu_max.startswith('max'):
+        quota, period = cpu_max.split()
+        cores = min(cores, max(1, int(int(quota) / int(period))))
+    # cgroup v1
+    quota = _read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        cores = min(cores, max(1, int(int(quota) / int(period))))
+
+    # Condor sets OMP_NUM_THREADS to request_cpus
+    omp = os.environ.get('OMP_NUM_THREADS')
+    if omp and omp.isdigit() and int(omp) > 0:
+        cores = min(cores, int(omp))
+    return max(1, cores)
+
+
+def get_memory():
+    # Available memory in bytes
+    override = os.environ.get('SOMOSPIE_MEMORY_MB')
+    if override:
+        return int(override) * 1024**2
+
+    memory = None
+    meminfo = _read('/proc/meminfo')
+    if meminfo:
+        for line in meminfo.splitlines():
+            if line.startswith('MemAvailable:'):
+                memory = int(line.split()[1]) * 1024
+    if memory is None:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    # cgroup v2
+    limit = _read('/sys/fs/cgroup/memory.max')
+    usage = _read('/sys/fs/cgroup/memory.current')
+    if limit and limit != 'max':
+        memory = min(memory, int(limit) - int(usage or 0))
+    # cgroup v1, an unlimited group reports a huge number
+    limit = _read('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    usage = _read('/sys/fs/cgroup/memory/memory.usage_in_bytes')
+    if limit and int(limit) < 2**60:
+        memory = min(memory, int(limit) - int(usage or 0))
+    return max(memory, 256 * 1024**2)
+
+
+def get_block_size(raster):
+    # Block size of the first band of raster, path or dataset
+    ds = gdal.Open(str(raster), 0) if isinstance(raster, (str, os.PathLike)) else raster
+    band = ds.GetRasterBand(1)
+    xsize, ysize = band.GetBlockSize()
+    return xsize * ysize * gdal.GetDataTypeSize(band.DataType) // 8
+
+
+def cache_bytes(value, memory):
+    # Bytes of a GDAL_CACHEMAX value in the forms GDAL accepts: "10%" of the memory, "512MB"/"2GB"/"1024KB",
+    # or a number, MB below 100000 and bytes above. None when it can not be parsed.
+    value = str(value).strip().upper()
+    try:
+        if value.endswith('%'):
+            return int(float(value[:-1]) * memory / 100)
+        for unit, size in [('KB', 1024), ('MB', 1024**2), ('GB', 1024**3)]:
+            if value.endswith(unit):
+                return int(float(value[:-len(unit)]) * size)
+        number = float(value)
+        return int(number * 1024**2) if number < 100000 else int(number)
+    except ValueError:
+        return None
+
+
+def configure(stage='default', workers=1, block_size=None, verbose=True):
+    # stage: key of STAGES, workers: processes sharing the node, block_size: bytes of one input block
+    fractions = STAGES.get(stage, STAGES['default'])
+    workers = max(1, int(workers or 1))
+    cores = get_cores()
+    memory = get_memory()
+    threads = max(1, cores // workers)
+    worker_memory = memory // workers
+
+    block_size = block_size or 512 * 512 * 4
+    cache = max(int(fractions['cache'] * worker_memory), MIN_CACHE_BLOCKS * block_size)
+    cache = min(cache, worker_memory // 2)
+    warp_memory = int(fractions['warp'] * worker_memory)
+    vsi_cache = min(MAX_VSI_CACHE, worker_memory // 20)
+
+    settings = {
+        'GDAL_CACHEMAX': USER_ENV.get('GDAL_CACHEMAX', str(cache // 1024**2)),
+        'GDAL_NUM_THREADS': USER_ENV.get('GDAL_NUM_THREADS', str(threads)),
+        'VSI_CACHE': USER_ENV.get('VSI_CACHE', 'TRUE'),
+        'VSI_CACHE_SIZE': USER_ENV.get('VSI_CACHE_SIZE', str(vsi_cache)),
+    }
+    for key, value in settings.items():
+        gdal.SetConfigOption(key, value)
+        # Also seen by the gdal command line tools run as subprocesses
+        os.environ[key] = value
+    # The cache size may already be fixed if GDAL read something, SetCacheMax always applies.
+    # A value of the user that can not be parsed is left to GDAL through the config option.
+    cache = cache_bytes(settings['GDAL_CACHEMAX'], memory)
+    if cache is not None:
+        gdal.SetCacheMax(cache)
+
+    _settings.clear()
+    _settings.update(settings)
+    _settings.update({'stage': stage, 'cores': cores, 'memory_mb': memory // 1024**2, 'workers': workers,
+                      'warp_memory': warp_memory if warp_memory > 0 else None})
+    if verbose:
+        print("GDAL runtime:", _settings)
+    return dict(_settings)
+
+
+def warp_memory():
+    # Memory limit in bytes for gdal.WarpOptions(warpMemoryLimit=...), None keeps the GDAL default
+    return _settings.get('warp_memory')
+
+
+def num_threads():
+    # Threads for options such as NUM_THREADS of the warper and the GTiff driver
+    return _settings.get('GDAL_NUM_THREADS', 'ALL_CPUS')
@@ -5,6 +5,10 @@ import os
 from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
 import numpy as np
 import math
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
+import reproject_plan as pl
 
 
 def get_parser():
@@ -15,6 +19,10 @@ def get_parser():
     parser.add_argument('-x', "--xnum", help='Number of the tile in the x dimension.', default=0)
     parser.add_argument('-y', "--ynum", help='Number of the tile in the y dimension.', default=0)
     parser.add_argument('-s', "--shpfile", help='Shp file to crop into region.')
+    parser.add_argument('-g', "--grid", help='Json file with the evaluation grid (from reproject_plan.py), planned from the first parameter if not given.', default=None)
+    parser.add_argument('-r', "--resampling", help='Resampling used to warp the terrain parameters to the evaluation grid.', default='near')
+    parser.add_argument('-c', "--stack", help='Parameters already cropped to the region (from region_stack.py), replaces --infiles.', default=None)
+    parser.add_argument('-m', "--mask", help='Rasterized region (from region_stack.py), used with --stack.', default=None)
     parser.add_argument('-o', "--outfile", help='Evaluation file in csv format.')
     return parser
 
@@ -28,7 +36,11 @@ def from_args_to_vars (args):
     idx_y = int(args.ynum)
     shp_file = args.shpfile
     output_file = args.outfile
-    return parameter_files, parameter_names, n_tiles, idx_x, idx_y, shp_file, output_file
+    grid_file = args.grid
+    resampling = args.resampling
+    stack_file = args.stack
+    mask_file = args.mask
+    return parameter_files, parameter_names, n_tiles, idx_x, idx_y, shp_file, output_file, grid_file, resampling, stack_file, mask_file
 
 
 def build_stack(input_files):
@@ -64,12 +76,12 @@ def crop_tile(raster, out_file, n_tiles, idx_x, idx_y):
     else:
         ncols = cols - idx_x
 
-    translate_options = gdal.TranslateOptions(srcWin=[idx_x, idx_y, ncols, nrows], creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+    translate_options = gdal.TranslateOptions(srcWin=[idx_x, idx_y, ncols, nrows], **cp.translate_kwargs(cp.get_data_type(raster)), callback=gdal.TermProgress_nocb)
     gdal.Translate(out_file, raster, options=translate_options)
 
 
 def write_stack(vrt_file, out_file):
-    translate_options = gdal.TranslateOptions(creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(cp.get_data_type(vrt_file)), callback=gdal.TermProgress_nocb)
     gdal.Translate(out_file, vrt_file, options=translate_options)
 
 
@@ -92,29 +104,79 @@ def get_band_names(raster):
     return names
 
 
-def crop_region(input_file, shp_file, output_file):
-    warp_options = gdal.WarpOptions(cutlineDSName=shp_file, cropToCutline=True, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+def crop_region(input_file, shp_file, output_file, profile=None):
+    warp_options = gdal.WarpOptions(cutlineDSName=shp_file, cropToCutline=True, creationOptions=cp.creation_options(cp.get_data_type(input_file), profile), callback=gdal.TermProgress_nocb)
     warp = gdal.Warp(output_file, input_file, options=warp_options)
     warp = None
+    cp.finalize(output_file, profile)
 
     
+def warp_to_eval_grid(input_files, grid, shp_file, resampling='near'):
+    # Each parameter is warped once, from its own projection to the evaluation grid, cropped to the region
+    warped_files = []
+    for input_file in input_files:
+        warped_file = 'grid_{}'.format(os.path.basename(input_file))
+        pl.warp_to_grid(input_file, warped_file, grid, shp_file, resampling=resampling, profile='tiled')
+        warped_files.append(warped_file)
+    return warped_files
+
+
+def read_tile(stack_file, mask_file, out_file, n_tiles, idx_x, idx_y):
+    # Reads only the window of the tile from the region stack, pixels outside the region are set to nan
+    grid = pl.grid_from_raster(stack_file)
+    if n_tiles != 0:
+        col, row, ncols, nrows = pl.tile_window(grid, n_tiles, idx_x, idx_y)
+    else:
+        col, row, ncols, nrows = 0, 0, grid['width'], grid['height']
+
+    stack = gdal.Open(stack_file, 0)
+    data = stack.ReadAsArray(col, row, ncols, nrows).reshape(stack.RasterCount, nrows, ncols)
+    mask = gdal.Open(mask_file, 0).ReadAsArray(col, row, ncols, nrows)
+    data[:, mask == 0] = np.nan
+
+    tile = gdal.GetDriverByName('MEM').Create('', ncols, nrows, stack.RasterCount, gdal.GDT_Float32)
+    xmin, xres, _, ymax, _, yres = stack.GetGeoTransform()
+    tile.SetGeoTransform([xmin + col * xres, xres, 0, ymax + row * yres, 0, yres])
+    tile.SetProjection(stack.GetProjection())
+    for i in range(stack.RasterCount):
+        band = tile.GetRasterBand(i + 1)
+        band.SetNoDataValue(np.nan)
+        band.WriteArray(data[i])
+    stack = None
+
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(gdal.GDT_Float32), callback=gdal.TermProgress_nocb)
+    gdal.Translate(out_file, tile, options=translate_options)
+    tile = None
+
+
 if __name__ == "__main__":	
     parser = get_parser()
     args = parser.parse_args()
-    parameter_files, parameter_names, n_tiles, idx_x, idx_y, shp_file, output_file = from_args_to_vars(args)
-
-    for f in parameter_files:
-        crop_region(f, shp_file, f)
+    parameter_files, parameter_names, n_tiles, idx_x, idx_y, shp_file, output_file, grid_file, resampling, stack_file, mask_file = from_args_to_vars(args)
+    grt.configure('warp')
+    stage = tm.start('generate_eval', tile=[idx_x, idx_y])
 
-    vrt_file = build_stack(parameter_files)
-    if n_tiles == 0:
-        write_stack(vrt_file, output_file)
+    if stack_file:
+        # The region was cropped once for every tile, only the window of this tile is read
+        read_tile(stack_file, mask_file, output_file, n_tiles, idx_x, idx_y)
     else:
-        crop_tile(vrt_file, output_file, n_tiles, idx_x, idx_y)
+        if grid_file:
+            grid = pl.load_grid(grid_file)
+        else:
+            grid = pl.plan_grid(parameter_files[0], shp_file=shp_file)
+        # Only the pixels of this tile are warped
+        if n_tiles != 0:
+            grid = pl.tile_grid(grid, n_tiles, idx_x, idx_y)
+
+        # The warped parameters are only stacked into the evaluation file, so no overviews
+        warped_files = warp_to_eval_grid(parameter_files, grid, shp_file, resampling)
+        vrt_file = build_stack(warped_files)
+        write_stack(vrt_file, output_file)
+        os.remove('stack.vrt')
+        for warped_file in warped_files:
+            os.remove(warped_file)
 
     set_band_names(output_file, parameter_names)
-    os.remove('stack.vrt')
     print("Band names:")
     print(get_band_names(output_file))
-        
-
+    stage.finish(outputs=[output_file])
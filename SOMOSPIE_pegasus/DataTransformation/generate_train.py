@@ -7,14 +7,20 @@ import zipfile
 from pathlib import Path
 import glob
 import shutil
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
+import reproject_plan as pl
 
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Arguments and data files to generate GeoTIF training file for model.')
     parser.add_argument('-i', "--infile", help='Satellite soil moisture GeoTIF file.')
-    parser.add_argument('-f', "--paramfiles", help='Terrain parameters GeoTIF files.', nargs='+')
+    parser.add_argument('-f', "--paramfiles", help='Terrain parameters GeoTIF files.', nargs='+', default=[])
+    parser.add_argument('-t', "--terrain", help='Terrain parameters already on the satellite grid (from terrain_stack.py), replaces --paramfiles.', default=None)
     parser.add_argument('-p', "--params", help='Terrain parameter identifiers for csv file headers.', nargs='+')
     parser.add_argument('-s', "--shpfile", help='Shp file to crop into region, in zip.')
+    parser.add_argument('-r', "--resampling", help='Resampling used to warp the terrain parameters to the satellite grid.', default='near')
     parser.add_argument('-o', "--outfile", help='Training file in tif format.')
     return parser
 
@@ -26,10 +32,12 @@ def from_args_to_vars (args):
     parameter_names = args.params
     shp_file = args.shpfile
     output_file = args.outfile
-    return satellite_file, parameter_files, parameter_names, shp_file, output_file
+    resampling = args.resampling
+    terrain_file = args.terrain
+    return satellite_file, parameter_files, parameter_names, shp_file, output_file, resampling, terrain_file
 
 
-def build_stack(input_files, output_file):
+def build_stack(input_files, output_file, profile='tiled'):
     # input_files: list of .tif files to stack
 
     # Get target resolution from satellite file
@@ -39,7 +47,7 @@ def build_stack(input_files, output_file):
     vrt_file = 'stack.vrt'
     vrt_options = gdal.BuildVRTOptions(separate=True)
     vrt = gdal.BuildVRT(vrt_file, input_files, options=vrt_options)
-    translate_options = gdal.TranslateOptions(creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], xRes=xres , yRes=yres,
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(cp.get_data_type(vrt), profile), xRes=xres , yRes=yres,
                                               callback=gdal.TermProgress_nocb)
     gdal.Translate(output_file, vrt, options=translate_options)
     vrt = None  # closes file
@@ -73,25 +81,64 @@ def get_shp(zip_file):
     return shp_file
 
 
-def crop_region(input_file, shp_file, output_file):
-    warp_options = gdal.WarpOptions(cutlineDSName=shp_file, cropToCutline=True, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'],
+def crop_region(input_file, shp_file, output_file, profile=None):
+    warp_options = gdal.WarpOptions(cutlineDSName=shp_file, cropToCutline=True, creationOptions=cp.creation_options(cp.get_data_type(input_file), profile),
                                     callback=gdal.TermProgress_nocb)
     warp = gdal.Warp(output_file, input_file, options=warp_options)
     warp = None
+    cp.finalize(output_file, profile)
+
+
+def warp_to_satellite_grid(satellite_file, parameter_files, shp_file, resampling='near'):
+    # Each file is warped once, from its own projection to the satellite grid restricted to the region
+    grid = pl.plan_grid(satellite_file, reference=satellite_file, shp_file=shp_file)
+    warped_files = []
+    for i, input_file in enumerate([satellite_file] + parameter_files):
+        warped_file = 'grid_{}'.format(os.path.basename(input_file))
+        pl.warp_to_grid(input_file, warped_file, grid, shp_file, resampling='near' if i == 0 else resampling, profile='tiled')
+        warped_files.append(warped_file)
+    return warped_files
+
+
+def add_month(satellite_file, terrain_file, shp_file, output_file):
+    # Only the soil moisture band is warped, the terrain bands are referenced from the stack through a VRT
+    grid = pl.grid_from_raster(terrain_file)
+    month_file = 'grid_{}'.format(os.path.basename(satellite_file))
+    pl.warp_to_grid(satellite_file, month_file, grid, shp_file, resampling='near', profile='tiled')
+
+    ds = gdal.Open(terrain_file, 0)
+    band_files = [month_file]
+    for i in range(ds.RasterCount):
+        band_files.append('/vsimem/terrain_{}.vrt'.format(i + 1))
+        gdal.Translate(band_files[-1], ds, options=gdal.TranslateOptions(format='VRT', bandList=[i + 1]))
+    ds = None
+
+    build_stack(band_files, output_file, profile=None)
+    os.remove(month_file)
+    for band_file in band_files[1:]:
+        gdal.Unlink(band_file)
 
 
 if __name__ == "__main__":	
     parser = get_parser()
     args = parser.parse_args()
-    satellite_file, parameter_files, parameter_names, shp_file, output_file = from_args_to_vars(args)
+    satellite_file, parameter_files, parameter_names, shp_file, output_file, resampling, terrain_file = from_args_to_vars(args)
+    grt.configure('warp')
+    stage = tm.start('generate_train')
 
-    parameter_files.insert(0, satellite_file)
     parameter_names.insert(0, 'z')
 
-    build_stack(parameter_files, output_file)
     shp_file = get_shp(shp_file)
-    crop_region(output_file, shp_file, output_file)
+    if terrain_file:
+        # The terrain parameters were resampled once for the 12 months
+        add_month(satellite_file, terrain_file, shp_file, output_file)
+    else:
+        warped_files = warp_to_satellite_grid(satellite_file, parameter_files, shp_file, resampling)
+        # Every band is already on the cropped satellite grid, the stack is the final file
+        build_stack(warped_files, output_file, profile=None)
+        for warped_file in warped_files:
+            os.remove(warped_file)
     
     set_band_names(output_file, parameter_names)
     print(get_band_names(output_file))
-    
\ No newline at end of file
+    stage.finish(outputs=[output_file])
@@ -9,6 +9,9 @@ from pathlib import Path
 import numpy as np
 import os
 import concurrent.futures
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
 
 
 def get_parser():
@@ -104,22 +107,26 @@ def average(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize,raster_ysize,
     with open('merged.vrt', 'w') as f:
         f.write(contents)
 
-    cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-co', 'TILED=YES', '-co', 'BIGTIFF=YES', '--config', 'GDAL_VRT_ENABLE_PYTHON', 'YES', 'merged.vrt', output_file]
+    # The average is reprojected afterwards, so it is written without overviews
+    cmd = ['gdal_translate'] + cp.translate_args(gdal.GDT_Float32, profile='tiled') + ['--config', 'GDAL_VRT_ENABLE_PYTHON', 'YES', 'merged.vrt', output_file]
     bash(cmd)
     os.remove('merged.vrt')
 
 
 def reproject(input_file, output_file, projection):
     # Projection can be EPSG:4326, .... or the path to a wkt file
-    warp_options = gdal.WarpOptions(dstSRS=projection, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS'], multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'], dstNodata=np.nan, callback=gdal.TermProgress_nocb)
+    warp_options = gdal.WarpOptions(dstSRS=projection, creationOptions=cp.creation_options(cp.get_data_type(input_file)), multithread=True, warpOptions=['NUM_THREADS={}'.format(grt.num_threads())], warpMemoryLimit=grt.warp_memory(), dstNodata=np.nan, callback=gdal.TermProgress_nocb)
     warp = gdal.Warp(output_file, input_file, options=warp_options)
     warp = None  # Closes the files
+    cp.finalize(output_file)
 
 
 if __name__ == "__main__":	
     parser = get_parser()
     args = parser.parse_args()
     year, averaging_type, output_files = from_args_to_vars(args)
+    grt.configure('warp')
+    stage = tm.start('get_sm')
     
     download(year)
     # print('\n'.join(sorted([gdal.GetDriver(i).GetDescription() for i in range(gdal.GetDriverCount())])))
@@ -134,5 +141,6 @@ if __name__ == "__main__":
     # Change projection
     for f in output_files:
         reproject(f, f, 'EPSG:4326')
+    stage.finish(outputs=output_files)
 
     shutil.rmtree('./{0:04d}'.format(year))
\ No newline at end of file
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Crops the terrain parameters to the region once, for all the evaluation tiles: each parameter is
+# warped to the evaluation grid and stacked in a single file, and the region is rasterized on the same
+# grid as a mask (1 inside, 0 outside). Tile jobs (generate_eval.py -c -m) read only their window.
+#
+# Command-line example:
+# ./region_stack.py -i aspect.tif elevation_m.tif hillshading.tif slope.tif -s LA_County_Boundary.zip -g eval_grid.json -o region_stack.tif -m region_mask.tif
+
+import argparse
+import os
+import numpy as np
+from osgeo import gdal, ogr # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
+import reproject_plan as pl
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Arguments and data files to crop the terrain parameters to a region once.')
+    parser.add_argument('-i', "--infiles", help='Terrain parameters GeoTIF files.', nargs='+')
+    parser.add_argument('-s', "--shpfile", help='Shp file (or zip) of the region.')
+    parser.add_argument('-g', "--grid", help='Json file with the evaluation grid (from reproject_plan.py), planned from the first parameter if not given.', default=None)
+    parser.add_argument('-r', "--resampling", help='Resampling used to warp the terrain parameters to the evaluation grid.', default='near')
+    parser.add_argument('-o', "--outfile", help='Stack of the parameters on the evaluation grid.')
+    parser.add_argument('-m', "--maskfile", help='Rasterized region on the evaluation grid.')
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    return args.infiles, args.shpfile, args.grid, args.resampling, args.outfile, args.maskfile
+
+
+def build_stack(input_files, grid, output_file, resampling='near'):
+    # One warp per parameter straight to the grid, without cutline (the mask is applied by the tile jobs).
+    # Tile jobs read windows of the stack, so it is tiled and has no overviews.
+    warped_files = []
+    for input_file in input_files:
+        warped_file = 'region_{}'.format(os.path.basename(input_file))
+        pl.warp_to_grid(input_file, warped_file, grid, resampling=resampling, profile='tiled')
+        warped_files.append(warped_file)
+
+    vrt = gdal.BuildVRT('/vsimem/stack.vrt', warped_files, options=gdal.BuildVRTOptions(separate=True))
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(gdal.GDT_Float32, profile='tiled'), callback=gdal.TermProgress_nocb)
+    gdal.Translate(output_file, vrt, options=translate_options)
+    vrt = None
+    gdal.Unlink('/vsimem/stack.vrt')
+    for warped_file in warped_files:
+        os.remove(warped_file)
+
+
+def rasterize_mask(shp_file, grid, output_file):
+    # Pixels whose center is inside the region, as the cutline of gdal.Warp
+    ds = gdal.GetDriverByName('GTiff').Create(output_file, grid['width'], grid['height'], 1, gdal.GDT_Byte,
+                                              options=cp.creation_options(gdal.GDT_Byte, 'tiled'))
+    ds.SetGeoTransform([grid['bounds'][0], grid['xres'], 0, grid['bounds'][3], 0, -grid['yres']])
+    ds.SetProjection(grid['srs'])
+    shp = ogr.Open(str(shp_file))
+    gdal.RasterizeLayer(ds, [1], shp.GetLayer(), burn_values=[1])
+    shp = None
+    ds = None
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    input_files, shp_file, grid_file, resampling, output_file, mask_file = from_args_to_vars(args)
+    grt.configure('warp')
+    stage = tm.start('region_stack')
+
+    if grid_file:
+        grid = pl.load_grid(grid_file)
+    else:
+        grid = pl.plan_grid(input_files[0], shp_file=shp_file)
+
+    build_stack(input_files, grid, output_file, resampling)
+    rasterize_mask(shp_file, grid, mask_file)
+    print("Region stack:", output_file, os.path.getsize(output_file), "bytes, mask:", mask_file)
+    stage.finish(inputs=input_files, outputs=[output_file, mask_file])
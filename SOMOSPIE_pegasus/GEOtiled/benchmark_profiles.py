@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Compares GeoTIFF creation profiles on our own rasters (terrain parameters, soil moisture averages):
+# file size, write time, time for random windowed reads and time for a downsampled (overview) read.
+# Example:
+# ./benchmark_profiles.py -i elevation.tif slope.tif 01.tif -p legacy tiled cog -c ZSTD DEFLATE -b 256 512 -o benchmark.csv
+
+import argparse
+import csv
+import os
+import random
+import tempfile
+from time import time
+from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark of GeoTIFF creation profiles.')
+    parser.add_argument('-i', "--infiles", help='Rasters to rewrite with each profile.', nargs='+')
+    parser.add_argument('-p', "--profiles", help='Profiles to compare (legacy, tiled, cog).', nargs='+', default=['legacy', 'tiled', 'cog'])
+    parser.add_argument('-c', "--compress", help='Compression methods for the tiled and cog profiles.', nargs='+', default=['ZSTD', 'DEFLATE'])
+    parser.add_argument('-b', "--blocksizes", help='Block sizes for the tiled and cog profiles.', nargs='+', type=int, default=[512])
+    parser.add_argument('-w', "--window", help='Size in pixels of the windows read.', type=int, default=256)
+    parser.add_argument('-n', "--nwindows", help='Number of random windows read per file.', type=int, default=50)
+    parser.add_argument('-s', "--overview", help='Width in pixels of the downsampled read.', type=int, default=1024)
+    parser.add_argument('-d', "--tmpdir", help='Folder for the rewritten files (removed afterwards).', default=None)
+    parser.add_argument('-o', "--outfile", help='CSV file with the results.', default='benchmark_profiles.csv')
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    return args.infiles, args.profiles, args.compress, args.blocksizes, args.window, args.nwindows, args.overview, args.tmpdir, args.outfile
+
+
+def get_configurations(profiles, compress, blocksizes):
+    # The legacy profile has fixed options, the others are combined with every compression and block size
+    configurations = []
+    for profile in profiles:
+        if profile == 'legacy':
+            configurations.append((profile, 'LZW', 256))
+            continue
+        for method in compress:
+            for block_size in blocksizes:
+                configurations.append((profile, cp.get_compression(method), block_size))
+    return configurations
+
+
+def write_raster(input_file, output_file, profile, compress, block_size):
+    data_type = cp.get_data_type(input_file)
+    t0 = time()
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(data_type, profile, compress, block_size))
+    gdal.Translate(output_file, input_file, options=translate_options)
+    return time() - t0
+
+
+def read_windows(raster, window, n_windows, seed=0):
+    # Random windows, the same ones for every profile of a given raster, read without block cache
+    cache = gdal.GetCacheMax()
+    gdal.SetCacheMax(0)
+    try:
+        ds = gdal.Open(raster, 0)
+        band = ds.GetRasterBand(1)
+        rng = random.Random(seed)
+        xsize = min(window, ds.RasterXSize)
+        ysize = min(window, ds.RasterYSize)
+        t0 = time()
+        for _ in range(n_windows):
+            xoff = rng.randint(0, ds.RasterXSize - xsize)
+            yoff = rng.randint(0, ds.RasterYSize - ysize)
+            band.ReadAsArray(xoff, yoff, xsize, ysize)
+        t = time() - t0
+        ds = None
+    finally:
+        # The writes of the next profiles are timed with the usual cache
+        gdal.SetCacheMax(cache)
+    return t
+
+
+def read_overview(raster, width):
+    # Reading the whole extent into a small buffer uses the overviews when the file has them
+    cache = gdal.GetCacheMax()
+    gdal.SetCacheMax(0)
+    try:
+        ds = gdal.Open(raster, 0)
+        band = ds.GetRasterBand(1)
+        width = min(width, ds.RasterXSize)
+        height = max(1, int(ds.RasterYSize * width / ds.RasterXSize))
+        t0 = time()
+        band.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize, buf_xsize=width, buf_ysize=height, resample_alg=gdal.GRIORA_Average)
+        t = time() - t0
+        overviews = band.GetOverviewCount()
+        ds = None
+    finally:
+        gdal.SetCacheMax(cache)
+    return t, overviews
+
+
+def benchmark(input_files, profiles, compress, blocksizes, window, n_windows, overview, tmp_dir, output_file):
+    results = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as folder:
+        for input_file in input_files:
+            for profile, method, block_size in get_configurations(profiles, compress, blocksizes):
+                out_file = os.path.join(folder, 'benchmark.tif')
+                write_time = write_raster(input_file, out_file, profile, method, block_size)
+                size = os.path.getsize(out_file)
+                window_time = read_windows(out_file, window, n_windows)
+                overview_time, overviews = read_overview(out_file, overview)
+                results.append({'file': os.path.basename(input_file), 'profile': profile, 'compress': method,
+                                'blocksize': block_size, 'bytes': size, 'write_s': write_time,
+                                'window_read_s': window_time, 'overview_read_s': overview_time, 'overviews': overviews})
+                print(results[-1])
+                gdal.Unlink(out_file)
+
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    return results
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    grt.configure('translate')
+    stage = tm.start('benchmark_profiles')
+    benchmark(*from_args_to_vars(args))
+    stage.finish(inputs=args.infiles, pixels=0)
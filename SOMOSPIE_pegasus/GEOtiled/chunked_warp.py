@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Chunked reprojection: the destination grid is split into windows aligned with the GeoTIFF blocks,
+# each window is warped by a separate process from the part of the source it needs, and the chunks
+# are assembled into the output at the end. Completed chunks are recorded in a manifest, so a run
+# that crashed is resumed by running the same command again.
+#
+# Command-line example:
+# ./chunked_warp.py -i mosaic.tif -o elevation_m.tif -p NAD_83.wkt -w 16 -c 8
+
+import argparse
+import json
+import math
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from osgeo import gdal # Install in a conda env: https://anaconda.org/conda-forge/gdal
+import creation_profile as cp
+import reproject_plan as pl
+import gdal_runtime as grt
+import telemetry as tm
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Arguments and data files for a chunked, resumable reprojection.')
+    parser.add_argument('-i', "--infile", help='Input file (DEM), can be a .vrt mosaic or a list of tiles.', nargs='+')
+    parser.add_argument('-o', "--outfile", help='Output file (reprojected DEM).')
+    parser.add_argument('-p', "--projection", help='Projection, can be an EPSG identifier such as EPSG:4326 or the path to a wkt file')
+    parser.add_argument('-n', "--nodata", help='If y, nodata value will be set to np.nan.', default='n')
+    parser.add_argument('-w', "--workers", help='Number of processes warping chunks.', type=int, default=os.cpu_count())
+    parser.add_argument('-c', "--chunk", help='Size of the chunks, in GeoTIFF blocks per side.', type=int, default=8)
+    parser.add_argument('-r', "--resampling", help='Resampling algorithm.', default='near')
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    input_file = args.infile[0] if len(args.infile) == 1 else args.infile
+    return input_file, args.outfile, args.projection, args.nodata, args.workers, args.chunk, args.resampling
+
+
+def get_chunks(grid, chunk_size):
+    # Windows [col, row, ncols, nrows] of the destination grid, chunk_size is a multiple of the block size
+    chunks = []
+    for row in range(0, grid['height'], chunk_size):
+        for col in range(0, grid['width'], chunk_size):
+            chunks.append([col, row, min(chunk_size, grid['width'] - col), min(chunk_size, grid['height'] - row)])
+    return chunks
+
+
+def chunk_bounds(grid, window):
+    col, row, ncols, nrows = window
+    xmin = grid['bounds'][0] + col * grid['xres']
+    ymax = grid['bounds'][3] - row * grid['yres']
+    return [xmin, ymax - nrows * grid['yres'], xmin + ncols * grid['xres'], ymax]
+
+
+def source_window(input_file, grid, window, margin=2):
+    # Pixels of the source needed by a destination window, with a margin for the resampling kernel.
+    # None when the window does not overlap the source.
+    src = pl.grid_from_raster(input_file)
+    bounds = pl.transform_bounds(chunk_bounds(grid, window), grid['srs'], src['srs'])
+    col0 = int(math.floor((bounds[0] - src['bounds'][0]) / src['xres'])) - margin
+    col1 = int(math.ceil((bounds[2] - src['bounds'][0]) / src['xres'])) + margin
+    row0 = int(math.floor((src['bounds'][3] - bounds[3]) / src['yres'])) - margin
+    row1 = int(math.ceil((src['bounds'][3] - bounds[1]) / src['yres'])) + margin
+    col0, row0 = max(col0, 0), max(row0, 0)
+    col1, row1 = min(col1, src['width']), min(row1, src['height'])
+    if col1 <= col0 or row1 <= row0:
+        return None
+    return [col0, row0, col1 - col0, row1 - row0]
+
+
+def warp_chunk(input_file, chunk_file, grid, window, nodata, resampling):
+    # Runs in a worker process: one thread per process, the pool gives the parallelism
+    src_win = source_window(input_file, grid, window)
+    if src_win is None:
+        return None
+
+    src_vrt = '/vsimem/{}.vrt'.format(os.path.basename(chunk_file))
+    gdal.Translate(src_vrt, input_file, options=gdal.TranslateOptions(format='VRT', srcWin=src_win))
+    _, _, ncols, nrows = window
+    warp_options = gdal.WarpOptions(dstSRS=grid['srs'], outputBounds=chunk_bounds(grid, window), width=ncols, height=nrows,
+                                    resampleAlg=resampling, dstNodata=nodata, warpMemoryLimit=grt.warp_memory(),
+                                    creationOptions=cp.creation_options(cp.get_data_type(input_file), 'tiled', threads=False))
+    tmp_file = chunk_file + '.tmp'
+    warp = gdal.Warp(tmp_file, src_vrt, options=warp_options)
+    warp = None  # Closes the files
+    gdal.Unlink(src_vrt)
+    # The chunk only exists once it is complete
+    os.replace(tmp_file, chunk_file)
+    return chunk_file
+
+
+def load_manifest(manifest_file, settings):
+    # Chunks completed by a previous run with the same settings
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('settings') != settings:
+        return {}
+    return {int(k): v for k, v in manifest['done'].items() if v is None or os.path.exists(v)}
+
+
+def save_manifest(manifest_file, settings, done):
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'settings': settings, 'done': {str(k): v for k, v in done.items()}}, f)
+    os.replace(tmp_file, manifest_file)
+
+
+def assemble(chunk_files, output_file, grid, nodata, data_type):
+    # The chunks are mosaicked through a VRT with the extent of the whole grid, missing chunks are nodata
+    vrt_file = output_file + '.vrt'
+    vrt_options = gdal.BuildVRTOptions(outputBounds=grid['bounds'], xRes=grid['xres'], yRes=grid['yres'],
+                                       VRTNodata=nodata, srcNodata=nodata)
+    vrt = gdal.BuildVRT(vrt_file, chunk_files, options=vrt_options)
+    vrt = None
+    translate_options = gdal.TranslateOptions(**cp.translate_kwargs(data_type), callback=gdal.TermProgress_nocb)
+    gdal.Translate(output_file, vrt_file, options=translate_options)
+    os.remove(vrt_file)
+
+
+def chunked_reproject(input_file, output_file, projection, nodata='n', workers=None, chunk=8, resampling='near'):
+    chunk_dir = output_file + '.chunks'
+    os.makedirs(chunk_dir, exist_ok=True)
+    if isinstance(input_file, (list, tuple)):
+        # A list of tiles is read by the workers through a VRT mosaic
+        vrt = gdal.BuildVRT(os.path.join(chunk_dir, 'source.vrt'), [os.path.abspath(f) for f in input_file])
+        vrt = None
+        input_file = os.path.join(chunk_dir, 'source.vrt')
+
+    src = gdal.Open(input_file, 0)
+    src_nodata = src.GetRasterBand(1).GetNoDataValue()
+    data_type = src.GetRasterBand(1).DataType
+    src = None
+    nodata = np.nan if nodata == 'y' else src_nodata
+
+    grid = pl.plan_grid(input_file, projection=projection)
+    chunk_size = chunk * cp.BLOCKSIZE
+    chunks = get_chunks(grid, chunk_size)
+
+    manifest_file = os.path.join(chunk_dir, 'manifest.json')
+    settings = {'input': os.path.abspath(input_file), 'grid': grid, 'chunk_size': chunk_size,
+                'nodata': None if nodata is None else str(nodata), 'resampling': resampling, 'profile': cp.PROFILE}
+    done = load_manifest(manifest_file, settings)
+    print("Chunks:", len(chunks), "Already done:", len(done))
+
+    # Each worker sizes its cache and warp memory for its share of the node
+    with ProcessPoolExecutor(max_workers=workers, initializer=grt.configure, initargs=('warp', workers, None, False)) as executor:
+        futures = {}
+        for i, window in enumerate(chunks):
+            if i in done:
+                continue
+            chunk_file = os.path.join(chunk_dir, 'chunk_{0:06d}.tif'.format(i))
+            futures[executor.submit(warp_chunk, input_file, chunk_file, grid, window, nodata, resampling)] = i
+        for future in as_completed(futures):
+            done[futures[future]] = future.result()
+            save_manifest(manifest_file, settings, done)
+
+    chunk_files = [done[i] for i in range(len(chunks)) if done[i] is not None]
+    assemble(chunk_files, output_file, grid, nodata, data_type)
+    shutil.rmtree(chunk_dir)
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    grt.configure('warp', workers=args.workers)
+    stage = tm.start('chunked_warp', workers=args.workers)
+    chunked_reproject(*from_args_to_vars(args))
+    stage.finish(inputs=args.infile, outputs=[args.outfile])
@@ -5,6 +5,9 @@ import pickle
 import numpy as np
 import os
 from osgeo import gdal
+import creation_profile as cp
+import gdal_runtime as grt
+import telemetry as tm
 
 
 def get_parser():
@@ -92,9 +95,10 @@ def rasterize(input_file, output_file, xres, yres):
 </OGRVRTDataSource>'.format('predictions', input_file)) # https://gdal.org/programs/gdal_grid.html#gdal-grid
     f.close()
     
-    rasterize_options = gdal.RasterizeOptions(xRes=xres, yRes=yres, attribute='z', noData=np.nan, outputType=gdal.GDT_Float32, creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'], callback=gdal.TermProgress_nocb)
+    rasterize_options = gdal.RasterizeOptions(xRes=xres, yRes=yres, attribute='z', noData=np.nan, outputType=gdal.GDT_Float32, creationOptions=cp.creation_options(gdal.GDT_Float32), callback=gdal.TermProgress_nocb)
     r = gdal.Rasterize(output_file, vrt_file, options=rasterize_options)
     r = None
+    cp.finalize(output_file)
     os.remove(vrt_file)
 
 
@@ -102,6 +106,8 @@ if __name__ == "__main__":
     parser = get_parser()
     args = parser.parse_args()
     evaluation_file, model_file, scaler_file, out_file = from_args_to_vars(args)
+    grt.configure('read')
+    stage = tm.start('evaluate_model')
 
     print("Loading dataset...")
     x_predict, evaluation_data = load_ds(evaluation_file, scaler_file)
@@ -118,4 +124,4 @@ if __name__ == "__main__":
     rasterize('./predictions.csv', out_file, gt[1], gt[5])
 
     os.remove('./predictions.csv')
-
+    stage.finish(inputs=[evaluation_file, model_file, scaler_file], outputs=[out_file], rows=len(x_predict))
@@ -5,6 +5,8 @@ import pandas as pd
 import argparse
 import pickle
 from osgeo import gdal
+import gdal_runtime as grt
+import telemetry as tm
 from sklearn.neighbors import KNeighborsRegressor
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.model_selection import train_test_split
@@ -15,7 +17,8 @@ from sklearn.metrics import mean_squared_error
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Arguments and data files for executing Nearest Neighbors Regression or Random Forest.')
-    parser.add_argument('-i', "--infile", help='Training GeoTIF file.')
+    parser.add_argument('-i', "--infile", help='Training GeoTIF file, or multi-month training table (.parquet or .csv from training_table.py).')
+    parser.add_argument('-c', "--month", help='Month to train on, selects the sm_<month> column of a training table.', default=None)
     parser.add_argument('-o', "--outfile", help='Path where the model will be saved')
     parser.add_argument('-s', "--scfile", help='Path where the scaler will be saved')
     parser.add_argument('-m', "--model", help='Model to train (knn or rf)', default='knn')
@@ -33,7 +36,8 @@ def from_args_to_vars (args):
     maxK = int(args.maxK)
     maxtree = int(args.maxtree)
     seed = int(args.seed)
-    return train_file, model_file, scaler_file, model, maxK, maxtree, seed
+    month = int(args.month) if args.month else None
+    return train_file, model_file, scaler_file, model, maxK, maxtree, seed, month
 
 
 def tif2df(raster_file):
@@ -68,6 +72,26 @@ def tif2df(raster_file):
     return df
 
 
+def table2df(table_file, month):
+    # Only the covariates and the column of the month are read, renamed z as in tif2df
+    month_column = 'sm_{0:02d}'.format(month)
+    if table_file.endswith('.csv'):
+        columns = pd.read_csv(table_file, nrows=0).columns
+    else:
+        import pyarrow.parquet as pq
+        columns = pq.read_schema(table_file).names
+    covariates = [c for c in columns if not c.startswith('sm_')]
+    selected = ['x', 'y', month_column] + [c for c in covariates if c not in ['x', 'y']]
+
+    if table_file.endswith('.csv'):
+        df = pd.read_csv(table_file, usecols=selected)[selected]
+    else:
+        df = pd.read_parquet(table_file, columns=selected)
+    df = df.rename(columns={month_column: 'z'})
+    df.dropna(inplace=True)
+    return df
+
+
 def get_band_names(raster):
     ds = gdal.Open(raster, 0)
     names = []
@@ -78,8 +102,11 @@ def get_band_names(raster):
     return names
 
 
-def load_ds(train_file, scaler_file):
-    train_data = tif2df(train_file)
+def load_ds(train_file, scaler_file, month=None):
+    if month is None:
+        train_data = tif2df(train_file)
+    else:
+        train_data = table2df(train_file, month)
     print(train_data.shape)
 
     x_train, x_val, y_train, y_val = train_test_split(train_data.loc[:,train_data.columns != 'z'], train_data.loc[:,'z'], test_size=0.1)
@@ -181,9 +208,11 @@ def validate_model(model, x_val, y_val):
 if __name__ == "__main__":	
     parser = get_parser()
     args = parser.parse_args()
-    train_file, model_file, scaler_file, model, maxK, maxtree, seed = from_args_to_vars(args)
+    train_file, model_file, scaler_file, model, maxK, maxtree, seed, month = from_args_to_vars(args)
+    grt.configure('read')
+    stage = tm.start('train_model', model=model, month=month)
     
-    x_train, x_val, y_train, y_val = load_ds(train_file, scaler_file)
+    x_train, x_val, y_train, y_val = load_ds(train_file, scaler_file, month)
 
     if model == 'knn':
         model = train_knn(x_train, y_train, maxK, seed, model_file)
@@ -191,3 +220,4 @@ if __name__ == "__main__":
         model = train_rf(x_train, y_train, maxtree, seed, model_file)
 
     validate_model(model, x_val, y_val)
+    stage.finish(inputs=[train_file], outputs=[model_file, scaler_file], rows=len(x_train) + len(x_val))
@@ -28,6 +28,7 @@ def _main():
     ]
     shp_path = "s3://" + access_user + "@osn/" + osn_bucket + "/shpFiles/OK.zip"
     n_tiles = 6
+    training_table = True  # One multi-month training table instead of 12 training GeoTIFFs
 
     BASE_DIR = Path(".").resolve()
 
@@ -58,6 +59,19 @@ def _main():
     shp_file = File(os.path.basename(shp_path))
     rc.add_replica(site="osn", lfn=shp_file, pfn=shp_path)
 
+    # Module with the GeoTIFF creation profile, imported by the job scripts
+    profile_module = File("creation_profile.py")
+    rc.add_replica(site="local", lfn=profile_module, pfn=Path(".").resolve() / "code/creation_profile.py")
+    # Module planning the grids the terrain parameters are warped to, imported by generate_train and generate_eval
+    plan_module = File("reproject_plan.py")
+    rc.add_replica(site="local", lfn=plan_module, pfn=Path(".").resolve() / "code/reproject_plan.py")
+    # Module sizing the GDAL cache and threads for the node, imported by every job script
+    runtime_module = File("gdal_runtime.py")
+    rc.add_replica(site="local", lfn=runtime_module, pfn=Path(".").resolve() / "code/gdal_runtime.py")
+    # Module recording the timing and resources of each job, imported by every job script
+    telemetry_module = File("telemetry.py")
+    rc.add_replica(site="local", lfn=telemetry_module, pfn=Path(".").resolve() / "code/telemetry.py")
+
     rc.write()
 
     # --- Container ----------------------------------------------------------
@@ -98,10 +112,40 @@ def _main():
         os_type=OS.LINUX,
     ).add_profiles(Namespace.CONDOR, request_memory="8GB", request_disk="70GB")
 
+    terrain_stack = Transformation(
+        "terrain_stack.py",
+        site="local",
+        pfn=Path(".").resolve() / "code/terrain_stack.py",
+        is_stageable=True,
+        container=base_container,
+        arch=Arch.X86_64,
+        os_type=OS.LINUX,
+    ).add_profiles(Namespace.CONDOR, request_memory="3GB")
+
+    build_training_table = Transformation(
+        "training_table.py",
+        site="local",
+        pfn=Path(".").resolve() / "code/training_table.py",
+        is_stageable=True,
+        container=base_container,
+        arch=Arch.X86_64,
+        os_type=OS.LINUX,
+    ).add_profiles(Namespace.CONDOR, request_memory="3GB")
+
+    region_stack = Transformation(
+        "region_stack.py",
+        site="local",
+        pfn=Path(".").resolve() / "code/region_stack.py",
+        is_stageable=True,
+        container=base_container,
+        arch=Arch.X86_64,
+        os_type=OS.LINUX,
+    ).add_profiles(Namespace.CONDOR, request_memory="8GB", request_disk="70GB")
+
     tc = (
         TransformationCatalog()
         .add_containers(base_container)
-        .add_transformations(get_sm, generate_train, generate_eval)
+        .add_transformations(get_sm, terrain_stack, build_training_table, generate_train, region_stack, generate_eval)
         .write()
     )  # written to ./transformations.yml
 
@@ -159,53 +203,115 @@ def _main():
     job_get_sm = (
         Job(get_sm)
         .add_args("-y", year, "-a", avg_type, "-o", *avg_files)
+        .add_inputs(profile_module, runtime_module, telemetry_module)
         .add_outputs(*avg_files, stage_out=stg_out)
     )  # bypass_staging=False
 
     wf.add_jobs(job_get_sm)
 
-    # Generate training files
-    for i, avg_file in enumerate(avg_files):
-        train_file = File("{0:04d}_{1:02d}.tif".format(year, i + 1))
-        train_file_aux = File("{0:04d}_{1:02d}.tif.aux.xml".format(year, i + 1))
-        job_generate_train = (
-            Job(generate_train)
+    # Terrain parameters resampled and cropped to the soil moisture grid once, for the 12 months
+    terrain_file = File("terrain_stack.tif")
+    job_terrain_stack = (
+        Job(terrain_stack)
+        .add_args(
+            "-i",
+            avg_files[0],
+            "-f",
+            *param_files,
+            "-p",
+            *param_names,
+            "-s",
+            shp_file,
+            "-o",
+            terrain_file
+        )
+        .add_inputs(avg_files[0], *param_files, shp_file, profile_module, plan_module, runtime_module, telemetry_module)
+        .add_outputs(terrain_file, stage_out=stg_out)
+    )
+    wf.add_jobs(job_terrain_stack)
+
+    # Training table of the year, the months are selected by column when training
+    if training_table:
+        table_file = File("{0:04d}_training.parquet".format(year))
+        job_training_table = (
+            Job(build_training_table)
             .add_args(
+                "-t",
+                terrain_file,
                 "-i",
-                avg_file,
-                "-o",
-                train_file,
-                "-f",
-                *param_files,
-                "-p",
-                *param_names,
+                *avg_files,
                 "-s",
-                shp_file
+                shp_file,
+                "-o",
+                table_file
+            )
+            .add_inputs(terrain_file, *avg_files, shp_file, profile_module, plan_module, runtime_module, telemetry_module)
+            .add_outputs(table_file, stage_out=True)
+        )
+        wf.add_jobs(job_training_table)
+    else:
+        # Otherwise one training file per month, only the band of the month is warped
+        for i, avg_file in enumerate(avg_files):
+            train_file = File("{0:04d}_{1:02d}.tif".format(year, i + 1))
+            train_file_aux = File("{0:04d}_{1:02d}.tif.aux.xml".format(year, i + 1))
+            job_generate_train = (
+                Job(generate_train)
+                .add_args(
+                    "-i",
+                    avg_file,
+                    "-o",
+                    train_file,
+                    "-t",
+                    terrain_file,
+                    "-p",
+                    *param_names,
+                    "-s",
+                    shp_file
+                )
+                .add_inputs(avg_file, terrain_file, shp_file, profile_module, plan_module, runtime_module, telemetry_module)
+                .add_outputs(train_file, train_file_aux, stage_out=True)
             )
-            .add_inputs(avg_file, *param_files, shp_file)
-            .add_outputs(train_file, train_file_aux, stage_out=True)
+            wf.add_jobs(job_generate_train)
+
+    # Parameters cropped to the region once, for every eval tile
+    region_file = File("region_stack.tif")
+    mask_file = File("region_mask.tif")
+    job_region_stack = (
+        Job(region_stack)
+        .add_args(
+            "-i",
+            *param_files,
+            "-s",
+            shp_file,
+            "-o",
+            region_file,
+            "-m",
+            mask_file
         )
-        wf.add_jobs(job_generate_train)
+        .add_inputs(*param_files, shp_file, profile_module, plan_module, runtime_module, telemetry_module)
+        .add_outputs(region_file, mask_file, stage_out=stg_out)
+    )
+    wf.add_jobs(job_region_stack)
 
-    # Generate eval files
+    # Generate eval files, each job reads its window of the region stack
     if n_tiles == 0:
         eval_file = File("eval.tif")
         eval_file_aux = File("eval.tif.aux.xml")
         job_generate_eval = (
             Job(generate_eval)
             .add_args(
-                "-i",
-                *param_files,
+                "-c",
+                region_file,
+                "-m",
+                mask_file,
                 "-p",
                 *param_names,
                 "-n",
                 n_tiles,
-                "-s",
-                shp_file,
                 "-o",
                 eval_file
             )
-            .add_inputs(*param_files, shp_file)
+            .add_inputs(region_file, mask_file, profile_module, plan_module, runtime_module, telemetry_module)
             .add_outputs(eval_file, eval_file_aux, stage_out=True)
         )
         wf.add_jobs(job_generate_eval)
@@ -219,8 +325,10 @@ def _main():
             job_generate_eval = (
                 Job(generate_eval)
                 .add_args(
-                    "-i",
-                    *param_files,
+                    "-c",
+                    region_file,
+                    "-m",
+                    mask_file,
                     "-p",
                     *param_names,
                     "-n",
@@ -229,12 +337,10 @@ def _main():
                     i,
                     "-y",
                     j,
-                    "-s",
-                    shp_file,
                     "-o",
                     eval_file
                 )
-                .add_inputs(*param_files, shp_file)
+                .add_inputs(region_file, mask_file, profile_module, plan_module, runtime_module, telemetry_module)
                 .add_outputs(eval_file, eval_file_aux, stage_out=True)
             )
             wf.add_jobs(job_generate_eval)
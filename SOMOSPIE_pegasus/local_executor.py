@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+# Local executor for the SOMOSPIE Pegasus workflows, without Pegasus or HTCondor.
+#
+# Reads the files written by the generators (workflow.yml, replicas.yml and transformations.yml) and runs
+# the jobs in dependency order on a pool of processes. As with nonsharedfs, each job runs in its own
+# directory with its inputs linked in, and its outputs are moved to the work directory afterwards.
+#
+# A job is skipped when its outputs exist and the content hashes of its inputs (executable included)
+# are the ones recorded the last time it ran, so running again only rebuilds what changed.
+#
+# Command-line example (after ./workflow_generator.py --year 2010):
+# ../local_executor.py -w workflow.yml -r replicas.yml -t transformations.yml -d run -j 4 -s code config
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import yaml
+
+
+STATE_FILE = '.executor_state.json'
+HASH_BLOCK = 4 * 1024**2
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Arguments and files to run a SOMOSPIE Pegasus workflow locally.')
+    parser.add_argument('-w', "--workflow", help='Workflow written by the generator.', default='workflow.yml')
+    parser.add_argument('-r', "--replicas", help='Replica catalog (also read from the workflow if embedded).', default='replicas.yml')
+    parser.add_argument('-t', "--transformations", help='Transformation catalog (also read from the workflow if embedded).', default='transformations.yml')
+    parser.add_argument('-d', "--workdir", help='Directory with the inputs, outputs and logs of the jobs.', default='local-run')
+    parser.add_argument('-j', "--jobs", help='Number of jobs running at the same time.', type=int, default=os.cpu_count())
+    parser.add_argument('-s', "--search", help='Directories where inputs and executables are looked up by name before their replicas.', nargs='*', default=[])
+    parser.add_argument('-f', "--force", help='Run every job, even the ones whose inputs did not change.', action='store_true')
+    parser.add_argument('-n', "--dry-run", help='Only print the jobs that would run.', action='store_true')
+    return parser
+
+#Translate from namespaces to Python variables
+def from_args_to_vars (args):
+    return args.workflow, args.replicas, args.transformations, args.workdir, max(1, args.jobs), args.search, args.force, args.dry_run
+
+
+def load_yaml(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+
+def load_catalogs(workflow, replica_file, transformation_file):
+    # lfn -> list of pfns, transformation name -> pfn of the executable
+    replicas = {}
+    for catalog in [load_yaml(replica_file), workflow.get('replicaCatalog', {})]:
+        for entry in catalog.get('replicas', []):
+            replicas.setdefault(entry['lfn'], []).extend(pfn['pfn'] for pfn in entry.get('pfns', []))
+
+    executables = {}
+    for catalog in [load_yaml(transformation_file), workflow.get('transformationCatalog', {})]:
+        for transformation in catalog.get('transformations', []):
+            for site in transformation.get('sites', []):
+                executables.setdefault(transformation['name'], site['pfn'])
+    return replicas, executables
+
+
+def load_jobs(workflow):
+    # Jobs with their inputs and outputs (lfns), dependencies declared in the workflow and inferred from the files
+    jobs = {}
+    for job in workflow.get('jobs', []):
+        uses = job.get('uses', [])
+        jobs[job['id']] = {
+            'id': job['id'],
+            'name': job['name'],
+            'args': [str(arg) for arg in job.get('arguments', [])],
+            'inputs': sorted(u['lfn'] for u in uses if u['type'] == 'input'),
+            'outputs': sorted(u['lfn'] for u in uses if u['type'] in ('output', 'checkpoint')),
+            'parents': set(),
+        }
+
+    producers = {lfn: job['id'] for job in jobs.values() for lfn in job['outputs']}
+    for job in jobs.values():
+        job['parents'] |= {producers[lfn] for lfn in job['inputs'] if lfn in producers}
+    for dependency in workflow.get('jobDependencies', []):
+        for child in dependency.get('children', []):
+            jobs[child]['parents'].add(dependency['id'])
+    return jobs, producers
+
+
+def local_path(pfn):
+    # Path of a pfn on this machine, None for remote replicas
+    parsed = urllib.parse.urlparse(str(pfn))
+    if parsed.scheme in ('', 'file'):
+        return urllib.parse.unquote(parsed.path)
+    return None
+
+
+def resolve(lfn, pfns, search):
+    # Where an input comes from: a file found by name in the search directories, a local replica or a url
+    for directory in search:
+        candidate = os.path.join(directory, os.path.basename(lfn))
+        if os.path.exists(candidate):
+            return os.path.abspath(candidate)
+    remote = None
+    for pfn in pfns:
+        path = local_path(pfn)
+        if path is not None:
+            if os.path.exists(path):
+                return path
+        elif urllib.parse.urlparse(pfn).scheme in ('http', 'https'):
+            remote = pfn
+    return remote
+
+
+def file_hash(path, hashes):
+    # sha256 of the content, cached by size and modification time so unchanged files are not read again
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    cached = hashes.get(key)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    hashes[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return hashes[key][2]
+
+
+def job_key(job):
+    # Job ids change when the generator adds or removes jobs, the command does not
+    return job['name'] + ' ' + ' '.join(job['args'])
+
+
+def run_job(job, executable, sources, workdir, env):
+    # Runs in a worker process: stages the inputs, runs the job in its own directory and moves the outputs back
+    job_dir = os.path.join(workdir, 'jobs', job['id'])
+    shutil.rmtree(job_dir, ignore_errors=True)
+    os.makedirs(job_dir)
+    log_file = os.path.join(workdir, 'logs', job['id'] + '.log')
+
+    for lfn, source in sources.items():
+        stored = os.path.join(workdir, lfn)
+        if not os.path.exists(stored):
+            # Downloaded to a temporary name first, jobs sharing an input may fetch it at the same time
+            tmp = '{}.{}.part'.format(stored, os.getpid())
+            urllib.request.urlretrieve(source, tmp)
+            os.replace(tmp, stored)
+    for lfn in job['inputs']:
+        os.symlink(os.path.join(workdir, lfn), os.path.join(job_dir, lfn))
+
+    # The executable is staged next to the modules it imports, as Pegasus does with stageable transformations
+    script = os.path.join(job_dir, os.path.basename(executable))
+    if not os.path.exists(script):
+        shutil.copy(executable, script)
+    command = [sys.executable, script, *job['args']] if script.endswith('.py') else [script, *job['args']]
+
+    start = time.time()
+    with open(log_file, 'w') as log:
+        log.write(' '.join(command) + '\n')
+        log.flush()
+        returncode = subprocess.run(command, cwd=job_dir, stdout=log, stderr=subprocess.STDOUT, env=env).returncode
+
+    missing = [lfn for lfn in job['outputs'] if not os.path.exists(os.path.join(job_dir, lfn))]
+    if returncode == 0 and not missing:
+        for lfn in job['outputs']:
+            os.replace(os.path.join(job_dir, lfn), os.path.join(workdir, lfn))
+        shutil.rmtree(job_dir, ignore_errors=True)  # Kept when the job fails, for debugging
+    return job['id'], returncode, missing, time.time() - start
+
+
+class LocalExecutor:
+
+    def __init__(self, jobs, producers, replicas, executables, workdir, workers=1, search=(), force=False):
+        self.jobs = jobs
+        self.producers = producers
+        self.replicas = replicas
+        self.executables = executables
+        self.workdir = os.path.abspath(workdir)
+        self.workers = workers
+        self.search = list(search)
+        self.force = force
+        self.state = {'jobs': {}, 'hashes': {}}
+        state_file = os.path.join(self.workdir, STATE_FILE)
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.state = json.load(f)
+
+    def save_state(self):
+        tmp = os.path.join(self.workdir, STATE_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, os.path.join(self.workdir, STATE_FILE))
+
+    def executable(self, job):
+        pfn = self.executables.get(job['name'])
+        if pfn is None:
+            raise ValueError("No transformation {} in the catalog".format(job['name']))
+        path = resolve(os.path.basename(local_path(pfn) or pfn), [pfn], self.search)
+        if path is None or local_path(path) is None:
+            raise ValueError("Executable of {} not found: {}".format(job['name'], pfn))
+        return path
+
+    def sources(self, job):
+        # Inputs not produced by the workflow, not yet in the work directory
+        sources = {}
+        for lfn in job['inputs']:
+            if lfn in self.producers or os.path.exists(os.path.join(self.workdir, lfn)):
+                continue
+            source = resolve(lfn, self.replicas.get(lfn, []), self.search)
+            if source is None:
+                raise ValueError("No local or http replica of {} (job {}), use -s with a directory that has it".format(lfn, job['id']))
+            if local_path(source) is not None:
+                if os.path.lexists(os.path.join(self.workdir, lfn)):
+                    os.remove(os.path.join(self.workdir, lfn))  # Broken link from a previous run
+                os.symlink(os.path.abspath(source), os.path.join(self.workdir, lfn))
+            else:
+                sources[lfn] = source
+        return sources
+
+    def signature(self, job, executable):
+        hashes = self.state['hashes']
+        signature = {lfn: file_hash(os.path.join(self.workdir, lfn), hashes) for lfn in job['inputs']}
+        signature[job['name']] = file_hash(executable, hashes)
+        return signature
+
+    def up_to_date(self, job, executable):
+        if self.force or not all(os.path.exists(os.path.join(self.workdir, lfn)) for lfn in job['outputs']):
+            return False
+        if not all(os.path.exists(os.path.join(self.workdir, lfn)) for lfn in job['inputs']):
+            return False
+        recorded = self.state['jobs'].get(job_key(job))
+        return recorded is not None and recorded == self.signature(job, executable)
+
+    def environment(self):
+        # Jobs share the node: gdal_runtime sizes threads and caches for the cores of one worker
+        env = dict(os.environ)
+        if 'SOMOSPIE_CORES' not in env:
+            env['SOMOSPIE_CORES'] = str(max(1, (os.cpu_count() or 1) // self.workers))
+        # Stage telemetry of every job in a single file of the work directory (see telemetry_report.py)
+        env.setdefault('SOMOSPIE_TELEMETRY', os.path.join(self.workdir, 'telemetry.jsonl'))
+        env.setdefault('SOMOSPIE_RUN_ID', time.strftime('run_%Y_%m_%d_%H_%M_%S', time.gmtime()))
+        return env
+
+    def run(self, dry_run=False):
+        os.makedirs(os.path.join(self.workdir, 'logs'), exist_ok=True)
+        os.makedirs(os.path.join(self.workdir, 'jobs'), exist_ok=True)
+        env = self.environment()
+
+        waiting = {job_id: set(job['parents']) for job_id, job in self.jobs.items()}
+        children = {job_id: [] for job_id in self.jobs}
+        for job_id, parents in waiting.items():
+            for parent in parents:
+                children[parent].append(job_id)
+
+        done, skipped, failed = set(), set(), set()
+        ready = sorted(job_id for job_id, parents in waiting.items() if not parents)
+        running = {}
+
+        def release(job_id):
+            for child in children[job_id]:
+                waiting[child].discard(job_id)
+                if not waiting[child]:
+                    ready.append(child)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            while ready or running:
+                while ready and len(running) < self.workers:
+                    job = self.jobs[ready.pop(0)]
+                    try:
+                        executable = self.executable(job)
+                        sources = self.sources(job)
+                    except (ValueError, OSError) as e:
+                        print("FAILED", job['id'], job['name'], e)
+                        failed.add(job['id'])
+                        continue
+                    if not sources and self.up_to_date(job, executable):
+                        skipped.add(job['id'])
+                        release(job['id'])
+                        continue
+                    if dry_run:
+                        print("RUN", job['id'], job['name'], ' '.join(job['args']))
+                        done.add(job['id'])
+                        release(job['id'])
+                        continue
+                    running[pool.submit(run_job, job, executable, sources, self.workdir, env)] = executable
+
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    executable = running.pop(future)
+                    job_id, returncode, missing, elapsed = future.result()
+                    job = self.jobs[job_id]
+                    if returncode != 0 or missing:
+                        print("FAILED", job_id, job['name'], "exit code", returncode, "missing outputs", missing,
+                              "log:", os.path.join(self.workdir, 'logs', job_id + '.log'))
+                        failed.add(job_id)
+                        continue
+                    print("DONE", job_id, job['name'], "{:.1f} s".format(elapsed))
+                    self.state['jobs'][job_key(job)] = self.signature(job, executable)
+                    self.save_state()
+                    done.add(job_id)
+                    release(job_id)
+
+        if not dry_run:
+            self.save_state()
+        blocked = set(self.jobs) - done - skipped - failed
+        print("Jobs: {} run, {} up to date, {} failed, {} not run".format(len(done), len(skipped), len(failed), len(blocked)))
+        return not failed and not blocked
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    workflow_file, replica_file, transformation_file, workdir, workers, search, force, dry_run = from_args_to_vars(args)
+
+    workflow = load_yaml(workflow_file)
+    replicas, executables = load_catalogs(workflow, replica_file, transformation_file)
+    jobs, producers = load_jobs(workflow)
+    os.makedirs(workdir, exist_ok=True)
+
+    executor = LocalExecutor(jobs, producers, replicas, executables, workdir, workers, search, force)
+    sys.exit(0 if executor.run(dry_run) else 1)